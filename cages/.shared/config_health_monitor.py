@@ -1,11 +1,15 @@
 # this module configures health monitor module, when started
 # on a cage called health_monitor, it sends probes to each
-# cage approximately once in probe_period
+# cage approximately once in probe_period, if collect_performance
+# is set, each probe also fetches the performance snapshot of
+# the probed cage, which is then displayed on the cluster-wide
+# page of the health monitor's performance interface (/cluster)
 
 config = dict \
 (
 probe_period = 30.0,    # seconds between probing passes
 connect_timeout = 3.0,  # connect timeout for probe request
+collect_performance = False, # fetch performance snapshots along with probes
 )
 
 # self-tests of health_monitor.py depend on the following configuration,
@@ -14,6 +18,7 @@ connect_timeout = 3.0,  # connect timeout for probe request
 self_test_config = dict \
 (
 probe_period = 1.0,
+collect_performance = True,
 )
 
 # DO NOT TOUCH BELOW THIS LINE
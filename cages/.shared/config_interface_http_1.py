@@ -3,12 +3,17 @@
 #
 # copy this file to your own cage, possibly renaming into
 # config_interface_YOUR_INTERFACE_NAME.py, then modify the copy
+#
+# with io_threads > 1 each I/O thread listens on its own socket bound to
+# the same port with SO_REUSEPORT where supported, the port is still not
+# shared with any other process, if it is in use the interface fails to start
 
 config = dict \
 (
 protocol = "http",                        # meta
 listener_address = ("0.0.0.0", 80),       # tcp
 max_connections = 100,                    # tcp
+io_threads = 1,                           # tcp, more I/O threads scale parsing and SSL
 ssl_key_cert_file = None,                 # ssl, optional filename
 ssl_ca_cert_file = None,                  # ssl, optional filename
 ssl_ciphers = None,                       # ssl, optional str
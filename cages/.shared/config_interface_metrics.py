@@ -0,0 +1,39 @@
+# configuration file for standard HTTP interface "metrics"
+#
+# this file configures a http interface for exporting cage
+# performance statistics collected in module performance.py
+# in OpenMetrics text format, to be scraped by Prometheus or
+# compatible monitoring systems
+#
+# each cage needs its own copy of this file, each with its own
+# different port number
+#
+# the exported text is rendered at most once in cache_seconds,
+# all the scrapes within the same time slice get the same copy
+
+config = dict \
+(
+protocol = "http",                                # meta
+listener_address = ("0.0.0.0", 0),                # tcp (note that each cage needs a separate port)
+max_connections = 100,                            # tcp
+ssl_key_cert_file = None,                         # ssl, optional filename
+ssl_ca_cert_file = None,                          # ssl, optional filename
+ssl_ciphers = None,                               # ssl, optional str
+response_encoding = "ascii",                      # http
+original_ip_header_fields = (),                   # http
+allowed_methods = ("GET", ),                      # http
+keep_alive_support = True,                        # http
+keep_alive_idle_timeout = 120.0,                  # http
+keep_alive_max_requests = 100,                    # http
+gzip_content_types = (),                          # http
+cache_seconds = 5,                                # metrics
+)
+
+# DO NOT TOUCH BELOW THIS LINE
+
+__all__ = [ "get", "copy" ]
+
+get = lambda key, default = None: pmnc.config.get_(config, {}, key, default)
+copy = lambda: pmnc.config.copy_(config, {})
+
+# EOF
@@ -28,6 +28,7 @@ keep_alive_max_requests = 10,                     # http
 gzip_content_types = ("text/.+", ),               # http
 refresh_seconds = 10,                             # performance
 css_font_family = "DejaVu Sans Mono, monospace",  # performance
+profiler_max_seconds = 600,                       # performance
 )
 
 # DO NOT TOUCH BELOW THIS LINE
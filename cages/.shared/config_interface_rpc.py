@@ -16,6 +16,11 @@
 # config_resource_rpc.py exact_locations parameter specifying this
 # cage's address.
 #
+# With io_threads > 1 and an exact port, each I/O thread listens on its
+# own socket bound to the same port with SO_REUSEPORT where supported,
+# the port is still not shared with any other process, if it is in use
+# the interface fails to start.
+#
 # There is no need to make a copy of this file for each cage,
 # but you may need to modify the broadcast_address parameter
 # if your OS doesn't work with 255.255.255.255 broadcasts,
@@ -27,6 +32,7 @@ config = dict \
 protocol = "rpc",                                       # meta
 random_port = -63000,                                   # tcp, negative means "in range 63000..63999"
 max_connections = 100,                                  # tcp
+io_threads = 1,                                         # tcp, more I/O threads scale parsing and SSL
 broadcast_address = ("0.0.0.0/255.255.255.255", 12480), # rpc, "interface address/broadcast address", port
 ssl_ciphers = None,                                     # ssl, optional str
 ssl_protocol = None,                                    # ssl, optional "SSLv23", "TLSv1", "TLSv1_1", "TLSv1_2" or "TLS"
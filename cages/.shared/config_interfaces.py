@@ -13,6 +13,25 @@
 #
 # log_level can be changed at runtime to temporarily increase logging
 # verbosity (set to "DEBUG") to see wtf is going on
+#
+# log_overflow is what happens when the log lines are produced faster
+# than the log writer thread can write them out, the logging thread
+# either waits ("block"), or the line is dropped ("drop"), or one line
+# in a hundred waits and the rest are dropped ("sample"), the number of
+# dropped lines is then reported in the log, errors are never dropped
+#
+# log_repeat_limits contain storms of the same message, such as a failure
+# to connect to something, logged from the same place over and over again,
+# at most the specified number of such messages are logged per 10 seconds
+# at each log level, the rest are counted and reported with a single line,
+# the messages are considered the same if they only differ in numbers,
+# the limits are off by default, a level that is missing or None is not
+# limited, for example
+# log_repeat_limits = dict(ERROR = None, WARNING = 100, LOG = 20, INFO = 20)
+#
+# log_format "jsonl" switches the log to cage-yyyymmdd.jsonl with
+# one JSON object per line, the lines of any request can then be
+# looked up instantly with tools/logsearch.py
 
 config = dict \
 (
@@ -21,6 +40,9 @@ request_timeout = 10.0,                       # global request timeout for this
 thread_count = 10,                            # interfaces worker thread pool size
 sweep_period = 15.0,                          # time between scanning all pools for expired objects
 log_level = "INFO",                           # one of "ERROR", "WARNING", "LOG", "INFO", "DEBUG", "NOISE"
+log_overflow = "block",                       # one of "block", "drop", "sample"
+log_repeat_limits = None,                     # same messages per 10 seconds, per level, None is unlimited
+log_format = "text",                          # one of "text", "jsonl"
 )
 
 # DO NOT TOUCH BELOW THIS LINE
@@ -7,7 +7,7 @@ config = dict \
 protocol = "callable",          # meta
 )
 
-# self-tests of protocol_callable.py depend on the following configuration,
+# self-tests of protocol_callable.py and transaction.py depend on the following configuration,
 # this dict may safely be removed in production copies of this module
 
 self_test_config = dict \
@@ -15,7 +15,8 @@ self_test_config = dict \
 pool__cache_size = 3,
 pool__cache_policy = "weight",  # will also be used for testing "weight" eviction policy
 pool__cache_default_ttl = 2.0,  # enable caching for this pool, but for a very short time
-pool__cache_evict_period = 3.0  # eviction will be possible once every 3 seconds
+pool__cache_evict_period = 3.0, # eviction will be possible once every 3 seconds
+pool__cache_stale_ttl = 2.0,    # expired values will be returned and refreshed for 2 more seconds
 )
 
 # DO NOT TOUCH BELOW THIS LINE
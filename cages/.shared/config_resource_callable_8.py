@@ -0,0 +1,30 @@
+# this configuration module exists for self-testing, but you can use it as
+# a reference for configuring resources of "callable" protocol, in which case
+# you copy this file and edit the copy
+
+config = dict \
+(
+protocol = "callable",              # meta
+)
+
+# self-tests of transaction.py depend on the following configuration,
+# this dict may safely be removed in production copies of this module
+
+self_test_config = dict \
+(
+pool__cache_size = 10,       # enable caching for this pool
+pool__breaker_failures = 2,  # the circuit breaker opens after 2 consecutive failures
+pool__breaker_timeout = 1.0, # and lets a probe through after 1 second
+)
+
+# DO NOT TOUCH BELOW THIS LINE
+
+__all__ = [ "get", "copy" ]
+
+try: self_test_config
+except NameError: self_test_config = {}
+
+get = lambda key, default = None: pmnc.config.get_(config, self_test_config, key, default)
+copy = lambda: pmnc.config.copy_(config, self_test_config)
+
+# EOF
\ No newline at end of file
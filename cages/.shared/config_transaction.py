@@ -0,0 +1,24 @@
+# this module configures transaction module, when trace_threshold
+# is set, each transaction records the timeline of the phases its
+# participants go through, such as waiting for a thread, allocating
+# and connecting a resource instance, waiting for the cache, executing,
+# waiting for the decision and committing, the time spent in each phase
+# is sampled as resource.foo.phase_time, and the transactions taking
+# longer than trace_threshold have their timelines written to the log
+
+config = dict \
+(
+trace_threshold = None, # seconds, enables phase tracing of all the transactions, None disables
+)
+
+# DO NOT TOUCH BELOW THIS LINE
+
+__all__ = [ "get", "copy" ]
+
+try: self_test_config
+except NameError: self_test_config = {}
+
+get = lambda key, default = None: pmnc.config.get_(config, self_test_config, key, default)
+copy = lambda: pmnc.config.copy_(config, self_test_config)
+
+# EOF
@@ -7,6 +7,14 @@
 # although nothing prevents two or more, if so the regular cages will simply
 # receive more probes.
 #
+# If collect_performance is enabled in config_health_monitor.py, each probe
+# is followed by a call to performance.extract_snapshot() on the probed cage
+# over the same connection, which returns the performance totals changed since the previous snapshot.
+# The differences between the consecutive snapshots give the request rate and
+# the response time distribution of each cage at each node over the last probe
+# period, these are merged per cage across the nodes and returned by
+# extract_performance() for displaying (see interface_performance.py).
+#
 # Pythomnic3k project
 # (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
 # Distributed under BSD license
@@ -20,7 +28,7 @@ __all__ = [ "HealthMonitor" ]
 import os; from os import urandom
 import time; from time import strftime
 import binascii; from binascii import b2a_hex
-import threading; from threading import current_thread
+import threading; from threading import current_thread, Lock
 
 if __name__ == "__main__": # add pythomnic/lib to sys.path
     import os; import sys
@@ -36,6 +44,102 @@ import pmnc.timeout; from pmnc.timeout import Timeout
 
 ################################################################################
 
+# this class keeps the performance totals of one cage at one node as of the most
+# recent snapshot, along with the differences from the previous snapshot
+
+class _NodePerformance:
+
+    def __init__(self):
+        self._epoch, self._generation, self._time = None, 0, None
+        self._counters, self._histograms = {}, {}
+        self.bounds = ()
+        self.interval = None        # seconds between the last two snapshots
+        self.requests = 0           # requests accepted in the interval
+        self.response_times = [], 0 # response times in the interval, [ in each bucket ], sum
+
+    base = property(lambda self: (self._epoch, self._generation))
+
+    @staticmethod
+    def _is_request_key(key):
+        return key.startswith("interface.") and key.endswith(".request_rate")
+
+    @staticmethod
+    def _is_response_time_key(key):
+        return key.startswith("interface.") and ".response_time" in key
+
+    @typecheck
+    def update(self, snapshot: dict):
+
+        if snapshot["epoch"] != self._epoch: # first snapshot or the cage has restarted
+            self.__init__()
+            self.bounds = tuple(snapshot["buckets"])
+            prev_time = None
+        else:
+            prev_time = self._time
+
+        requests, buckets, sum_ = 0, [ 0 ] * (len(self.bounds) + 1), 0
+
+        for key, count in snapshot["counters"].items():
+            if self._is_request_key(key):
+                requests += count - self._counters.get(key, 0)
+            self._counters[key] = count
+
+        for key, (key_sum, *key_buckets) in snapshot["histograms"].items():
+            if self._is_response_time_key(key):
+                prev_sum, *prev_buckets = self._histograms.get(key, [ 0 ])
+                prev_buckets.extend([ 0 ] * (len(key_buckets) - len(prev_buckets)))
+                for i, (count, prev_count) in enumerate(zip(key_buckets, prev_buckets)):
+                    buckets[i] += count - prev_count
+                sum_ += key_sum - prev_sum
+            self._histograms[key] = [ key_sum ] + key_buckets
+
+        self._epoch, self._generation, self._time = \
+            snapshot["epoch"], snapshot["generation"], snapshot["time"]
+
+        if prev_time is not None and self._time > prev_time:
+            self.interval = self._time - prev_time
+            self.requests = requests
+            self.response_times = buckets, sum_
+        else:
+            self.interval = None
+
+###############################################################################
+
+# this method returns (requests/sec, average response time, p99 response time)
+# out of the performance of several nodes, the times are in milliseconds, p99
+# is the upper bound of the bucket in which it falls, or None if it is above
+# the highest bound, both times are None if there were no responses
+
+@typecheck
+def _merge_performance(nodes: list) -> (float, optional(float), optional(int)):
+
+    rate, buckets, sum_, bounds = 0.0, [], 0, ()
+
+    for node in nodes:
+        if node.interval is None:
+            continue
+        rate += node.requests / node.interval
+        node_buckets, node_sum = node.response_times
+        buckets.extend([ 0 ] * (len(node_buckets) - len(buckets)))
+        for i, count in enumerate(node_buckets):
+            buckets[i] += count
+        sum_ += node_sum
+        bounds = max(bounds, node.bounds, key = len)
+
+    count = sum(buckets)
+    if count == 0:
+        return rate, None, None
+
+    cumulative = 0
+    for bound, bucket_count in zip(bounds + (None, ), buckets):
+        cumulative += bucket_count
+        if cumulative >= count * 0.99:
+            break
+
+    return rate, sum_ / count, bound
+
+###############################################################################
+
 class HealthMonitor:
 
     def __init__(self, **kwargs):
@@ -47,12 +151,16 @@ class HealthMonitor:
         self._probe_thread_pool = pmnc.shared_pools.get_private_thread_pool()
         self._up_cages = {} # { cage: { node: { location: ..., probe_result: ... } } }
         self._up_down_queue = InterlockedQueue()
+        self._performance_lock = Lock()
+        self._performance = {} # { cage: { node: _NodePerformance } }
 
         self._request_timeout = pmnc.config_interfaces.get("request_timeout") # this is now static
 
         if pmnc.request.self_test == __name__: # self-test
             self._process_event = kwargs["process_event"]
+            self._connect_cage = kwargs["connect_cage"]
             self._probe_cage = kwargs["probe_cage"]
+            self._probe_performance = kwargs["probe_performance"]
 
     ###################################
 
@@ -162,24 +270,55 @@ class HealthMonitor:
         if pmnc.log.debug:
             pmnc.log.debug("sending probe")
         try:
-            probe_result = self._probe_cage(node, cage, location)
+            rpc = self._connect_cage(node, cage, location)
+            try:
+                probe_result = self._probe_cage(rpc)
+            except:
+                rpc.disconnect()
+                raise
         except:
             pmnc.log.warning("probe failed: {0:s}".format(exc_string()))
             self._up_down_queue.push((node, cage, "down"))
         else:
-            if pmnc.log.debug:
-                pmnc.log.debug("probe returned successfully")
-            if prev_probe_result == "restarted":               # if the cage has restarted
-                self._up_down_queue.push((node, cage, "down")) # we push "down" event first
-            self._up_down_queue.push((node, cage, "up", location, probe_result))
+            try:
+                if pmnc.log.debug:
+                    pmnc.log.debug("probe returned successfully")
+                if prev_probe_result == "restarted":               # if the cage has restarted
+                    self._up_down_queue.push((node, cage, "down")) # we push "down" event first
+                self._up_down_queue.push((node, cage, "up", location, probe_result))
+                if pmnc.config.get("collect_performance"):
+                    self._collect_performance(rpc, node, cage) # over the connection of the probe
+            finally:
+                rpc.disconnect()
+
+    ###################################
+
+    # this method is invoked by one of the private pool threads after
+    # a successful probe to fetch and register the cage performance,
+    # failure to do so does not affect the cage being up
+
+    def _collect_performance(self, rpc, node, cage):
+
+        with self._performance_lock:
+            node_performance = self._performance.get(cage, {}).get(node) or _NodePerformance()
+            epoch, generation = node_performance.base
+
+        try:
+            snapshot = self._probe_performance(rpc, epoch, generation)
+        except:
+            pmnc.log.warning("performance probe failed: {0:s}".format(exc_string()))
+        else:
+            with self._performance_lock:
+                node_performance.update(snapshot)
+                self._performance.setdefault(cage, {})[node] = node_performance
 
     ###################################
 
     # this method is invoked by one of the private pool threads
-    # to send the actual probe call to the cage being probed
+    # to connect to the cage being probed, the connection is used
+    # both for the probe and for the following performance snapshot
 
-    @typecheck
-    def _probe_cage(self, node, cage, location) -> dict:
+    def _connect_cage(self, node, cage, location):
 
         # health monitor has to create rpc resources manually, not using
         # pmnc(cage) syntax, because we need to access exact cage at exact
@@ -196,20 +335,45 @@ class HealthMonitor:
                                          pool__resource_name = cage)
 
         rpc.connect()
+
+        return rpc
+
+    # this method is invoked by one of the private pool threads
+    # to send the actual probe call to the cage being probed
+
+    @typecheck
+    def _probe_cage(self, rpc) -> dict:
+
+        # if the cage returns anything but a dict, it is considered a failure
+
+        return self._call_cage(rpc, "health_monitor_event", "probe")
+
+    # this method is invoked by one of the private pool threads
+    # to fetch the performance snapshot from the cage being probed
+
+    @typecheck
+    def _probe_performance(self, rpc, epoch: optional(int), generation: int) -> dict:
+
+        return self._call_cage(rpc, "performance", "extract_snapshot", epoch, generation)
+
+    ###################################
+
+    # each call is made in a separate transaction over the same connection
+
+    @staticmethod
+    def _call_cage(rpc, module_name, method_name, *args):
+
+        rpc.begin_transaction("", source_module_name = __name__, transaction_options = {},
+                              resource_args = (), resource_kwargs = {})
         try:
-            rpc.begin_transaction("", source_module_name = __name__, transaction_options = {},
-                                  resource_args = (), resource_kwargs = {})
-            try:
-                probe_result = rpc.health_monitor_event.probe() # there, an RPC call
-            except:
-                rpc.rollback()
-                raise
-            else:
-                rpc.commit()
-        finally:
-            rpc.disconnect()
+            result = getattr(getattr(rpc, module_name), method_name)(*args) # there, an RPC call
+        except:
+            rpc.rollback()
+            raise
+        else:
+            rpc.commit()
 
-        return probe_result # if the cage returns anything but a dict, it is considered a failure
+        return result
 
     ###################################
 
@@ -251,6 +415,9 @@ class HealthMonitor:
                             if self._up_cages.setdefault(cage, {}).pop(node, None):
                                 self._schedule_up_down_event(node, cage, "down")
 
+                            with self._performance_lock:
+                                self._performance.get(cage, {}).pop(node, None)
+
                     except:
                         pmnc.log.error(exc_string()) # log and ignore
 
@@ -319,6 +486,20 @@ class HealthMonitor:
         elif up_down == "down":
             pmnc.health_monitor_event.cage_down(node, cage)
 
+    ###################################
+
+    # this method returns the performance of all the cages over the last
+    # probe period, { cage: (merged performance, { node: node performance }) },
+    # each performance being (requests/sec, average ms, p99 ms)
+
+    def extract_performance(self) -> dict:
+
+        with self._performance_lock:
+            return { cage: (_merge_performance(list(nodes.values())),
+                            { node: _merge_performance([ node_performance ])
+                              for node, node_performance in nodes.items() })
+                     for cage, nodes in self._performance.items() if nodes }
+
 ###############################################################################
 
 def self_test():
@@ -424,20 +605,38 @@ def self_test():
 
     ###################################
 
-    def start_health_monitor(cages_list, responses_list):
+    def start_health_monitor(cages_list, responses_list, snapshots = None):
 
         rpc_interface = FakeRpcInterface(cages_list)
         pmnc.interfaces.set_fake_interface("rpc", rpc_interface)
 
-        def _probe_cage(node, cage, location):
-            result = responses_list[rpc_interface._pass-1].get(location)
+        class FakeRpc:
+            def __init__(self, location):
+                self.location, self.connected = location, True
+            def disconnect(self):
+                self.connected = False
+
+        def _connect_cage(node, cage, location):
+            return FakeRpc(location)
+
+        def _probe_cage(rpc):
+            assert rpc.connected
+            result = responses_list[rpc_interface._pass-1].get(rpc.location)
             if result is not None:
                 return result
             else:
                 raise Exception("down")
 
+        def _probe_performance(rpc, epoch, generation):
+            assert rpc.connected # the probe connection is still open
+            if snapshots is None:
+                return dict(epoch = 1, generation = 1, time = 0.0, buckets = [], counters = {}, histograms = {})
+            return snapshots(rpc.location, rpc_interface._pass, epoch, generation)
+
         hm = pmnc.health_monitor.HealthMonitor(process_event = rpc_interface.process_event,
-                                               probe_cage = _probe_cage)
+                                               connect_cage = _connect_cage,
+                                               probe_cage = _probe_cage,
+                                               probe_performance = _probe_performance)
         hm.wait = rpc_interface._stopped.wait
         hm.start()
 
@@ -452,14 +651,16 @@ def self_test():
 
     ###################################
 
-    def simulate_scenario(cages_list, responses_list):
+    def simulate_scenario(cages_list, responses_list, snapshots = None):
 
-        hm = start_health_monitor(cages_list, responses_list)
+        hm = start_health_monitor(cages_list, responses_list, snapshots)
         try:
             hm.wait()
         finally:
             stop_health_monitor(hm)
 
+        simulate_scenario.performance = hm.extract_performance()
+
         return hm._rpc_interface.extract_events()
 
     ###################################
@@ -663,6 +864,109 @@ def self_test():
 
     ###################################
 
+    def test_node_performance():
+
+        bounds = [ 1, 2, 5, 10 ]
+
+        np = _NodePerformance()
+        assert np.base == (None, 0) and np.interval is None
+
+        np.update(dict(epoch = 1, generation = 10, time = 100.0, buckets = bounds,
+                       counters = { "interface.foo.request_rate": 100, "resource.bar.transaction_rate": 50 },
+                       histograms = { "interface.foo.response_time.success": [ 100, 0, 0, 20 ] }))
+        assert np.base == (1, 10) and np.interval is None
+        assert _merge_performance([ np ]) == (0.0, None, None)
+
+        # the differences from the previous snapshot are registered
+
+        np.update(dict(epoch = 1, generation = 20, time = 110.0,
+                       counters = { "interface.foo.request_rate": 150 },
+                       histograms = { "interface.foo.response_time.success": [ 150, 0, 0, 30 ],
+                                      "interface.foo.response_time.failure": [ 260, 0, 0, 0, 20 ] }))
+        assert np.base == (1, 20) and np.interval == 10.0 and np.requests == 50
+        assert np.response_times == ([ 0, 0, 10, 20, 0 ], 310)
+        assert _merge_performance([ np ]) == (5.0, 310 / 30, 10)
+
+        # the keys missing from the snapshot have not changed
+
+        np.update(dict(epoch = 1, generation = 30, time = 120.0, counters = {}, histograms = {}))
+        assert np.requests == 0 and np.response_times == ([ 0, 0, 0, 0, 0 ], 0)
+        assert _merge_performance([ np ]) == (0.0, None, None)
+
+        np.update(dict(epoch = 1, generation = 40, time = 130.0, counters = {},
+                       histograms = { "interface.foo.response_time.failure": [ 1260, 0, 0, 0, 20, 1 ] }))
+        assert _merge_performance([ np ]) == (0.0, 1000.0, None) # above the highest bound
+
+        # a restarted cage starts over
+
+        np.update(dict(epoch = 2, generation = 5, time = 135.0, buckets = bounds,
+                       counters = { "interface.foo.request_rate": 10 }, histograms = {}))
+        assert np.base == (2, 5) and np.interval is None
+
+        # the nodes are merged
+
+        np1 = _NodePerformance()
+        np1.update(dict(epoch = 1, generation = 1, time = 0.0, buckets = bounds, counters = {}, histograms = {}))
+        np1.update(dict(epoch = 1, generation = 2, time = 10.0,
+                        counters = { "interface.foo.request_rate": 100 },
+                        histograms = { "interface.foo.response_time.success": [ 100, 100 ] }))
+
+        np2 = _NodePerformance()
+        np2.update(dict(epoch = 7, generation = 1, time = 0.0, buckets = bounds, counters = {}, histograms = {}))
+        np2.update(dict(epoch = 7, generation = 2, time = 20.0,
+                        counters = { "interface.foo.request_rate": 100, "interface.bar.request_rate": 100 },
+                        histograms = { "interface.foo.response_time.success": [ 900, 0, 0, 100 ] }))
+
+        assert _merge_performance([ np1 ]) == (10.0, 1.0, 1)
+        assert _merge_performance([ np2 ]) == (10.0, 9.0, 5)
+        assert _merge_performance([ np1, np2 ]) == (20.0, 5.0, 5)
+        assert _merge_performance([ np1, np2, _NodePerformance() ]) == (20.0, 5.0, 5)
+
+    test_node_performance()
+
+    ###################################
+
+    def test_performance():
+
+        cages_1 = dict(cage1 = dict(nodeA = "ssl_1A", nodeB = "ssl_1B"))
+        cages_2 = dict(cage1 = dict(nodeA = "ssl_1A", nodeB = "ssl_1B"))
+        cages_3 = dict(cage1 = dict(nodeA = "ssl_1A", nodeB = "ssl_1B"))
+        cages_list = [cages_1, cages_2, cages_3]
+
+        responses_1 = dict(ssl_1A = {}, ssl_1B = {})
+        responses_list = [responses_1] * 4
+
+        # node B is twice as slow and receives half as many requests
+
+        def snapshots(location, pass_, epoch, generation):
+            slow = location == "ssl_1B" and 2 or 1
+            return dict(epoch = 1, generation = pass_, time = pass_ * 10.0, buckets = [ 1, 2, 5, 10 ],
+                        counters = { "interface.rpc.request_rate": pass_ * 100 // slow },
+                        histograms = { "interface.rpc.response_time.success": [ pass_ * 100 * slow ] +
+                                       [ 0 ] * (slow - 1) + [ pass_ * 100 // slow ] })
+
+        assert simulate_scenario(cages_list, responses_list, snapshots) == \
+               { "nodeA.cage1": [{}], "nodeB.cage1": [{}] }
+
+        cage_performance, node_performance = simulate_scenario.performance["cage1"]
+        assert cage_performance == (15.0, 2.0, 2)
+        assert node_performance == { "nodeA": (10.0, 1.0, 1), "nodeB": (5.0, 4.0, 2) }
+
+        # the cages that failed to provide performance are not reported
+
+        def no_snapshots(location, pass_, epoch, generation):
+            if location == "ssl_1B":
+                raise Exception("no performance")
+            return snapshots(location, pass_, epoch, generation)
+
+        assert simulate_scenario(cages_list, responses_list, no_snapshots) == \
+               { "nodeA.cage1": [{}], "nodeB.cage1": [{}] }
+        assert simulate_scenario.performance == { "cage1": ((10.0, 1.0, 1), { "nodeA": (10.0, 1.0, 1) }) }
+
+    test_performance()
+
+    ###################################
+
 if __name__ == "__main__": import pmnc.self_test; pmnc.self_test.run()
 
 ###############################################################################
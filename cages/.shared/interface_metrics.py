@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#-*- coding: iso-8859-1 -*-
+###############################################################################
+#
+# This module implements the metrics exporting HTTP interface. If the "metrics"
+# interface has been started in config_interfaces.py, this module is called
+# to process HTTP requests incoming through it. Returned to each request is
+# a plain text in OpenMetrics format, suitable for scraping by Prometheus.
+#
+# Unlike interface_performance.py, which displays the normalized averages,
+# this module exports the raw totals since the cage start, as collected by
+# performance.py (see extract_totals() method):
+#
+# interface.foo.request_rate           -> counter pmnc_interface_request_total{interface="foo"}
+# resource.bar.transaction_rate.success -> counter pmnc_resource_transaction_total{resource="bar",outcome="success"}
+# resource.bar.processing_time         -> histogram pmnc_resource_processing_seconds{resource="bar"}
+#
+# along with the gauges for the utilization of the interfaces thread pool,
+# the resource thread and instance pools, the states of the circuit breakers,
+# memory and CPU usage.
+#
+# The rendered text is cached for cache_seconds, therefore frequent scrapes
+# are cheap.
+#
+# Pythomnic3k project
+# (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
+# Distributed under BSD license
+#
+################################################################################
+
+__all__ = [ "process_request" ]
+
+################################################################################
+
+import time; from time import time
+import threading; from threading import Lock
+import urllib.parse; from urllib.parse import urlparse
+
+if __name__ == "__main__": # add pythomnic/lib to sys.path
+    import os; import sys
+    main_module_dir = os.path.dirname(sys.modules["__main__"].__file__) or os.getcwd()
+    sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..", "..", "lib")))
+
+import typecheck; from typecheck import typecheck, optional
+
+###############################################################################
+
+content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+breaker_states = ("closed", "open", "half-open")
+
+_cache_lock = Lock()
+_cache = (None, None) # time slice, rendered content
+
+###############################################################################
+# this class collects the samples grouped by metric family, because
+# OpenMetrics requires all the samples of a family to appear together
+
+class _MetricFamilies:
+
+    def __init__(self):
+        self._families = {}
+
+    def add(self, family: str, metric_type: str, unit: optional(str), sample: str, labels: dict, value):
+        lines = self._families.setdefault(family, (metric_type, unit, []))[2]
+        label_set = ",".join("{0:s}=\"{1:s}\"".format(k, v) for k, v in labels.items())
+        lines.append("{0:s}{1:s}{2:s} {3}".format(family, sample, label_set and "{" + label_set + "}" or "", value))
+
+    def render(self) -> str:
+        lines = []
+        for family in sorted(self._families.keys()):
+            metric_type, unit, samples = self._families[family]
+            lines.append("# TYPE {0:s} {1:s}".format(family, metric_type))
+            if unit:
+                lines.append("# UNIT {0:s} {1:s}".format(family, unit))
+            lines.extend(samples)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+###############################################################################
+# this method splits a performance key, such as "resource.bar.processing_time.success"
+# into metric family "pmnc_resource_processing" and labels { "resource": "bar", "outcome": "success" }
+
+@typecheck
+def _split_key(key: str, suffix: str) -> (str, dict):
+
+    object_type, object_name, reading = key.split(".", 2)
+    reading, _, outcome = reading.partition(".")
+
+    labels = { object_type: object_name }
+    if outcome:
+        labels["outcome"] = outcome
+
+    return "pmnc_{0:s}_{1:s}".format(object_type, reading[:-len(suffix)]), labels
+
+###############################################################################
+
+def _render_metrics() -> str:
+
+    counters, histograms, stats = pmnc.performance.extract_totals()
+
+    families = _MetricFamilies()
+
+    # the events are exported as counters
+
+    for key, count in counters.items():
+        family, labels = _split_key(key, "_rate")
+        families.add(family, "counter", None, "_total", labels, count)
+
+    # the time readings are exported as histograms in seconds
+
+    for key, (buckets, sum_) in histograms.items():
+        family, labels = _split_key(key, "_time")
+        family = "{0:s}_seconds".format(family)
+        for bound, count in buckets:
+            bucket_labels = dict(labels, le = bound is not None and str(bound / 1000.0) or "+Inf")
+            families.add(family, "histogram", "seconds", "_bucket", bucket_labels, count)
+        families.add(family, "histogram", "seconds", "_count", labels, buckets[-1][1])
+        families.add(family, "histogram", "seconds", "_sum", labels, sum_ / 1000.0)
+
+    # the utilization of the interfaces thread pool
+
+    busy, free, queued = pmnc.interfaces.get_thread_stats()
+    families.add("pmnc_interface_threads", "gauge", None, "", { "state": "busy" }, busy)
+    families.add("pmnc_interface_threads", "gauge", None, "", { "state": "free" }, free)
+    families.add("pmnc_interface_queued_requests", "gauge", None, "", {}, queued)
+
+    # the utilization of the resource pools
+
+    for resource_name, (threads_busy, threads_free, queued, instances_busy, instances_free) in \
+        pmnc.shared_pools.get_pool_stats().items():
+        families.add("pmnc_resource_threads", "gauge", None, "",
+                     { "resource": resource_name, "state": "busy" }, threads_busy)
+        families.add("pmnc_resource_threads", "gauge", None, "",
+                     { "resource": resource_name, "state": "free" }, threads_free)
+        families.add("pmnc_resource_queued_requests", "gauge", None, "",
+                     { "resource": resource_name }, queued)
+        families.add("pmnc_resource_instances", "gauge", None, "",
+                     { "resource": resource_name, "state": "busy" }, instances_busy)
+        families.add("pmnc_resource_instances", "gauge", None, "",
+                     { "resource": resource_name, "state": "free" }, instances_free)
+
+    # the states of the circuit breakers
+
+    for resource_name, (state, consecutive_failures, failure_rate) in \
+        pmnc.shared_pools.get_breaker_stats().items():
+        for breaker_state in breaker_states:
+            families.add("pmnc_resource_circuit_breaker", "stateset", None, "",
+                         { "resource": resource_name, "pmnc_resource_circuit_breaker": breaker_state },
+                         state == breaker_state and 1 or 0)
+        families.add("pmnc_resource_circuit_breaker_failures", "gauge", None, "",
+                     { "resource": resource_name }, consecutive_failures)
+
+    # the global statistics
+
+    if "wss" in stats:
+        families.add("pmnc_memory_working_set_bytes", "gauge", "bytes", "", {}, stats["wss"] * 1048576)
+    if "cpu_ut" in stats:
+        families.add("pmnc_cpu_user_seconds", "counter", "seconds", "_total", {}, stats["cpu_ut"])
+    if "cpu_kt" in stats:
+        families.add("pmnc_cpu_system_seconds", "counter", "seconds", "_total", {}, stats["cpu_kt"])
+
+    return families.render()
+
+###############################################################################
+# this method returns the rendered metrics, rendering them at most once per time slice
+
+def _get_metrics() -> bytes:
+
+    global _cache
+
+    time_slice = int(time()) // pmnc.config.get("cache_seconds")
+
+    with _cache_lock:
+        cached_slice, content = _cache
+        if cached_slice != time_slice:
+            content = _render_metrics().encode("utf-8")
+            _cache = (time_slice, content)
+
+    return content
+
+###############################################################################
+# this method is called from the HTTP interface for actual request processing
+
+def process_request(request: dict, response: dict):
+
+    path = urlparse(request["url"]).path
+
+    if path not in ("/", "/metrics"):
+        response["status_code"] = 404
+        return
+
+    response["content"] = _get_metrics()
+    response["headers"]["content-type"] = content_type
+
+###############################################################################
+
+def self_test():
+
+    from time import sleep
+    from pmnc.request import fake_request
+
+    ###################################
+
+    def test_split_key():
+
+        assert _split_key("interface.foo.request_rate", "_rate") == \
+               ("pmnc_interface_request", { "interface": "foo" })
+        assert _split_key("resource.bar.processing_time.failure", "_time") == \
+               ("pmnc_resource_processing", { "resource": "bar", "outcome": "failure" })
+
+    test_split_key()
+
+    ###################################
+
+    def test_metrics():
+
+        fake_request(30.0)
+
+        pmnc.shared_pools.get_thread_pool("callable_6")
+        circuit_breaker = pmnc.shared_pools.get_circuit_breaker("callable_6")
+        circuit_breaker.register(False)
+
+        for i in range(10):
+            pmnc.performance.event("interface.foo.request_rate")
+            pmnc.performance.event("resource.bar.transaction_rate.success")
+            pmnc.performance.sample("resource.bar.processing_time.success", 150)
+
+        sleep(max(pmnc.config.get("cache_seconds"), 2.5)) # let the performance thread collect the readings
+
+        request = dict(url = "/metrics", method = "GET", headers = {}, body = b"")
+        response = dict(status_code = 200, headers = {}, body = b"")
+
+        time_slice = int(time()) // pmnc.config.get("cache_seconds")
+        pmnc.__getattr__(__name__).process_request(request, response)
+        assert response["status_code"] == 200
+        assert response["headers"]["content-type"] == content_type
+
+        content = response["content"]
+        lines = content.decode("utf-8").split("\n")
+        assert lines[-2:] == [ "# EOF", "" ]
+
+        assert "# TYPE pmnc_interface_request counter" in lines
+        assert "pmnc_interface_request_total{interface=\"foo\"} 10" in lines
+        assert "# TYPE pmnc_resource_transaction counter" in lines
+        assert "pmnc_resource_transaction_total{resource=\"bar\",outcome=\"success\"} 10" in lines
+
+        assert "# TYPE pmnc_resource_processing_seconds histogram" in lines
+        assert "# UNIT pmnc_resource_processing_seconds seconds" in lines
+        assert "pmnc_resource_processing_seconds_bucket{resource=\"bar\",outcome=\"success\",le=\"0.1\"} 0" in lines
+        assert "pmnc_resource_processing_seconds_bucket{resource=\"bar\",outcome=\"success\",le=\"0.2\"} 10" in lines
+        assert "pmnc_resource_processing_seconds_bucket{resource=\"bar\",outcome=\"success\",le=\"+Inf\"} 10" in lines
+        assert "pmnc_resource_processing_seconds_count{resource=\"bar\",outcome=\"success\"} 10" in lines
+        assert "pmnc_resource_processing_seconds_sum{resource=\"bar\",outcome=\"success\"} 1.5" in lines
+
+        assert "pmnc_interface_threads{state=\"busy\"} 0" in lines
+        assert "pmnc_resource_threads{resource=\"callable_6\",state=\"busy\"} 0" in lines
+        assert "pmnc_resource_queued_requests{resource=\"callable_6\"} 0" in lines
+        assert "pmnc_resource_circuit_breaker{resource=\"callable_6\",pmnc_resource_circuit_breaker=\"closed\"} 1" in lines
+        assert "pmnc_resource_circuit_breaker{resource=\"callable_6\",pmnc_resource_circuit_breaker=\"open\"} 0" in lines
+        assert "pmnc_resource_circuit_breaker_failures{resource=\"callable_6\"} 1" in lines
+
+        # the families do not interleave
+
+        families = [ line.split(" ")[2] for line in lines if line.startswith("# TYPE ") ]
+        assert len(families) == len(set(families))
+
+        # the rendered content is cached within a time slice
+
+        response2 = dict(status_code = 200, headers = {}, body = b"")
+        pmnc.__getattr__(__name__).process_request(request, response2)
+        assert response2["content"] is content or \
+               int(time()) // pmnc.config.get("cache_seconds") != time_slice
+
+        request = dict(url = "/foo", method = "GET", headers = {}, body = b"")
+        response = dict(status_code = 200, headers = {}, body = b"")
+
+        pmnc.__getattr__(__name__).process_request(request, response)
+        assert response["status_code"] == 404
+
+    test_metrics()
+
+if __name__ == "__main__": import pmnc.self_test; pmnc.self_test.run()
+
+###############################################################################
+# EOF
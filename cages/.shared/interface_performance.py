@@ -15,6 +15,27 @@
 # one last minute) and scaling (0-39) of the collected data are also fixed
 # to match that of the performance.py's (see extract() method).
 #
+# The time readings can also be displayed in "percentiles" mode, in which
+# the bars are drawn between p50 and p99 of each time slice instead of the
+# average plus/minus deviation, followed by the percentiles for the last hour.
+#
+# The page can also display the long-horizon history from the performance
+# archive, with each bar standing for 10 minutes or an hour instead of a minute,
+# this is selected with resolution=10m or resolution=1h in the URL query.
+#
+# The cage can be profiled on demand, GET /profile?seconds=N starts the sampling
+# profiler for N seconds, after which GET /profile returns the collected stacks
+# as plain text in collapsed form, ready to be fed to the flame graph tools.
+#
+# On the health_monitor cage with collect_performance enabled, GET /cluster
+# displays the request rate and the response times of every cage over the last
+# probe period, merged across the nodes and for each node separately, the nodes
+# which receive notably more requests or respond notably slower than the others
+# are highlighted (see health_monitor.py).
+#
+# The states of the circuit breakers of the resources for which they are
+# configured (see shared_pools.py) are displayed below the page header.
+#
 # Pythomnic3k project
 # (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
 # Distributed under BSD license
@@ -130,7 +151,21 @@ legends = { "request_rate": "request rate",
             "processing_time.failure": "failed processing time",
             "response_time": "response time",
             "response_time.success": "successful response time",
-            "response_time.failure": "failed response time" }
+            "response_time.failure": "failed response time",
+            "thread_time": "thread wait time",
+            "allocate_time": "allocation time",
+            "cache_time": "cache lookup time",
+            "begin_time": "transaction begin time",
+            "execute_time": "execution time",
+            "decision_time": "decision wait time",
+            "commit_time": "commit time",
+            "rollback_time": "rollback time" }
+
+breaker_classes = { "closed": 4, "half-open": 1, "open": 0 }
+
+outlier_ratio = 1.5 # a node this much busier or slower than the cage average is highlighted
+
+resolutions = { "1m": (60, "%H:%M"), "10m": (600, "%H:%M"), "1h": (3600, "%a%H") }
 
 default_reading_modes = { "interface": ("response_time", "collapsed"),
                           "resource": ("processing_time" , "collapsed") }
@@ -159,7 +194,7 @@ a {{ color: darkblue; text-decoration: none }}
 # this method takes a dict containing parsed URL query and one of the optional
 # mangling arguments, assembles and returns string with modified URL query
 
-def _format_modified_query(query: dict, *, expand = None, collapse = None, replace = None):
+def _format_modified_query(query: dict, *, expand = None, collapse = None, replace = None, switch = None):
 
     d = query.copy()
 
@@ -167,6 +202,9 @@ def _format_modified_query(query: dict, *, expand = None, collapse = None, repla
         d[expand] = "expanded"
     if collapse:
         d[collapse] = "collapsed"
+    if switch:
+        k, mode = switch
+        d[k] = mode
     if replace:
         k, reading = replace
         del d[k]
@@ -181,12 +219,17 @@ def _format_modified_query(query: dict, *, expand = None, collapse = None, repla
 def _performance_report(html: with_attr("write"), query: dict_of(str, str),
                         request: dict, response: dict) -> nothing:
 
-    # fetch the performance dump, this can return None
+    # fetch the performance dump for the requested resolution, this can return None
+
+    resolution = query.pop("resolution", "1m")
+    resolution_seconds, hhmm_format = resolutions[resolution]
 
-    stats = pmnc.performance.extract()
+    stats = pmnc.performance.extract(resolution_seconds)
     if stats is None:
-        html.write("<html><body>cage {0:s} has nothing to report yet"
-                   "</body></html>".format(__cage__))
+        html.write("<html><body>cage {0:s} has nothing to report yet{1:s}"
+                   "</body></html>".format(__cage__, resolution != "1m" and
+                                           " at {0:s} resolution, <a href=\"/performance\">back</a>".\
+                                           format(resolution) or ""))
         return
 
     # extract main thread pool stats
@@ -198,7 +241,11 @@ def _performance_report(html: with_attr("write"), query: dict_of(str, str),
     xa = pmnc.transaction.create(); xa.execute()
     txn_rate = xa.get_transaction_rate()
 
-    base_time, stats_dump, app_perf = stats
+    # extract circuit breaker states
+
+    breaker_stats = pmnc.shared_pools.get_breaker_stats()
+
+    base_time, stats_dump, app_perf, percentiles = stats
     base_dt = datetime.fromtimestamp(base_time)
 
     # see data for what objects is available, will have to display at least one graph for each
@@ -215,21 +262,26 @@ def _performance_report(html: with_attr("write"), query: dict_of(str, str),
 
     for k, v in query.items():
         if k in stats_dump:
+            if v == "percentiles" and k not in percentiles:
+                v = "expanded"
             displayed_objects[k] = v
 
+    if resolution != "1m": # the resolution is carried along with the displayed objects
+        displayed_objects["resolution"] = resolution
+
     # reassemble the canonical URL query
 
     canonical_query = _format_modified_query(displayed_objects)
 
     # format horizontal time scales
 
-    base_minute = base_dt.minute % 10
+    base_minute = base_time // resolution_seconds % 10
     hrule = "---- "  + _hrule[base_minute:][:59] + "   -----"
     plus_count = hrule.count("+")
 
-    base_dt10m = datetime.fromtimestamp(base_time // 600  * 600)
-    base_dt10m -= timedelta(minutes = (plus_count - (base_minute != 0 and 1 or 0)) * 10)
-    hhmms = [ (base_dt10m + timedelta(minutes = i * 10)).strftime("%H:%M")
+    base_dt10m = datetime.fromtimestamp(base_time // (resolution_seconds * 10) * (resolution_seconds * 10))
+    base_dt10m -= timedelta(seconds = (plus_count - (base_minute != 0 and 1 or 0)) * resolution_seconds * 10)
+    hhmms = [ (base_dt10m + timedelta(seconds = i * resolution_seconds * 10)).strftime(hhmm_format)
               for i in range(plus_count) ]
 
     hscale = " " * (hrule.index("+") - 2) + "     ".join(hhmms)
@@ -264,6 +316,30 @@ def _performance_report(html: with_attr("write"), query: dict_of(str, str),
                "<a href=\"/notifications\">logs</a>" + _decorate("  {0:s}<br/>".format(cage_at_node.center(58))) +
                _decorate("      {0:s}  {1:s}<br/><br/>\n".format(activity_info.center(58), base_dt.strftime("%b %d"))))
 
+    # write circuit breaker states, if any
+
+    for resource_name, (state, failures, failure_rate) in sorted(breaker_stats.items()):
+        breaker_info = "resource {0:s} circuit breaker {1:s}, {2:d} consecutive failure(s), {3:d}% failed".\
+                       format(resource_name, state, failures, int(failure_rate * 100))
+        html.write(_decorate("      ") + "<span class=\"c{0:d}\">{1:s}</span><br/>\n".\
+                   format(breaker_classes[state], _quote(breaker_info)))
+
+    if breaker_stats:
+        html.write("<br/>\n")
+
+    # write resolution selector links
+
+    resolution_links = []
+    for r in sorted(resolutions.keys(), key = lambda r: resolutions[r][0]):
+        resolution_query = dict(displayed_objects, resolution = r)
+        if r == "1m":
+            del resolution_query["resolution"]
+        resolution_links.append("{0:s}<a href=\"/performance?{1:s}\">{2:s}</a>{3:s}".\
+                                format(r == resolution and _decorate("&raquo; ") or _decorate("  "),
+                                       _format_modified_query(resolution_query), r,
+                                       r == resolution and _decorate(" &laquo;") or _decorate("  ")))
+    html.write(_decorate("      ") + "<nobr>resolution " + "".join(resolution_links) + "</nobr><br/>\n")
+
     html.write("<span style=\"line-height: 1.0;\">\n" + hscale + "<br/>\n" + hrule + "<br/>\n")
 
     # loop through the statistics items to display
@@ -296,7 +372,13 @@ def _performance_report(html: with_attr("write"), query: dict_of(str, str),
             html.write("<a href=\"/performance?{0:s}\">{1:s} {2:s} ({3:s})</a></nobr><br/>".\
                        format(expand_query, object_type, object_name, legends[reading]))
 
-        elif mode == "expanded": # draw expanded graph
+        else: # draw expanded graph, either of averages or of percentiles
+
+            if mode == "percentiles":
+                s1m, s10s, hour_percentiles = percentiles[k]
+                s10s = s10s[:5]
+                if hour_percentiles is not None:
+                    p50, p90, p99, p999, pmax = hour_percentiles
 
             bars1m = list(zip(*map(_expanded_bar, s1m)))
             bars10s = list(zip(*map(_expanded_bar, s10s)))
@@ -330,10 +412,15 @@ def _performance_report(html: with_attr("write"), query: dict_of(str, str),
                 _line += "</span> ~ <span_class=\"c{0:d}\">".format(i) + append_bars(bars10s, i) + "  "
                 line += _decorate(_line) + "</span>"
 
-                if i == 0: # append the clickable collapse link
+                if i == 0: # append the clickable collapse link and percentiles/averages switch
                     collapse_query = _format_modified_query(displayed_objects, collapse = k)
                     line += "<a href=\"/performance?{0:s}\">{1:s} {2:s}</a>".\
                             format(collapse_query, object_type, object_name)
+                    if k in percentiles:
+                        switch_mode = mode == "expanded" and "percentiles" or "expanded"
+                        switch_query = _format_modified_query(displayed_objects, switch = (k, switch_mode))
+                        line += _decorate("  ") + "<a href=\"/performance?{0:s}\">{1:s}</a>".\
+                                format(switch_query, mode == "expanded" and "percentiles" or "averages")
                 elif i <= len(opt_readings): # append the clickable selector links
                     opt_reading = opt_readings[i - 1]
                     modify_query = _format_modified_query(displayed_objects, replace = (k, opt_reading))
@@ -344,6 +431,10 @@ def _performance_report(html: with_attr("write"), query: dict_of(str, str),
 
                 html.write(line + "</nobr><br/>\n")
 
+            if mode == "percentiles" and percentiles[k][2] is not None:
+                html.write(_decorate("     ") + "<nobr>last hour p50 {0:d} ms, p90 {1:d} ms, p99 {2:d} ms, "
+                           "p99.9 {3:d} ms, max {4:d} ms</nobr><br/>\n".format(p50, p90, p99, p999, pmax))
+
         html.write(hrule + "<br/>\n")
 
     # complete the response
@@ -423,10 +514,104 @@ def _notifications_report(html: with_attr("write"), query: dict_of(str, str),
 
 ###############################################################################
 
-valid_perf_query_element = "(interface|resource)\\.[A-Za-z0-9_-]+\\.({0:s})=(collapsed|expanded)".\
+@typecheck
+def _cluster_report(html: with_attr("write"), query: dict_of(str, str),
+                    request: dict, response: dict) -> nothing:
+
+    # write page header
+
+    html.write("<html>"
+               "<head>" +
+               css_style.format(css_font_family = pmnc.config.get("css_font_family")) +
+               "<title>Cluster performance report</title>"
+               "</head>"
+               "<body class=\"default\">"
+               "<a href=\"/performance\">perf</a>" + _decorate("  {0:s}<br/>".format("cluster performance".center(58))) +
+               _decorate("performance of all cages over the last probe period".center(69)) + "<br/><br/>")
+
+    cluster_performance = pmnc.interfaces.get_cluster_performance()
+    if cluster_performance is None:
+        html.write("cage {0:s} is not running the health monitor</body></html>".format(__cage__))
+        return
+
+    _write_cluster_performance(html, cluster_performance)
+
+    # complete the response
+
+    html.write(_decorate("------------------------------------------------------------------------<br/>\n"))
+    html.write("</body></html>")
+
+    # require a refresh within a configured time
+
+    refresh_seconds = pmnc.config.get("refresh_seconds")
+    response["headers"]["refresh"] = "{0:d};URL=/cluster".format(refresh_seconds)
+
+###############################################################################
+# this method writes a line for each cage and each of its nodes, the cluster
+# performance is as returned by HealthMonitor.extract_performance()
+
+@typecheck
+def _write_cluster_performance(html: with_attr("write"), cluster_performance: dict) -> nothing:
+
+    html.write(_decorate(" cage/node                             req/s      avg ms      p99 ms<br/>\n"))
+    html.write(_decorate("------------------------------------------------------------------------<br/>\n"))
+
+    def format_line(indent, name, note, note_class, performance):
+        rate, avg_ms, p99_ms = performance
+        name = name[:30 - indent]
+        numbers = "{0:8.01f}{1:>12s}{2:>12s}".format(rate,
+                  avg_ms is not None and "{0:.01f}".format(avg_ms) or "",
+                  avg_ms is not None and (p99_ms is not None and "{0:d}".format(p99_ms) or "inf") or "")
+        return _decorate(" " * indent) + _quote(name) + _decorate(" " * (31 - indent - len(name))) + \
+               "<span class=\"c{0:d}\">{1:s}</span>".format(note_class, note) + \
+               _decorate(" " * (8 - len(note)) + numbers) + "<br/>\n"
+
+    for cage, (cage_performance, nodes) in sorted(cluster_performance.items()):
+
+        cage_rate, cage_avg_ms, cage_p99_ms = cage_performance
+        html.write(format_line(1, cage, "", 4, cage_performance))
+
+        for node, node_performance in sorted(nodes.items()):
+            rate, avg_ms, p99_ms = node_performance
+            if avg_ms is not None and cage_avg_ms and avg_ms > cage_avg_ms * outlier_ratio:
+                note, note_class = "lagging", 0
+            elif len(nodes) > 1 and rate > cage_rate / len(nodes) * outlier_ratio:
+                note, note_class = "hot", 1
+            else:
+                note, note_class = "", 4
+            html.write(format_line(3, node, note, note_class, node_performance))
+
+###############################################################################
+
+@typecheck
+def _profile_report(query: dict_of(str, str), request: dict, response: dict) -> str:
+
+    seconds = query.get("seconds")
+    if seconds is not None:
+        seconds = min(int(seconds), pmnc.config.get("profiler_max_seconds"))
+        if pmnc.performance.start_profiler(float(seconds)):
+            return "profiling cage {0:s} for {1:d} second(s)\n".format(__cage__, seconds)
+
+    profile = pmnc.performance.extract_profile()
+    if profile is None:
+        return "cage {0:s} has not been profiled, use /profile?seconds=N\n".format(__cage__)
+
+    running, remain, samples, stacks = profile
+    if running:
+        return "profiling cage {0:s}, {1:d} second(s) remain, {2:d} sample(s) taken\n".\
+               format(__cage__, int(remain + 0.5), samples)
+
+    return stacks
+
+###############################################################################
+
+valid_perf_query_element = "(interface|resource)\\.[A-Za-z0-9_-]+\\.({0:s})=(collapsed|expanded|percentiles)".\
                            format("|".join(legends.keys()))
+valid_perf_query_element = "({0:s}|resolution=({1:s}))".format(valid_perf_query_element, "|".join(resolutions.keys()))
 valid_perf_query = by_regex("^({0:s}(&{0:s})*)?$".format(valid_perf_query_element))
 valid_ntfy_query = by_regex("^$")
+valid_prof_query = by_regex("^(seconds=[1-9][0-9]{0,3})?$")
+valid_clus_query = by_regex("^$")
 
 ###############################################################################
 # this method is called from the HTTP interface for actual request processing
@@ -454,6 +639,23 @@ def process_request(request: dict, response: dict):
 
         _notifications_report(html, query, request, response)
 
+    elif path == "/cluster":
+
+        if not valid_clus_query(query):
+            raise Exception("invalid query format")
+
+        _cluster_report(html, {}, request, response)
+
+    elif path == "/profile":
+
+        if not valid_prof_query(query):
+            raise Exception("invalid query format")
+        query = query and dict(p.split("=") for p in query.split("&")) or {}
+
+        response["content"] = _profile_report(query, request, response)
+        response["headers"]["content-type"] = "text/plain"
+        return
+
     else:
         response["status_code"] = 404
         return
@@ -466,6 +668,7 @@ def process_request(request: dict, response: dict):
 def self_test():
 
     from time import sleep
+    from expected import expected
     from pmnc.request import fake_request
 
     ###################################
@@ -547,6 +750,9 @@ def self_test():
             sleep(1.0)
             pmnc.log("wait {0:d}/90".format(i + 1))
 
+        circuit_breaker = pmnc.shared_pools.get_circuit_breaker("callable_6")
+        circuit_breaker.register(True); circuit_breaker.register(False)
+
         request = dict(url = "/?"
                              "interface.foo.request_rate=expanded&"
                              "interface.foo.response_rate.success=collapsed&"
@@ -576,9 +782,106 @@ def self_test():
         assert "processing time</a>" in content
         assert "RAM" in content
         assert "CPU" in content
+        assert "resource callable_6 circuit breaker closed, 1 consecutive failure(s), 50% failed" in content
+        assert "resolution=10m" in content and "resolution=1h" in content
+        assert "percentiles</a>" in content
+
+        request = dict(url = "/?"
+                             "resource.bar.processing_time.success=percentiles&"
+                             "resource.bar.transaction_rate.success=percentiles",
+                       method = "GET", headers = {}, body = b"")
+        response = dict(status_code = 200, headers = {}, body = b"")
+
+        pmnc.__getattr__(__name__).process_request(request, response)
+        assert response["status_code"] == 200
+        content = response["content"]
+
+        assert "last hour p50 10 ms, p90 10 ms, p99 10 ms, p99.9 10 ms, max 10 ms" in content
+        assert "averages</a>" in content and "transaction rate</a>" in content
+
+        for resolution in ("10m", "1h"):
+
+            request = dict(url = "/?resolution={0:s}&resource.bar.processing_time=expanded".format(resolution),
+                           method = "GET", headers = {}, body = b"")
+            response = dict(status_code = 200, headers = {}, body = b"")
+
+            pmnc.__getattr__(__name__).process_request(request, response)
+            assert response["status_code"] == 200
+            content = response["content"]
+
+            if "nothing to report yet" in content:
+                assert "at {0:s} resolution".format(resolution) in content
+            else:
+                assert "resolution={0:s}".format(resolution) in response["headers"]["refresh"]
+                assert "processing time</a>" in content
 
     test_performance()
 
+    ###################################
+
+    def test_cluster():
+
+        from re import sub
+
+        request = dict(url = "/cluster", method = "GET", headers = {}, body = b"")
+        response = dict(status_code = 200, headers = {}, body = b"")
+
+        pmnc.__getattr__(__name__).process_request(request, response)
+        assert response["status_code"] == 200
+        assert "cage {0:s} is not running the health monitor".format(__cage__) in response["content"]
+
+        request = dict(url = "/cluster?foo=bar", method = "GET", headers = {}, body = b"")
+        with expected(Exception("invalid query format")):
+            pmnc.__getattr__(__name__).process_request(request, response)
+
+        html = StringIO()
+        _write_cluster_performance(html, { "cage_1": ((30.0, 5.0, 10), { "nodeA": (10.0, 1.0, 2),
+                                                                         "nodeB": (10.0, 10.0, 20),
+                                                                         "nodeC": (10.0, None, None) }),
+                                           "cage_2": ((30.0, 2.0, None), { "nodeA": (25.0, 2.0, None),
+                                                                           "nodeB": (5.0, 2.0, 5) }) })
+        lines = html.getvalue().split("<br/>\n")
+        assert lines[-1] == ""
+        lines = [ sub("<[^>]+>", "", line).replace(full_block, " ").split() for line in lines[2:-1] ]
+
+        assert lines == [ [ "cage_1", "30.0", "5.0", "10" ],
+                          [ "nodeA", "10.0", "1.0", "2" ],
+                          [ "nodeB", "lagging", "10.0", "10.0", "20" ],
+                          [ "nodeC", "10.0" ],
+                          [ "cage_2", "30.0", "2.0", "inf" ],
+                          [ "nodeA", "hot", "25.0", "2.0", "inf" ],
+                          [ "nodeB", "5.0", "2.0", "5" ] ]
+
+    test_cluster()
+
+    ###################################
+
+    def test_profile():
+
+        fake_request(10.0)
+
+        def process_profile_request(url):
+            request = dict(url = url, method = "GET", headers = {}, body = b"")
+            response = dict(status_code = 200, headers = {}, body = b"")
+            pmnc.__getattr__(__name__).process_request(request, response)
+            assert response["status_code"] == 200
+            assert response["headers"]["content-type"] == "text/plain"
+            return response["content"]
+
+        with expected(Exception("invalid query format")):
+            process_profile_request("/profile?seconds=0")
+
+        assert process_profile_request("/profile?seconds=2") == \
+               "profiling cage {0:s} for 2 second(s)\n".format(__cage__)
+        assert process_profile_request("/profile").startswith("profiling cage {0:s}, ".format(__cage__))
+
+        sleep(3.0)
+
+        stacks = process_profile_request("/profile").split("\n")
+        assert stacks[-1] == "" and all(line.rsplit(" ", 1)[1].isdigit() for line in stacks[:-1])
+
+    test_profile()
+
 if __name__ == "__main__": import pmnc.self_test; pmnc.self_test.run()
 
 ###############################################################################
@@ -18,7 +18,7 @@
 
 __all__ = [ "start", "stop", "reload", "begin_request", "end_request", "enqueue",
             "get_interface", "set_fake_interface", "delete_fake_interface",
-            "get_activity_stats" ]
+            "get_activity_stats", "get_thread_stats", "get_cluster_performance" ]
 __reloadable__ = False
 
 ###############################################################################
@@ -441,8 +441,25 @@ def delete_fake_interface(interface_name: str):
 
 def get_activity_stats() -> (int, int, float): # returns active, pending, rate
 
+    busy, free, queued = get_thread_stats()
+    return busy, queued, _request_rate_sampler.avg
+
+###############################################################################
+# this method is called from interface_metrics.py to export the pool utilization
+
+def get_thread_stats() -> (int, int, int): # returns busy, free, queued
+
     main_thread_pool = _get_main_thread_pool()
-    return main_thread_pool.busy, main_thread_pool.over, _request_rate_sampler.avg
+    return main_thread_pool.busy, main_thread_pool.free, main_thread_pool.over
+
+###############################################################################
+# this method is called from interface_performance.py to report the performance
+# collected by the health monitor, returns None unless it is running on this cage
+
+def get_cluster_performance() -> optional(dict):
+
+    if _health_monitor:
+        return _health_monitor.extract_performance()
 
 ###############################################################################
 # EOF
@@ -29,6 +29,38 @@
 # averaging, and the resulting statistics for the last hour is put to a structure
 # from which it is extracted by the displaying web interface (interface_performance.py).
 #
+# The readings are not passed to the collecting thread one by one, instead each
+# thread pre-aggregates its own readings (per-key event counts and lists of sampled
+# values) under its private lock, and once a second the collecting thread swaps
+# out and merges the accumulations of all the threads. The keys are validated
+# once, the keys that have already passed the validation are remembered.
+#
+# In addition to that, the total number of events and fixed-bucket histograms of
+# the time readings since the cage start are maintained for each key as reported,
+# these are returned by extract_totals() for exporting (see interface_metrics.py).
+# The same totals are returned in compact form by extract_snapshot() to the health
+# monitor, which only receives the keys that have changed since its previous probe
+# (see health_monitor.py).
+#
+# Averaging hides the tail latency, therefore the time readings are also counted
+# in log-linear histograms (see HistogramSampler in samplers.py), which are merged
+# in the same 10 sec -> 60 sec manner. For each time reading extract() returns
+# p50-p99 bands for each 10 sec and 60 sec slice, normalized for display just
+# like the average bands, along with p50, p90, p99, p99.9 and the maximum for
+# the entire last hour.
+#
+# Each completed minute is also written to a round-robin archive file in the cage
+# directory (see PerformanceArchive in perf_archive.py), which keeps the history
+# at 1 min, 10 min and 1 hour resolutions for days and weeks. After a restart the
+# last hour is restored from it, the restored minutes keep their archived p50
+# and p99, but do not contribute to the percentiles for the entire hour, and
+# extract() called with a resolution of 600 or 3600 seconds returns the archived
+# history in the same format.
+#
+# The cage can also be profiled on demand for a number of seconds with
+# start_profiler(), and the collected stacks are returned by extract_profile()
+# in collapsed form (see SamplingProfiler in profiler.py).
+#
 # Interfaces report the following readings:
 #
 # interface.foo.request_rate - accepted requests/sec
@@ -59,14 +91,17 @@
 #
 ################################################################################
 
-__all__ = [ "start", "stop", "event", "sample", "timing", "extract", "request_processing" ]
+__all__ = [ "start", "stop", "event", "sample", "timing", "extract", "extract_totals",
+            "extract_snapshot", "request_processing", "start_profiler", "extract_profile" ]
 __reloadable__ = False
 
 ################################################################################
 
 import time; from time import time
-import threading; from threading import current_thread, Lock
+import threading; from threading import current_thread, Lock, local
 import math; from math import log10
+import bisect; from bisect import bisect_left
+import os; from os import path as os_path
 
 if __name__ == "__main__": # add pythomnic/lib to sys.path
     import os; import sys
@@ -75,9 +110,10 @@ if __name__ == "__main__": # add pythomnic/lib to sys.path
 
 import exc_string; from exc_string import exc_string
 import typecheck; from typecheck import typecheck, by_regex, optional
-import interlocked_queue; from interlocked_queue import InterlockedQueue
 import pmnc.perf_info; from pmnc.perf_info import get_working_set_size, get_cpu_times
-import pmnc.samplers; from pmnc.samplers import RawSampler, RateSampler
+import pmnc.samplers; from pmnc.samplers import RawSampler, RateSampler, HistogramSampler
+import pmnc.perf_archive; from pmnc.perf_archive import PerformanceArchive
+import pmnc.profiler; from pmnc.profiler import SamplingProfiler
 import pmnc.threads; from pmnc.threads import HeavyThread
 
 ###############################################################################
@@ -85,12 +121,26 @@ import pmnc.threads; from pmnc.threads import HeavyThread
 # module-level state => not reloadable
 
 _perf_thread = None
-_perf_queue = InterlockedQueue()
+_perf_archive = None
+
+_profiler_lock = Lock()
+_profiler = None
+
+_accumulators_lock = Lock()
+_accumulators = [] # (thread, accumulator) for each thread that has ever reported a reading
+_thread_local = local()
 
 _perf_lock = Lock()
 _perf_dump_60s = []
 _perf_dump_10s = [None] * 6
 _perf_stats = {}
+_perf_counters = {}   # rate key -> number of events since start
+_perf_histograms = {} # time key -> [ readings in each of the total_buckets, readings above, sum ]
+_perf_changes = {}    # rate or time key -> generation in which its total has last changed
+_perf_generation = 0  # incremented on each harvest
+_perf_epoch = int(time() * 1000) # distinguishes the totals of this run of the cage
+
+total_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000) # ms
 
 ###############################################################################
 
@@ -116,12 +166,30 @@ def _normalize_rate(rate: float) -> int: # takes rate in reqs/sec, returns 0-39
 
 ###############################################################################
 
+percentile_levels = (50.0, 90.0, 99.0, 99.9)
+
+# this method returns a tuple of percentiles at the above levels followed by maximum
+
+def _percentiles(histogram: HistogramSampler) -> tuple:
+    return tuple(histogram.percentiles(*percentile_levels)) + (histogram.max, )
+
+###############################################################################
+
 class Sampler: # this class contains a collection of named samplers
 
     @typecheck
     def __init__(self, period: int):
         self._period = period
         self._samplers = {}
+        self._histograms = {}
+
+    histograms = property(lambda self: self._histograms)
+
+    def _get_histogram(self, key: str):
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = HistogramSampler()
+        return histogram
 
     def _get_sampler(self, key: str, cls: type):
         sampler = self._samplers.get(key)
@@ -141,22 +209,44 @@ class Sampler: # this class contains a collection of named samplers
 
 ###############################################################################
 
-valid_time_key = by_regex("^(interface|resource)\\.[A-Za-z0-9_-]+\\.[A-Za-z0-9_-]+_time(\\.failure|\\.success)?$")
-valid_rate_key = by_regex("^(interface|resource)\\.[A-Za-z0-9_-]+\\.[A-Za-z0-9_-]+_rate(\\.failure|\\.success)?$")
+# the performance keys are checked on every reading, but there is only so many
+# distinct keys, therefore the keys that have matched once are remembered
+
+class _CachedRegexChecker(by_regex):
+
+    _max_keys = 10000
+
+    def __init__(self, regex):
+        by_regex.__init__(self, regex)
+        self._valid_keys = set()
+
+    def check(self, value):
+        if type(value) is str and value in self._valid_keys:
+            return True
+        if not by_regex.check(self, value):
+            return False
+        if len(self._valid_keys) < self._max_keys:
+            self._valid_keys.add(value)
+        return True
+
+valid_time_key = _CachedRegexChecker("^(interface|resource)\\.[A-Za-z0-9_-]+\\.[A-Za-z0-9_-]+_time(\\.failure|\\.success)?$")
+valid_rate_key = _CachedRegexChecker("^(interface|resource)\\.[A-Za-z0-9_-]+\\.[A-Za-z0-9_-]+_rate(\\.failure|\\.success)?$")
 
 ###############################################################################
 
 class CurrentSampler(Sampler):
 
     @typecheck
-    def tick(self, key: valid_rate_key):
+    def tick(self, key: valid_rate_key, count: int = 1):
         sampler = self._get_sampler(key, RateSampler)
-        sampler.tick()
+        sampler.tick(count)
 
     @typecheck
     def sample(self, key: valid_time_key, value: int):
         sampler = self._get_sampler(key, RawSampler)
         sampler += value
+        histogram = self._get_histogram(key)
+        histogram += value
 
     def dump(self) -> dict:
         d = {}
@@ -181,6 +271,8 @@ class CumulativeSampler(Sampler):
             self._sample("{0:s}.max".format(k), v.max)
             self._sample("{0:s}.avg".format(k), int(v.avg))
             self._sample("{0:s}.dev".format(k), int(v.dev))
+        for k, v in sampler._histograms.items():
+            self._get_histogram(k).merge(v)
 
     def dump(self) -> dict:
         keys = set(k.rsplit(".", 1)[0] for k in self._samplers.keys())
@@ -216,6 +308,98 @@ class TimeSlice: # this class tracks time and indicates a beginning of a new tim
 
 ###############################################################################
 
+class _ThreadAccumulator: # this class pre-aggregates the readings reported by one thread
+
+    def __init__(self):
+        self._lock = Lock() # only contended when the readings are being harvested
+        self._events = {}
+        self._samples = {}
+
+    def event(self, key):
+        with self._lock:
+            events = self._events
+            events[key] = events.get(key, 0) + 1
+
+    def sample(self, key, value):
+        with self._lock:
+            values = self._samples.get(key)
+            if values is None:
+                self._samples[key] = [ value ]
+            else:
+                values.append(value)
+
+    # this method is called by the performance thread, it takes away
+    # the accumulated readings and replaces them with empty ones
+
+    def harvest(self):
+        with self._lock:
+            events, self._events = self._events, {}
+            samples, self._samples = self._samples, {}
+        return events, samples
+
+###############################################################################
+
+def _get_accumulator():
+    try:
+        return _thread_local.accumulator
+    except AttributeError:
+        accumulator = _thread_local.accumulator = _ThreadAccumulator()
+        with _accumulators_lock:
+            _accumulators.append((current_thread(), accumulator))
+        return accumulator
+
+###############################################################################
+
+# this method collects the readings accumulated by all the threads,
+# the accumulators of the threads that have exited are harvested
+# for the last time and forgotten
+
+def _harvest_accumulators(sampler10s):
+
+    global _perf_generation
+
+    with _accumulators_lock:
+        accumulators = _accumulators[:]
+
+    with _perf_lock:
+        _perf_generation += 1
+        generation = _perf_generation
+
+    exited = []
+    for thread, accumulator in accumulators:
+        alive = thread.is_alive()
+        events, samples = accumulator.harvest()
+        for key, count in events.items():
+            sampler10s.tick(key, count)
+            if key.endswith(".success") or key.endswith(".failure"):
+                sampler10s.tick(key[:-8], count)
+        for key, values in samples.items():
+            for value in values:
+                sampler10s.sample(key, value)
+                if key.endswith(".success") or key.endswith(".failure"):
+                    sampler10s.sample(key[:-8], value)
+        with _perf_lock: # update the totals for the keys exactly as reported
+            for key, count in events.items():
+                _perf_counters[key] = _perf_counters.get(key, 0) + count
+                _perf_changes[key] = generation
+            for key, values in samples.items():
+                histogram = _perf_histograms.get(key)
+                if histogram is None:
+                    histogram = _perf_histograms[key] = [ 0 ] * (len(total_buckets) + 2)
+                for value in values:
+                    histogram[bisect_left(total_buckets, value)] += 1
+                histogram[-1] += sum(values)
+                _perf_changes[key] = generation
+        if not alive:
+            exited.append((thread, accumulator))
+
+    if exited:
+        with _accumulators_lock:
+            for t_a in exited:
+                _accumulators.remove(t_a)
+
+###############################################################################
+
 def _perf_thread_proc():
 
     slice10s = TimeSlice(10)
@@ -223,23 +407,12 @@ def _perf_thread_proc():
     sampler60s = CumulativeSampler(60)
     sampler10s = CurrentSampler(10)
 
-    while not current_thread().stopped():
+    while not current_thread().stopped(1.0): # this causes a delay of up to 1 sec
         try:
 
-            # drain the queue and append all the data to the current 10s sampler
-
-            perf_info = _perf_queue.pop(1.0) # this causes a delay of up to 1 sec
-            while perf_info:
-                what, key, value = perf_info
-                if what == "event":
-                    sampler10s.tick(key)
-                    if key.endswith(".success") or key.endswith(".failure"):
-                        sampler10s.tick(key[:-8])
-                elif what == "sample":
-                    sampler10s.sample(key, value)
-                    if key.endswith(".success") or key.endswith(".failure"):
-                        sampler10s.sample(key[:-8], value)
-                perf_info = _perf_queue.pop(0.0)
+            # collect the readings accumulated by all the threads to the current 10s sampler
+
+            _harvest_accumulators(sampler10s)
 
             # see if another 10s have passed
 
@@ -248,7 +421,8 @@ def _perf_thread_proc():
 
                 with _perf_lock: # update the shared 10s stats
                     completed_slice = slice - 1
-                    _perf_dump_10s[completed_slice % 6] = (completed_slice * 10, sampler10s.dump())
+                    _perf_dump_10s[completed_slice % 6] = (completed_slice * 10, sampler10s.dump(),
+                                                            sampler10s.histograms)
 
                 sampler60s.collect(sampler10s)   # append 10s stats to the 60s sampler
                 sampler10s = CurrentSampler(10) # create a new empty 10s sampler
@@ -258,13 +432,18 @@ def _perf_thread_proc():
                     # update the shared 60s stats with the current 60s summary
                     # and reset the shared 10s stats
 
+                    completed_minute = slice - 6
+                    dump60s = sampler60s.dump()
+
                     with _perf_lock:
-                        completed_minute = slice - 6
-                        _perf_dump_60s.append((completed_minute * 10, sampler60s.dump()))
+                        _perf_dump_60s.append((completed_minute * 10, dump60s, sampler60s.histograms, {}))
                         if len(_perf_dump_60s) == 60:
                             _perf_dump_60s.pop(0)
                         _perf_dump_10s[:] = [None] * 6
 
+                    if _perf_archive: # append the minute to the long-horizon history
+                        _perf_archive.write(completed_minute * 10, _archive_levels(dump60s, sampler60s.histograms))
+
                     sampler60s = CumulativeSampler(60) # create a new empty 60s sampler
 
                 with _perf_lock: # update global statistics
@@ -283,8 +462,49 @@ def _perf_thread_proc():
 
 ###############################################################################
 
+# this method converts a minute summary to the levels stored in the archive
+
+def _archive_levels(dump: dict, histograms: dict) -> dict:
+
+    levels = {}
+    for k, (low, high) in dump.items():
+        histogram = histograms.get(k)
+        if histogram is not None and histogram.count > 0:
+            p50, p99 = histogram.percentiles(50.0, 99.0)
+            levels[k] = (low, high, _normalize_time(p50), _normalize_time(p99))
+        else:
+            levels[k] = (low, high, None, None)
+
+    return levels
+
+###############################################################################
+# this method opens the archive and restores the last hour from it
+
+def _open_archive():
+
+    global _perf_archive
+
+    try:
+        _perf_archive = PerformanceArchive(os_path.join(__cage_dir__, "performance.archive"))
+    except:
+        pmnc.log.error("performance history is unavailable: {0:s}".format(exc_string()))
+        return
+
+    _restore_last_hour()
+
+def _restore_last_hour():
+
+    current_minute = int(time()) // 60 * 60
+    for t, levels in _perf_archive.read(60, current_minute - 59 * 60, 59):
+        if levels is not None:
+            _perf_dump_60s.append((t, { k: v[:2] for k, v in levels.items() }, {},
+                                   { k: v[2:] for k, v in levels.items() if None not in v[2:] }))
+
+###############################################################################
+
 def start():
     global _perf_thread
+    _open_archive()
     _perf_thread = HeavyThread(target = _perf_thread_proc, name = "performance")
     _perf_thread.start()
 
@@ -292,18 +512,23 @@ def start():
 
 def stop():
     _perf_thread.stop()
+    if _perf_archive:
+        _perf_archive.close()
+    with _profiler_lock:
+        if _profiler:
+            _profiler.stop()
 
 ###############################################################################
 
 @typecheck
 def event(key: valid_rate_key):
-    _perf_queue.push(("event", key, None))
+    _get_accumulator().event(key)
 
 ###############################################################################
 
 @typecheck
 def sample(key: valid_time_key, value: int):
-    _perf_queue.push(("sample", key, value))
+    _get_accumulator().sample(key, value)
 
 ###############################################################################
 
@@ -327,9 +552,13 @@ def timing(key: valid_time_key):
 
 ###############################################################################
 
-def extract() -> optional((int, dict, dict)):
+def extract(resolution: optional(int) = 60) -> optional((int, dict, dict, dict)):
+
+    if resolution != 60:
+        return _extract_history(resolution)
 
     result = {}
+    percentiles = {} # time key -> (60s slices, 10s slices, merge of all the slices)
 
     with _perf_lock:
 
@@ -347,7 +576,7 @@ def extract() -> optional((int, dict, dict)):
 
         # copy the 60s shared stats
 
-        for t, d in reversed(_perf_dump_60s):
+        for t, d, h, p in reversed(_perf_dump_60s): # p are the percentiles of the restored minutes
             time_delta = base_time - t
             assert time_delta % 60 == 0
             minutes_back = time_delta // 60
@@ -355,12 +584,16 @@ def extract() -> optional((int, dict, dict)):
                 i = 59 - minutes_back
                 for k, v in d.items():
                     result.setdefault(k, ([None] * 59, [None] * 6))[0][i] = v
+                for k, v in h.items():
+                    percentiles.setdefault(k, ([None] * 59, [None] * 6, HistogramSampler()))[0][i] = v
+                for k, v in p.items():
+                    percentiles.setdefault(k, ([None] * 59, [None] * 6, HistogramSampler()))[0][i] = v
 
         # copy the 10s shared stats
 
         for x in _perf_dump_10s:
             if x is not None:
-                t, d = x
+                t, d, h = x
                 time_delta = t - base_time
                 assert time_delta % 10 == 0
                 slices_forward = time_delta // 10
@@ -368,12 +601,140 @@ def extract() -> optional((int, dict, dict)):
                     i = slices_forward
                     for k, v in d.items():
                         result.setdefault(k, ([None] * 59, [None] * 6))[1][i] = v
+                    for k, v in h.items():
+                        percentiles.setdefault(k, ([None] * 59, [None] * 6, HistogramSampler()))[1][i] = v
 
         # copy the global statistics
 
         stats = _perf_stats.copy()
 
-    return base_time, result, stats
+    # the histograms are merged and converted to percentiles outside the lock,
+    # the shared histograms are never modified after they have been dumped
+
+    for k, (h1m, h10s, h) in percentiles.items():
+        for hs in (h1m, h10s):
+            for i, v in enumerate(hs):
+                if isinstance(v, HistogramSampler): # the restored minutes are already (p50, p99)
+                    h.merge(v)
+                    p50, p99 = v.percentiles(50.0, 99.0)
+                    hs[i] = (_normalize_time(p50), _normalize_time(p99))
+        percentiles[k] = (h1m, h10s, h.count > 0 and _percentiles(h) or None)
+
+    return base_time, result, stats, percentiles
+
+###############################################################################
+# this method returns the archived history in the same format as extract(),
+# only with the slots of the given resolution in place of the 60s slices and
+# without the 10s slices and the percentiles for the last hour
+
+def _extract_history(resolution: int) -> optional((int, dict, dict, dict)):
+
+    if not _perf_archive:
+        return None
+
+    base_time = int(time()) // resolution * resolution
+
+    result = {}
+    percentiles = {}
+
+    for i, (t, levels) in enumerate(_perf_archive.read(resolution, base_time - 59 * resolution, 59)):
+        for k, (low, high, p50, p99) in (levels or {}).items():
+            result.setdefault(k, ([None] * 59, [None] * 6))[0][i] = (low, high)
+            if p50 is not None and p99 is not None:
+                percentiles.setdefault(k, ([None] * 59, [None] * 6, None))[0][i] = (p50, p99)
+
+    if not result:
+        return None
+
+    with _perf_lock:
+        stats = _perf_stats.copy()
+
+    return base_time, result, stats, percentiles
+
+###############################################################################
+# this method returns the raw totals since the cage start, as rate key -> number
+# of events, and time key -> ((upper bound in ms or None, cumulative number
+# of readings), ..., sum of readings in ms), along with the global statistics
+
+def extract_totals() -> (dict, dict, dict):
+
+    with _perf_lock:
+        counters = _perf_counters.copy()
+        histograms = { k: v[:] for k, v in _perf_histograms.items() }
+        stats = _perf_stats.copy()
+
+    for k, v in histograms.items():
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(total_buckets + (None, ), v[:-1]):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        histograms[k] = (tuple(buckets), v[-1])
+
+    return counters, histograms, stats
+
+###############################################################################
+# this method returns the totals in compact form for the health monitor, if the
+# epoch matches, only the keys changed after the given generation are included,
+# the histograms are [ sum, readings in each of the buckets ] with trailing
+# zero buckets omitted, the bucket bounds are only included in full snapshots
+
+def extract_snapshot(epoch: optional(int) = None, generation: int = 0) -> dict:
+
+    with _perf_lock:
+
+        full = epoch != _perf_epoch
+        changed = [ k for k, g in _perf_changes.items() if full or g > generation ]
+
+        counters = { k: _perf_counters[k] for k in changed if k in _perf_counters }
+        histograms = { k: _perf_histograms[k][:] for k in changed if k in _perf_histograms }
+
+        # the harvest of the current generation may be incomplete,
+        # therefore the next snapshot will include it once again
+
+        snapshot = dict(epoch = _perf_epoch, generation = _perf_generation - 1, time = time(),
+                        counters = counters, histograms = histograms)
+
+    for k, v in histograms.items():
+        buckets = v[:-1]
+        while buckets and buckets[-1] == 0:
+            buckets.pop()
+        histograms[k] = [ v[-1] ] + buckets
+
+    if full:
+        snapshot["buckets"] = list(total_buckets)
+
+    return snapshot
+
+###############################################################################
+# this method starts profiling the cage for the specified number of seconds,
+# the stacks from the previous profiling are discarded, returns False if
+# the profiler is already running
+
+def start_profiler(seconds: float) -> bool:
+
+    global _profiler
+
+    with _profiler_lock:
+        if _profiler and _profiler.running:
+            return False
+        _profiler = SamplingProfiler(seconds)
+        _profiler.start()
+
+    pmnc.log.message("profiling for {0:.01f} second(s)".format(seconds))
+    return True
+
+###############################################################################
+# this method returns the state of the profiler as (running, remaining seconds,
+# number of samples, collapsed stacks) or None if it has never been started
+
+def extract_profile() -> optional((bool, float, int, str)):
+
+    with _profiler_lock:
+        profiler = _profiler
+
+    if profiler:
+        return profiler.running, profiler.remain, profiler.samples, profiler.collapsed()
 
 ###############################################################################
 
@@ -407,6 +768,7 @@ def self_test():
     from time import sleep
     from typecheck import InputParameterError
     from pmnc.request import fake_request
+    from threading import Event
 
     ###################################
 
@@ -467,6 +829,33 @@ def self_test():
 
     ###################################
 
+    def test_percentiles():
+
+        s10s = CurrentSampler(10)
+
+        for i in range(1, 1001):
+            s10s.sample("resource.bar.processing_time", i)
+        s10s.tick("interface.foo.request_rate")
+
+        assert list(s10s.histograms.keys()) == [ "resource.bar.processing_time" ]
+        p50, p90, p99, p999, max_ = _percentiles(s10s.histograms["resource.bar.processing_time"])
+        assert 500 <= p50 <= 510 and 900 <= p90 <= 915 and 990 <= p99 <= 1000 and 995 <= p999 <= max_ == 1000
+
+        s60s = CumulativeSampler(60)
+        s60s.collect(s10s)
+
+        s10s = CurrentSampler(10)
+        for i in range(1000):
+            s10s.sample("resource.bar.processing_time", 100000)
+        s60s.collect(s10s)
+
+        p50, p90, p99, p999, max_ = _percentiles(s60s.histograms["resource.bar.processing_time"])
+        assert 990 <= p50 <= 1010 and 99000 <= p90 <= max_ == 100000
+
+    test_percentiles()
+
+    ###################################
+
     def test_time_slice():
 
         # this test is still probabilistic
@@ -572,6 +961,105 @@ def self_test():
 
     ###################################
 
+    def test_profiler():
+
+        def wu_busy(seconds):
+            start = time()
+            while time() - start < seconds:
+                pass
+
+        th = HeavyThread(target = wu_busy, args = (1.5, ), name = "busy")
+        th.start()
+        try:
+            assert pmnc.performance.start_profiler(1.0)
+            assert not pmnc.performance.start_profiler(1.0)
+            running, remain, samples, stacks = pmnc.performance.extract_profile()
+            assert running and 0.0 < remain <= 1.0
+            sleep(1.2)
+        finally:
+            th.join()
+
+        running, remain, samples, stacks = pmnc.performance.extract_profile()
+        assert not running and remain == 0.0 and samples > 0
+        assert any(line.startswith("busy;") and "wu_busy (performance.py:" in line
+                   for line in stacks.split("\n"))
+
+    test_profiler()
+
+    ###################################
+
+    def test_accumulators():
+
+        a = _ThreadAccumulator()
+        a.event("interface.foo.request_rate")
+        a.event("interface.foo.request_rate")
+        a.sample("resource.bar.processing_time", 10)
+        a.sample("resource.bar.processing_time", 20)
+
+        assert a.harvest() == ({ "interface.foo.request_rate": 2 },
+                               { "resource.bar.processing_time": [ 10, 20 ] })
+        assert a.harvest() == ({}, {})
+
+        reported, exiting = Event(), Event()
+
+        def th_proc():
+            pmnc.performance.event("interface.foo.request_rate")
+            reported.set()
+            exiting.wait()
+
+        th = HeavyThread(target = th_proc)
+        th.start()
+        reported.wait()
+
+        with _accumulators_lock:
+            assert th in [ t for t, a in _accumulators ]
+
+        exiting.set()
+        th.join()
+        sleep(2.5) # the performance thread harvests the accumulators once a second
+
+        with _accumulators_lock:
+            assert th not in [ t for t, a in _accumulators ]
+
+    test_accumulators()
+
+    ###################################
+
+    def test_sample_overhead():
+
+        def th_proc(n):
+            for i in range(n):
+                sample("resource.bar.processing_time", i % 1000)
+
+        n = 100000
+
+        start = time()
+        th_proc(n)
+        elapsed = time() - start
+
+        pmnc.log.message("{0:.02f} us per sample() call".format(elapsed * 1000000 / n))
+
+        ths = [ HeavyThread(target = th_proc, args = (n, )) for i in range(4) ]
+        start = time()
+        for th in ths: th.start()
+        for th in ths: th.join()
+        elapsed = time() - start
+
+        pmnc.log.message("{0:.02f} us per sample() call from 4 threads".format(elapsed * 1000000 / (n * 4)))
+
+        n = 1000
+
+        start = time()
+        for i in range(n):
+            pmnc.performance.sample("resource.bar.processing_time", i % 1000)
+        elapsed = time() - start
+
+        pmnc.log.message("{0:.02f} us per pmnc.performance.sample() call".format(elapsed * 1000000 / n))
+
+    test_sample_overhead()
+
+    ###################################
+
     def test_running():
 
         fake_request(90.0)
@@ -583,12 +1071,121 @@ def self_test():
             if i % 10 == 0:
                 pmnc.log("wait {0:d}/90".format(i // 10))
 
-        pmnc.performance.extract()
+        base_time, stats_dump, app_perf, percentiles = pmnc.performance.extract()
+
+        assert "resource.baz.response_time" in stats_dump
+        assert "resource.baz.response_rate" in stats_dump
+        assert "resource.baz.response_rate" not in percentiles
+
+        b1m, b10s, p = percentiles["resource.baz.response_time"]
+        assert len(b1m) == 59 and len(b10s) == 6
+        assert p == (1, 1, 1, 1, 1)
+        assert all(v in (None, (0, 0)) for v in b1m + b10s)
+
+        sleep(1.5) # let the performance thread collect the latest readings
+
+        counters, histograms, stats = pmnc.performance.extract_totals()
+
+        assert counters["resource.baz.response_rate.success"] == 901
+        assert "resource.baz.response_rate" not in counters
+
+        buckets, sum_ = histograms["resource.baz.response_time.success"]
+        assert buckets[0] == (1, 901) and buckets[-1] == (None, 901) and sum_ == 901
+        assert "resource.baz.response_time" not in histograms
+
+        assert "wss" in stats
 
     test_running()
 
     ###################################
 
+    def test_snapshot():
+
+        fake_request(10.0)
+
+        snapshot = pmnc.performance.extract_snapshot()
+        assert snapshot["buckets"] == list(total_buckets)
+        epoch, generation = snapshot["epoch"], snapshot["generation"]
+
+        pmnc.performance.event("interface.snap.request_rate")
+        pmnc.performance.sample("interface.snap.response_time.success", 3)
+        pmnc.performance.sample("interface.snap.response_time.success", 7)
+        sleep(2.5) # let the performance thread collect the readings
+
+        snapshot = pmnc.performance.extract_snapshot(epoch, generation)
+        assert "buckets" not in snapshot and snapshot["epoch"] == epoch
+        assert snapshot["counters"]["interface.snap.request_rate"] == 1
+        assert snapshot["histograms"]["interface.snap.response_time.success"] == [ 10, 0, 0, 1, 1 ]
+
+        # the keys that have not changed are omitted
+
+        sleep(2.5)
+        snapshot = pmnc.performance.extract_snapshot(epoch, snapshot["generation"])
+        assert "interface.snap.request_rate" not in snapshot["counters"]
+        assert "interface.snap.response_time.success" not in snapshot["histograms"]
+
+        # after a restart a full snapshot is returned
+
+        snapshot = pmnc.performance.extract_snapshot(epoch - 1, snapshot["generation"])
+        assert snapshot["counters"]["interface.snap.request_rate"] == 1 and "buckets" in snapshot
+
+    test_snapshot()
+
+    ###################################
+
+    def test_history():
+
+        s60s = CumulativeSampler(60)
+        s10s = CurrentSampler(10)
+        s10s.tick("interface.foo.request_rate")
+        s10s.sample("resource.bar.processing_time", 1000)
+        s60s.collect(s10s)
+
+        assert _archive_levels(s60s.dump(), s60s.histograms) == \
+               { "interface.foo.request_rate": (0, 0, None, None),
+                 "resource.bar.processing_time": (20, 20, 20, 20) }
+
+        # test_running has completed at least one minute which went to the archive
+
+        current_minute = int(time()) // 60 * 60
+        archived = [ levels["resource.baz.response_time"] for t, levels in _perf_archive.read(60, current_minute - 120, 2)
+                     if levels is not None and "resource.baz.response_time" in levels ] # the earlier minute may
+        assert archived and all(levels == (0, 0, 0, 0) for levels in archived)    # predate test_running
+
+        for resolution in (600, 3600):
+            history = pmnc.performance.extract(resolution)
+            if history is not None:
+                base_time, stats_dump, app_perf, percentiles = history
+                assert base_time % resolution == 0
+                b1h, b10s = stats_dump["resource.baz.response_time"]
+                assert len(b1h) == 59 and b10s == [None] * 6
+                assert percentiles["resource.baz.response_time"][2] is None
+
+        # the restored minutes keep their percentiles
+
+        _perf_archive.write(current_minute - 300, { "resource.arch.processing_time": (1, 2, 3, 4),
+                                                    "interface.arch.request_rate": (5, 6, None, None) })
+
+        with _perf_lock:
+            saved_dump_60s = _perf_dump_60s[:]
+            del _perf_dump_60s[:]
+        try:
+            _restore_last_hour()
+            base_time, stats_dump, app_perf, percentiles = pmnc.performance.extract()
+            i = 59 - (base_time - (current_minute - 300)) // 60
+            assert stats_dump["resource.arch.processing_time"][0][i] == (1, 2)
+            assert stats_dump["interface.arch.request_rate"][0][i] == (5, 6)
+            assert percentiles["resource.arch.processing_time"][0][i] == (3, 4)
+            assert percentiles["resource.arch.processing_time"][2] is None
+            assert "interface.arch.request_rate" not in percentiles
+        finally:
+            with _perf_lock:
+                _perf_dump_60s[:] = saved_dump_60s
+
+    test_history()
+
+    ###################################
+
 if __name__ == "__main__": import pmnc.self_test; pmnc.self_test.run()
 
 ###############################################################################
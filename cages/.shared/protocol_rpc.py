@@ -59,6 +59,8 @@
 # request_timeout = None,                                  # meta, optional
 # random_port = -63000,                                    # tcp, negative means "in range 63000..63999"
 # max_connections = 100,                                   # tcp
+# io_threads = 1,                                          # tcp, optional, I/O threads
+# max_queued_requests = None,                              # tcp, optional, stop reading above, 2 * thread_count by default
 # broadcast_address = ("1.2.3.4/1.2.3.255", 12480),        # rpc, "interface address/broadcast address", port
 # ssl_ciphers = None,                                      # ssl, optional str
 # ssl_protocol = None,                                     # ssl, optional "SSLv23", "TLSv1", "TLSv1_1", "TLSv1_2" or "TLS"
@@ -94,7 +96,7 @@ __all__ = [ "Interface", "Resource", "Handler" ]
 
 ###############################################################################
 
-import os; from os import urandom, SEEK_SET, SEEK_CUR, SEEK_END, path as os_path
+import os; from os import urandom, SEEK_SET, SEEK_END, path as os_path
 import time; from time import time
 import binascii; from binascii import a2b_hex, b2a_hex
 import select; from select import select
@@ -262,7 +264,7 @@ class RpcUnmarshaler:
         self._hash = sha1()
 
     @typecheck
-    def __call__(self, data_b: bytes) -> optional((valid_marshaling_method, anything)):
+    def __call__(self, data_b: either(bytes, memoryview)) -> optional((valid_marshaling_method, anything)):
 
         self._stream.write(data_b)
         stream_length = self._stream.tell()
@@ -340,6 +342,8 @@ class Interface: # RPC interface
                  separate_thread_pool: optional(bool) = False,
                  disable_broadcast: optional(bool) = False,
                  request_timeout: optional(float) = None,
+                 io_threads: optional(int) = None,
+                 max_queued_requests: optional(int) = None,
                  **kwargs):
 
         self._name = name
@@ -392,7 +396,9 @@ class Interface: # RPC interface
                                            ssl_ca_cert_file = ssl_ca_cert_file,
                                            ssl_ciphers = ssl_ciphers or "HIGH:!aNULL:!MD5",
                                            ssl_protocol = ssl_protocol or "TLSv1",
-                                           required_auth_level = CERT_REQUIRED)
+                                           required_auth_level = CERT_REQUIRED,
+                                           io_threads = io_threads,
+                                           max_queued_requests = max_queued_requests)
 
         # RPC interface is special in that it can be configured to enqueue
         # its requests to a separate private thread pool instead of using
@@ -638,7 +644,7 @@ class Handler: # this class is instantiated from interface_tcp
     ###################################
 
     @typecheck
-    def consume(self, data_b: bytes) -> bool:
+    def consume(self, data_b: either(bytes, memoryview)) -> bool:
         if self._local_ts is None:
             self._local_ts = time()
         method_request = self._unmarshaler(data_b)
@@ -731,7 +737,7 @@ class Handler: # this class is instantiated from interface_tcp
         response_method, response_b = marshaler(response, self._method) # note that the response is marshaled
         assert response_method == self._method                          # using the same method as the request
 
-        self._response_stream = BytesIO(response_b)
+        self._response_b = response_b
 
         if pmnc.log.debug:
             pmnc.log.debug("returning {0:s}, {1:d} {2:s} byte(s)".\
@@ -739,15 +745,8 @@ class Handler: # this class is instantiated from interface_tcp
 
     ###################################
 
-    @typecheck
-    def produce(self, n: int) -> bytes:
-        return self._response_stream.read(n)
-
-    ###################################
-
-    @typecheck
-    def retract(self, n: int):
-        self._response_stream.seek(-n, SEEK_CUR)
+    def produce_buffers(self) -> list:
+        return [ self._response_b ]
 
 ###############################################################################
 
@@ -1149,11 +1148,23 @@ def self_test():
                 assert (p and not r) or (not p and r)
             return r
 
+        def unmarshal_views(p): # the data comes as views over a reused buffer
+            um = RpcUnmarshaler(("msgpack", "pickle"), 1024)
+            b = bytearray(10)
+            while p:
+                i = randint(1, 10)
+                pp, p = p[:i], p[i:]
+                b[:len(pp)] = pp
+                r = um(memoryview(b)[:len(pp)])
+                assert (p and not r) or (not p and r)
+            return r
+
         assert RpcUnmarshaler(("msgpack", "pickle"), 1024)(p) == ("pickle", "foo")
 
         t = Timeout(10.0)
         while not t.expired:
             assert unmarshal(p) == ("pickle", "foo")
+            assert unmarshal_views(p) == ("pickle", "foo")
 
         with expected(Exception("unsupported marshaling method")):
             RpcUnmarshaler(("msgpack", ), 1024)(p)
@@ -1192,6 +1203,7 @@ def self_test():
         t = Timeout(10.0)
         while not t.expired:
             assert unmarshal(p) == ("msgpack", "foo")
+            assert unmarshal_views(p) == ("msgpack", "foo")
 
         with expected(Exception("unsupported marshaling method")):
             RpcUnmarshaler(("pickle", ), 1024)(p)
@@ -25,8 +25,13 @@ __all__ = [ "TcpInterface", "TcpResource" ]
 
 import threading; from threading import Event, Lock, current_thread
 import select; from select import select, error as select_error
+import selectors; from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
 import socket; from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, \
-                                  SOL_SOCKET, SO_REUSEADDR, error as socket_error
+                                  SOL_SOCKET, SO_REUSEADDR, IPPROTO_TCP, TCP_NODELAY, error as socket_error
+try:
+    from socket import SO_REUSEPORT
+except ImportError: # not on Windows
+    SO_REUSEPORT = None
 import io; from io import BytesIO
 import os; from os import SEEK_CUR, path as os_path
 import ssl; from ssl import wrap_socket, CERT_OPTIONAL, CERT_REQUIRED, CERT_NONE, \
@@ -73,6 +78,18 @@ def _peer_cn(s):
 
 ###############################################################################
 
+# scatter-gather send is not available on Windows, where
+# the buffers are sent one at a time
+
+_have_sendmsg = hasattr(socket, "sendmsg")
+
+try:
+    _max_send_buffers = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError): # not on Windows
+    _max_send_buffers = 16
+
+###############################################################################
+
 class TcpConnection:
     """
     <TcpConnection>
@@ -84,6 +101,9 @@ class TcpConnection:
     is kept alive while handler allows.
     """
 
+    _min_read_size = 16384
+    _max_read_size = 1048576
+
     @typecheck
     def __init__(self, interface_name: str, socket, handler_factory: callable,
                  request_timeout: float):
@@ -94,9 +114,12 @@ class TcpConnection:
         self._handler_factory = handler_factory
         self._handler = None
         self._request_timeout = request_timeout
+        self._read_buffer = bytearray(self._min_read_size)
+        self._read_peak = 0
         self._go_active()
         self._state = self._state_initialize
         self._unwritten_data = None
+        self._buffers = None
 
     socket = property(lambda self: self._socket)
     expired = property(lambda self: self._timeout.expired)
@@ -106,6 +129,7 @@ class TcpConnection:
     ###################################
 
     def _go_idle(self, idle_timeout: float):
+        self._shrink_read_buffer()
         self._idle = True
         self._timeout = Timeout(idle_timeout)
         self._request = None
@@ -149,8 +173,25 @@ class TcpConnection:
 
     ###################################
 
+    # the data is received into a buffer owned by the connection and reused for
+    # each read, the handler consumes a memoryview over the part that has been
+    # read, which is only valid until consume returns, the buffer grows while
+    # reads fill it up, so that a large request is read in fewer larger pieces,
+    # and shrinks back between requests that turn out to be smaller
+
     def _recv(self):
-        return self._socket.recv(16384), "read"
+        buffer = self._read_buffer
+        data_len = self._socket.recv_into(buffer)
+        if data_len == len(buffer) and data_len < self._max_read_size:
+            self._read_buffer = bytearray(data_len * 2) # the view returned refers to the old buffer
+        self._read_peak = max(self._read_peak, data_len)
+        return memoryview(buffer)[:data_len], "read"
+
+    def _shrink_read_buffer(self):
+        buffer_len = len(self._read_buffer)
+        if buffer_len > self._min_read_size and self._read_peak * 4 <= buffer_len:
+            self._read_buffer = bytearray(buffer_len // 2)
+        self._read_peak = 0
 
     def _state_read(self):
         data, wait_state = self._recv()
@@ -184,14 +225,40 @@ class TcpConnection:
     ###################################
 
     def _state_resume(self):                     # this fake state performs the dispatch
-        self._state = self._state_write          # of the connection with ready response
+        produce_buffers = getattr(self._handler, "produce_buffers", None) # of the connection
+        if produce_buffers is not None:                                   # with ready response
+            self._buffers = [ memoryview(b).cast("B") for b in produce_buffers() if len(b) > 0 ]
+            self._state = self._state_write_buffers
+        else:
+            self._state = self._state_write
         return "write"
 
     ###################################
 
+    # a handler gives out its response either piecewise through produce/retract
+    # or, if it has produce_buffers method, at once as a list of bytes-like buffers
+    # (such as header and content), which are then sent with scatter-gather I/O,
+    # partial sends advance memoryviews over the buffers rather than copying them
+
     def _send(self, data):
         return self._socket.send(data)
 
+    def _send_buffers(self, buffers):
+        if _have_sendmsg:
+            return self._socket.sendmsg(buffers[:_max_send_buffers])
+        else:
+            return self._socket.send(buffers[0])
+
+    @staticmethod
+    def _advance_buffers(buffers, sent):
+        while sent > 0:
+            buffer_len = len(buffers[0])
+            if sent < buffer_len:
+                buffers[0] = buffers[0][sent:]
+                break
+            del buffers[0]
+            sent -= buffer_len
+
     def _state_write(self):
         data = self._unwritten_data or \
                self._handler.produce(16384)      # the handler gives out a response
@@ -211,15 +278,30 @@ class TcpConnection:
             else:
                 raise Exception("unexpected eof")
         else:
-            self._end_request()
-            idle_timeout = self._handler.idle_timeout
-            if idle_timeout > 0.0:               # if the connection is kept alive
-                self._go_idle(idle_timeout)      # return to reading another request
-                self._state = self._state_read
-                return "read"
-            else:                                # gracefully close the connection
-                self._state = None
-                return "close"
+            return self._state_written()
+
+    def _state_write_buffers(self):
+        if self._buffers:                        # some data still needs to be sent
+            sent = self._send_buffers(self._buffers)
+            if sent > 0:
+                self._advance_buffers(self._buffers, sent)
+                return "write"
+            else:
+                raise Exception("unexpected eof")
+        else:
+            return self._state_written()
+
+    def _state_written(self):
+        self._buffers = None
+        self._end_request()
+        idle_timeout = self._handler.idle_timeout
+        if idle_timeout > 0.0:                   # if the connection is kept alive
+            self._go_idle(idle_timeout)          # return to reading another request
+            self._state = self._state_read
+            return "read"
+        else:                                    # gracefully close the connection
+            self._state = None
+            return "close"
 
     ###################################
 
@@ -238,7 +320,31 @@ class TcpConnection:
 
 ###############################################################################
 
-def _wrap_socket(s, *, ssl_ciphers, ssl_protocol, ssl_server_hostname, ssl_ignore_hostname, **kwargs):
+# SSL contexts are cached and shared by all the connections with the same
+# settings, because creating one parses the certificate files; a context is
+# recreated whenever any of its files changes; sharing a context also allows
+# TLS sessions to be resumed, as it keeps the server side session cache and
+# session ticket keys
+
+_ssl_contexts = {}
+_ssl_contexts_lock = Lock()
+
+def _file_stamp(filename):
+    if filename:
+        st = os.stat(filename)
+        return st.st_mtime, st.st_size, st.st_ino
+    else:
+        return None
+
+def _ssl_context(ssl_protocol, ssl_ciphers, certfile, ca_certs, cert_reqs, check_hostname):
+
+    ssl_context_key = (ssl_protocol, ssl_ciphers, certfile, ca_certs, cert_reqs, check_hostname)
+    ssl_context_stamp = (_file_stamp(certfile), _file_stamp(ca_certs))
+
+    with _ssl_contexts_lock:
+        stamp, ssl_context = _ssl_contexts.get(ssl_context_key, (None, None))
+    if stamp == ssl_context_stamp:
+        return ssl_context
 
     ssl_protocol = ssl_protocol or "TLSv1"
     try:
@@ -254,15 +360,35 @@ def _wrap_socket(s, *, ssl_ciphers, ssl_protocol, ssl_server_hostname, ssl_ignor
     if ssl_ciphers is not None:
         ssl_context.set_ciphers(ssl_ciphers)
 
-    keyfile = kwargs.pop("keyfile", None)
-    certfile = kwargs.pop("certfile", None)
-    assert keyfile == certfile
     if certfile:
         ssl_context.load_cert_chain(certfile)
-    ca_certs = kwargs.pop("ca_certs")
     ssl_context.load_verify_locations(ca_certs)
-    ssl_context.verify_mode = kwargs.pop("cert_reqs")
-    ssl_context.check_hostname = ssl_server_hostname is not None and not ssl_ignore_hostname
+    ssl_context.verify_mode = cert_reqs
+    ssl_context.check_hostname = check_hostname
+
+    with _ssl_contexts_lock:
+        _ssl_contexts[ssl_context_key] = (ssl_context_stamp, ssl_context)
+
+    return ssl_context
+
+###############################################################################
+
+# ssl_session is a (context, session) pair of a previous connection, the session
+# is only resumed if the connection is made with the same (cached) context
+
+def _wrap_socket(s, *, ssl_ciphers, ssl_protocol, ssl_server_hostname, ssl_ignore_hostname,
+                 ssl_session = None, **kwargs):
+
+    keyfile = kwargs.pop("keyfile", None)
+    certfile = kwargs.pop("certfile", None)
+    assert keyfile == certfile
+
+    ssl_context = _ssl_context(ssl_protocol, ssl_ciphers, certfile, kwargs.pop("ca_certs"),
+                               kwargs.pop("cert_reqs"),
+                               ssl_server_hostname is not None and not ssl_ignore_hostname)
+
+    if ssl_session is not None and ssl_session[0] is ssl_context:
+        kwargs["session"] = ssl_session[1]
 
     return ssl_context.wrap_socket(s,
                 do_handshake_on_connect = False,
@@ -340,18 +466,21 @@ class SslConnection(TcpConnection):
     _max_read_data = 1048576
 
     def _recv(self):
-        data, data_len = [], 0
+        buffer, data_len = self._read_buffer, 0
         while data_len <= self._max_read_data: # prevent flooding, because the data read here is
-            try:                               # not seen by the handler in the course of reading
-                portion = self._socket.read(16384)
-                if portion:
-                    data.append(portion)
-                    data_len += len(portion)
+            if data_len == len(buffer):        # not seen by the handler in the course of reading
+                buffer = bytearray(data_len * 2)
+                buffer[:data_len] = self._read_buffer
+                self._read_buffer = buffer
+            try:
+                portion_len = self._socket.recv_into(memoryview(buffer)[data_len:])
+                if portion_len:
+                    data_len += portion_len
                 else: # EOF from the client
                     wait_state = "read"
                     break
             except SSLError as e:
-                if data: # if no data has been read, the exception is rethrown
+                if data_len: # if no data has been read, the exception is rethrown
                     if e.args[0] == SSL_ERROR_WANT_READ:
                         wait_state = "read"
                         break
@@ -361,11 +490,15 @@ class SslConnection(TcpConnection):
                 raise
         else:
             raise Exception("input size exceeded")
-        return b"".join(data), wait_state
+        self._read_peak = max(self._read_peak, data_len)
+        return memoryview(buffer)[:data_len], wait_state
 
     def _send(self, data):
         return self._socket.write(data)
 
+    def _send_buffers(self, buffers):            # SSL socket has no sendmsg, but a failed write
+        return self._socket.write(buffers[0][:16384]) # is retried with the same buffers anyway
+
     def process(self):                           # this is a state switch
         try:
             return self._state()
@@ -379,6 +512,57 @@ class SslConnection(TcpConnection):
 
 ###############################################################################
 
+class _SocketQueue:
+    """
+    <_SocketQueue>
+    This is a queue for delivering sockets to one I/O thread. Each push also
+    sends a UDP packet to the I/O thread's pulse socket to kick the thread
+    from its blocking select.
+    """
+
+    def __init__(self):
+
+        # create two sides of a UDP socket used for kicking
+        # I/O thread from blocking select
+
+        self._pulse_recv = socket(AF_INET, SOCK_DGRAM)
+        self._pulse_recv.bind(("127.0.0.1", 0))
+        self._pulse_recv.setblocking(False)
+        self._pulse_recv_address = self._pulse_recv.getsockname()
+
+        self._pulse_send_lock = Lock()
+        self._pulse_send = socket(AF_INET, SOCK_DGRAM)
+        self._pulse_send.bind((self._pulse_recv_address[0], 0))
+
+        self._queue = InterlockedQueue()
+
+    pulse_socket = property(lambda self: self._pulse_recv)
+
+    def push(self, socket, mode):
+        self._queue.push((socket, mode))
+        self.pulse()
+
+    def pulse(self):
+        with self._pulse_send_lock:
+            self._pulse_send.sendto(b"\x00", 0, self._pulse_recv_address)
+
+    def pop(self):
+        return self._queue.pop(0.0) or (None, None)
+
+    # this method reads and discards all UDP packets
+    # received and buffered on the pulse socket
+
+    def drain_pulse_socket(self):
+        while True:
+            try:
+                assert self._pulse_recv.recv(1) == b"\x00"
+            except BlockingIOError:
+                break
+            except:
+                pmnc.log.error(exc_string()) # log and ignore
+
+###############################################################################
+
 class TcpInterface: # called such so as not to be confused with "real" Interface's
     """
     <TcpInterface>
@@ -386,8 +570,26 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
     over TCP or SSL. An instance of this class owns two threads - listener
     thread and I/O thread. Listener thread accepts incoming TCP connections
     and hands them over to the I/O thread. I/O thread performs all the network
-    processing in asynchronous mode (via select). The actual protocol details
-    are processed by the handlers created by the supplied handler_factory.
+    processing in asynchronous mode (via selectors module, which is epoll on
+    Linux, therefore the number of connections is not limited by FD_SETSIZE).
+    The actual protocol details are processed by the handlers created by the
+    supplied handler_factory.
+
+    With io_threads > 1 there are as many independent I/O threads, each owning
+    its own connections. If the listener port is fixed and the platform supports
+    SO_REUSEPORT, each I/O thread also has its own listener thread with its own
+    listening socket bound to the same port, and the kernel distributes incoming
+    connections between them. The first of the sockets is bound before the
+    option is set, therefore if the port is already in use, even by another
+    process using SO_REUSEPORT, the interface fails to start as it would with
+    a single I/O thread. Otherwise a single listener thread hands accepted
+    connections over to the I/O threads in round-robin fashion.
+
+    Once max_queued_requests of the interface's requests are waiting for
+    the worker threads, the I/O threads stop reading from the connections,
+    so that the clients are pushed back by TCP flow control rather than have
+    their requests pile up and expire in the queue. Reading resumes when the
+    queue drains to half of that. The responses are still being written.
     """
 
     @typecheck
@@ -402,13 +604,30 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
                  ssl_ca_cert_file: optional(os_path.isfile),
                  ssl_ciphers: optional(str),
                  ssl_protocol: optional(one_of("SSLv23", "TLSv1", "TLSv1_1", "TLSv1_2", "TLS")),
-                 required_auth_level: optional(one_of(CERT_REQUIRED, CERT_OPTIONAL, CERT_NONE)) = CERT_OPTIONAL): # this parameter is only user in protocol_rpc.py
+                 required_auth_level: optional(one_of(CERT_REQUIRED, CERT_OPTIONAL, CERT_NONE)) = CERT_OPTIONAL, # this parameter is only user in protocol_rpc.py
+                 io_threads: optional(int) = None,
+                 max_queued_requests: optional(int) = None):
 
         self._name = name
         self._handler_factory = handler_factory
         self._listener_address = listener_address
         self._max_connections = max_connections
 
+        # the connection limit applies to all the I/O threads together
+
+        self._connection_count_lock = Lock()
+        self._connection_count = 0
+
+        # the number of the requests waiting for the worker threads,
+        # with high and low water marks for pausing and resuming reading
+
+        self._queued_requests_lock = Lock()
+        self._queued_requests = 0
+        self._queue_high_water = max(max_queued_requests or
+                                     pmnc.config_interfaces.get("thread_count") * 2, 1)
+        self._queue_low_water = self._queue_high_water // 2
+        self._reading_paused = False
+
         assert (ssl_key_cert_file is None and ssl_ca_cert_file is None) or \
                (os_path.isfile(ssl_key_cert_file) and os_path.isfile(ssl_ca_cert_file)), \
                "both certificate files must be specified or none of them"
@@ -419,20 +638,12 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
         self._ssl_protocol = ssl_protocol
         self._use_ssl = ssl_key_cert_file is not None and ssl_ca_cert_file is not None
 
-        # create two sides of a UDP socket used for kicking
-        # I/O thread from blocking select
-
-        self._pulse_recv = socket(AF_INET, SOCK_DGRAM)
-        self._pulse_recv.bind(("127.0.0.1", 0))
-        self._pulse_recv_address = self._pulse_recv.getsockname()
-
-        self._pulse_send_lock = Lock()
-        self._pulse_send = socket(AF_INET, SOCK_DGRAM)
-        self._pulse_send.bind((self._pulse_recv_address[0], 0))
-
-        # create a queue used for delivering sockets to I/O thread
+        # create the queues used for delivering sockets to I/O threads, one per thread,
+        # the listening sockets are only shared through SO_REUSEPORT for a fixed port
 
-        self._socket_queue = InterlockedQueue()
+        self._socket_queues = [ _SocketQueue() for i in range(max(io_threads or 1, 1)) ]
+        self._reuse_port = len(self._socket_queues) > 1 and listener_address[1] >= 0 and \
+                           SO_REUSEPORT is not None
 
         # select the appropriate class for connections
 
@@ -456,31 +667,52 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
 
     ###################################
 
+    def _thread_name(self, kind, i):
+        if len(self._socket_queues) > 1:
+            return "{0:s}:{1:s}:{2:d}".format(self._name, kind, i)
+        else:
+            return "{0:s}:{1:s}".format(self._name, kind)
+
     def start(self):
 
-        # create and start the I/O thread
+        # create and start the I/O threads
 
-        self._io = HeavyThread(target = self._io_proc,
-                               name = "{0:s}:i/o".format(self._name))
-        self._io.start()
+        self._ios = [ HeavyThread(target = self._io_proc, name = self._thread_name("i/o", i),
+                                  args = (socket_queue, ))
+                      for i, socket_queue in enumerate(self._socket_queues) ]
+        for io in self._ios:
+            io.start()
 
-        try: # create and start the listener thread
+        # each listener thread hands the accepted sockets over to its own I/O thread,
+        # or to all of them in turn if there is just one listener thread
 
-            started_listening = Event()
-            self._listener = HeavyThread(target = self._listener_proc,
-                                         name = "{0:s}:lsn".format(self._name),
-                                         args = (started_listening, ))
-            self._listener.start()
+        if self._reuse_port:
+            listener_queues = [ [ socket_queue ] for socket_queue in self._socket_queues ]
+        else:
+            listener_queues = [ self._socket_queues ]
 
-            # wait for the listener thread to actually start listening
+        self._listeners = []
+        try: # create and start the listener threads one by one, because the first one
+             # may pick the actual port which the others then bind to
 
-            try:
-                started_listening.wait(3.0) # this may spend waiting slightly less, but it's ok
-                if not started_listening.is_set():
-                    raise Exception("failed to start listening")
-            except:
-                self.cease()
-                raise
+            for i, socket_queues in enumerate(listener_queues):
+
+                started_listening = Event()
+                listener = HeavyThread(target = self._listener_proc,
+                                       name = self._thread_name("lsn", i),
+                                       args = (started_listening, socket_queues, i == 0))
+                self._listeners.append(listener)
+                listener.start()
+
+                # wait for the listener thread to actually start listening
+
+                try:
+                    started_listening.wait(3.0) # this may spend waiting slightly less, but it's ok
+                    if not started_listening.is_set():
+                        raise Exception("failed to start listening")
+                except:
+                    self.cease()
+                    raise
 
         except:
             self.stop()
@@ -489,24 +721,15 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
     ###################################
 
     def cease(self):
-        self._ceased.set()    # this prevents the I/O thread from introducing new requests
-        self._listener.stop() # (from keep-alives) and the listener thread is simply stopped
+        self._ceased.set()               # this prevents the I/O threads from introducing new requests
+        for listener in self._listeners: # (from keep-alives) and the listener threads are simply stopped
+            listener.stop()
 
     ###################################
 
     def stop(self):
-        self._io.stop()
-
-    ###################################
-
-    def _push_socket_wake_io(self, socket, mode):
-
-        self._socket_queue.push((socket, mode))
-
-        # kick the I/O thread from its blocking select to hasten this socket processing
-
-        with self._pulse_send_lock:
-            self._pulse_send.sendto(b"\x00", 0, self._pulse_recv_address)
+        for io in self._ios:
+            io.stop()
 
     ###################################
 
@@ -514,8 +737,9 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
     # it does the actual processing and resubmits the socket back to the I/O thread
     # for sending the response back to the client
 
-    def wu_process_tcp_request(self, socket, connection):
+    def wu_process_tcp_request(self, socket, connection, socket_queue):
 
+        self._dequeued_request()
         try:
 
             # see for how long the request was on the execution queue up to this moment
@@ -536,31 +760,68 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
         else:
             reuse_mode = "reuse"
         finally:
-            self._push_socket_wake_io(socket, reuse_mode)
+            socket_queue.push(socket, reuse_mode) # back to the I/O thread which owns the connection
 
     ###################################
 
-    # this single thread multiplexes all the I/O on the interface
+    # these methods count the requests waiting for the worker threads, the
+    # decision to pause or resume reading is made here for all the I/O threads,
+    # which see it next time they wake up
+
+    def _queued_request(self):
+        with self._queued_requests_lock:
+            self._queued_requests += 1
+            if self._reading_paused or self._queued_requests < self._queue_high_water:
+                return
+            self._reading_paused = True
+        pmnc.log.warning("{0:d} request(s) are queued, interface {1:s} stops reading "
+                         "from connections".format(self._queue_high_water, self._name))
+
+    def _dequeued_request(self):
+        with self._queued_requests_lock:
+            self._queued_requests -= 1
+            if not self._reading_paused or self._queued_requests > self._queue_low_water:
+                return
+            self._reading_paused = False
+        pmnc.log.info("{0:d} request(s) are queued, interface {1:s} resumes reading "
+                      "from connections".format(self._queue_low_water, self._name))
+        for socket_queue in self._socket_queues:
+            socket_queue.pulse()
 
-    def _io_proc(self):
+    ###################################
+
+    # each I/O thread multiplexes all the I/O on its own connections
+
+    def _io_proc(self, socket_queue):
+
+        # all the currently active connections are registered with the selector
+        # for the events they are waiting for, alongside with the mapping of sockets
+        # to the protocol-specific connections, the sockets whose connections are
+        # being processed by the worker threads are not registered
+
+        selector = DefaultSelector()
+        selector.register(socket_queue.pulse_socket, EVENT_READ)
+        connections = {}
 
-        # all the currently active connections are here, arranged in select-ready lists,
-        # alongside with the mapping of sockets to the protocol-specific connections
+        # while reading is paused, the sockets waiting to read are not registered
+        # but kept aside, they can still expire or be discarded at shutdown
 
-        r_sockets, w_sockets, connections = [self._pulse_recv], [], {}
+        reading_paused = False
+        paused_sockets = set()
 
         # this function unconditionally removes all traces of a socket,
         # it is the last resort and presumably should not throw
 
         def discard_socket(socket, reason = None):
             try:
-                w_sockets.remove(socket)     # the socket may be in
-            except ValueError:               # |
-                try:                         # V
-                    r_sockets.remove(socket) # at most one list
-                except ValueError:
-                    pass
+                selector.unregister(socket) # the socket may not be registered
+            except (KeyError, ValueError):
+                pass
+            paused_sockets.discard(socket)
             connection = connections.pop(socket, None)
+            if connection:
+                with self._connection_count_lock:
+                    self._connection_count -= 1
             if reason:
                 if connection and connection.idle:
                     if pmnc.log.debug:
@@ -613,63 +874,55 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
             finally:
                 idle_sockets_discarded = True
 
-        # this function selects sockets that can be read or written,
-        # also dealing with possible select failures
+        # this function registers the socket for the given events or modifies
+        # its registration, a socket that cannot be registered (for instance
+        # because it has been closed) fails here rather than in select
 
-        def select_rw_sockets(timeout):
-            while not timeout.expired:
+        def wait_socket(socket, events):
+            if reading_paused and events == EVENT_READ:
                 try:
-                    return select(r_sockets, w_sockets, [], timeout.remain)[0:2]
-                except (select_error, ValueError):
-                    rs = []
-                    for r_socket in r_sockets[:]: # need to create a copy of r_sockets
-                        try:
-                            if select([r_socket], [], [], 0.0)[0]:
-                                rs.append(r_socket)
-                        except (select_error, ValueError):
-                            discard_socket(r_socket, "select failure")
-                            continue # for
-                    ws = []
-                    for w_socket in w_sockets[:]: # need to create a copy of w_sockets
-                        try:
-                            if select([], [w_socket], [], 0.0)[1]:
-                                ws.append(w_socket)
-                        except (select_error, ValueError):
-                            discard_socket(w_socket, "select failure")
-                            continue # for
-                    if rs or ws:
-                        return rs, ws
+                    selector.unregister(socket)
+                except KeyError:
+                    pass
+                paused_sockets.add(socket)
+                return
+            try:
+                key = selector.get_key(socket)
+            except KeyError:
+                selector.register(socket, events)
             else:
-                return [], []
+                if key.events != events:
+                    selector.modify(socket, events)
 
         # this function passes control to the given socket's connection,
-        # then dispatches it to the appropriate wait list
+        # then dispatches it to the appropriate wait state
 
-        def process_socket(socket, sockets = None):
+        def process_socket(socket):
             try:
                 connection = connections.get(socket)
                 if not connection: # must have already been discarded
                     return
                 wait_state = connection.process()
                 if wait_state == "read":
-                    if sockets is w_sockets:
-                        w_sockets.remove(socket)
-                    if sockets is not r_sockets:
-                        r_sockets.append(socket)
+                    wait_socket(socket, EVENT_READ)
                 elif wait_state == "write":
-                    if sockets is r_sockets:
-                        r_sockets.remove(socket)
-                    if sockets is not w_sockets:
-                        w_sockets.append(socket)
+                    wait_socket(socket, EVENT_WRITE)
                 elif wait_state == "enqueue":
-                    if sockets is not None:
-                        sockets.remove(socket)
+                    try:
+                        selector.unregister(socket) # the socket is not watched while being processed
+                    except KeyError:
+                        pass
                     if self._ceased.is_set():
                         discard_socket(socket, "interface shutdown")
                     else:
-                        self._enqueue_request(connection.request,
-                                              self.wu_process_tcp_request,
-                                              (socket, connection), {})
+                        self._queued_request()
+                        try:
+                            self._enqueue_request(connection.request,
+                                                  self.wu_process_tcp_request,
+                                                  (socket, connection, socket_queue), {})
+                        except:
+                            self._dequeued_request()
+                            raise
                 elif wait_state == "close":
                     discard_socket(socket)
                 else:
@@ -678,12 +931,21 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
                 discard_socket(socket, exc_string())
 
         # this function creates a connection for a newly accepted
-        # socket and puts it to the appropriate wait list
+        # socket and registers it for the appropriate events
 
         def create_connection(socket):
-            if len(connections) < self._max_connections:
+            with self._connection_count_lock:
+                admitted = self._connection_count < self._max_connections
+                if admitted:
+                    self._connection_count += 1
+            if admitted:
                 try:
-                    connection = self._connection_factory(socket)
+                    try:
+                        connection = self._connection_factory(socket)
+                    except:
+                        with self._connection_count_lock:
+                            self._connection_count -= 1
+                        raise
                     socket = connection.socket # this may be not the original TCP socket
                     connections[socket] = connection
                     process_socket(socket) # this does the appropriate initial dispatch
@@ -692,8 +954,8 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
             else:
                 discard_socket(socket, "too many connections")
 
-        # this function puts the socket for the processed
-        # request to the appropriate wait list
+        # this function registers the socket for the processed
+        # request for the appropriate events
 
         def reuse_connection(socket):
             try:
@@ -701,61 +963,72 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
             except:
                 discard_socket(socket, exc_string())
 
-        # this function reads and discards all UDP packets
-        # received and buffered on the pulse socket
-
-        def drain_pulse_socket():
-            while select([self._pulse_recv], [], [], 0.0)[0]:
-                try:
-                    assert self._pulse_recv.recv(1) == b"\x00"
-                except:
-                    pmnc.log.error(exc_string()) # log and ignore
+        # this function follows the decision to pause or resume reading,
+        # the sockets waiting to write are not affected
+
+        def pause_or_resume_reading():
+            nonlocal reading_paused
+            if self._reading_paused and not reading_paused:
+                reading_paused = True
+                for key in list(selector.get_map().values()): # need to create a copy of the keys
+                    if key.events == EVENT_READ and key.fileobj is not socket_queue.pulse_socket:
+                        wait_socket(key.fileobj, EVENT_READ)
+            elif not self._reading_paused and reading_paused:
+                reading_paused = False
+                while paused_sockets:
+                    socket = paused_sockets.pop()
+                    try:
+                        wait_socket(socket, EVENT_READ)
+                    except:
+                        discard_socket(socket, exc_string())
 
         # this thread multiplexes all the I/O on all the client sockets
 
-        while not current_thread().stopped(): # lifetime loop
-            try:
+        try:
 
-                discard_expired_sockets()
+            while not current_thread().stopped(): # lifetime loop
+                try:
 
-                if self._ceased.is_set() and not idle_sockets_discarded:
-                    discard_idle_sockets()
+                    discard_expired_sockets()
+                    pause_or_resume_reading()
 
-                # select the sockets which are ready for I/O and process them
+                    if self._ceased.is_set() and not idle_sockets_discarded:
+                        discard_idle_sockets()
 
-                readable_sockets, writable_sockets = select_rw_sockets(Timeout(1.0))
+                    # select the sockets which are ready for I/O and process them
 
-                for r_socket in readable_sockets:
-                    if r_socket is self._pulse_recv: # special case
-                        drain_pulse_socket()
-                    else:
-                        process_socket(r_socket, r_sockets)
+                    for key, events in selector.select(1.0):
+                        if key.fileobj is socket_queue.pulse_socket: # special case
+                            socket_queue.drain_pulse_socket()
+                        elif key.fileobj not in paused_sockets: # reading may have been paused meanwhile
+                            process_socket(key.fileobj)
+                            pause_or_resume_reading()
 
-                for w_socket in writable_sockets:
-                    process_socket(w_socket, w_sockets)
+                    # check for new incoming sockets from the queue
 
-                # check for new incoming sockets from the queue
+                    u_socket, mode = socket_queue.pop()
+                    while u_socket:
+                        try:
+                            if mode == "create":
+                                create_connection(u_socket)
+                            elif mode == "reuse":
+                                reuse_connection(u_socket)
+                            else:
+                                discard_socket(u_socket, mode)
+                        except:
+                            discard_socket(u_socket, exc_string())
+                        u_socket, mode = socket_queue.pop()
 
-                u_socket, mode = self._socket_queue.pop(0.0) or (None, None)
-                while u_socket:
-                    try:
-                        if mode == "create":
-                            create_connection(u_socket)
-                        elif mode == "reuse":
-                            reuse_connection(u_socket)
-                        else:
-                            discard_socket(u_socket, mode)
-                    except:
-                        discard_socket(u_socket, exc_string())
-                    u_socket, mode = self._socket_queue.pop(0.0) or (None, None)
+                except:
+                    pmnc.log.error(exc_string()) # log and ignore
 
-            except:
-                pmnc.log.error(exc_string()) # log and ignore
+            # discard the remaining sockets
 
-        # discard the remaining sockets
+            for socket, connection in list(connections.items()): # need to create a copy of connections
+                discard_socket(socket, "interface shutdown")
 
-        for socket, connection in list(connections.items()): # need to create a copy of connections
-            discard_socket(socket, "interface shutdown")
+        finally:
+            selector.close()
 
     ###################################
 
@@ -796,12 +1069,22 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
 
     ###################################
 
-    def _create_static_server_socket(self) -> socket:
+    # the first listening socket is bound without SO_REUSEPORT, so that if
+    # the port is taken, possibly by another cage also using SO_REUSEPORT,
+    # the bind fails rather than silently sharing the port, the option is
+    # turned on after the bind to let the sockets of the other I/O threads
+    # bind to the same port
+
+    def _create_static_server_socket(self, first: bool) -> socket:
 
         server_socket = socket(AF_INET, SOCK_STREAM)
         try:
             server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            if self._reuse_port and not first:
+                server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
             server_socket.bind(self._listener_address)
+            if self._reuse_port and first:
+                server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         except:
             server_socket.close()
             raise
@@ -810,14 +1093,14 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
 
     ###################################
 
-    def _listener_proc(self, started_listening):
+    def _listener_proc(self, started_listening, socket_queues, first):
 
         # bind the socket and start listening
 
         try:
             server_port = self._listener_address[1]
             if server_port >= 0:
-                server_socket = self._create_static_server_socket()
+                server_socket = self._create_static_server_socket(first)
             else:
                 server_socket = self._create_random_server_socket()
             self._listener_address = server_socket.getsockname()
@@ -828,26 +1111,33 @@ class TcpInterface: # called such so as not to be confused with "real" Interface
 
         try:
 
+            selector = DefaultSelector()
+            selector.register(server_socket, EVENT_READ)
+
             started_listening.set()
             pmnc.log.message("started listening for connections at {0[0]:s}:{0[1]:d}".\
                              format(self._listener_address))
 
             # this thread keeps accepting incoming connections and
-            # pushing the new sockets to the i/o thread's queue
+            # pushing the new sockets to the i/o threads' queues in turn
+
+            accepted = 0
 
             while not current_thread().stopped(): # lifetime loop
                 try:
-                    if select([server_socket], [], [], 1.0)[0]:
+                    if selector.select(1.0):
                         client_socket, client_address = server_socket.accept()
                         if pmnc.log.debug:
                             pmnc.log.debug("incoming connection from {0[0]:s}:{0[1]:d}".\
                                            format(client_address))
                         client_socket.setblocking(False)
-                        self._push_socket_wake_io(client_socket, "create")
+                        socket_queues[accepted % len(socket_queues)].push(client_socket, "create")
+                        accepted += 1
                 except:
                     pmnc.log.error(exc_string()) # log and ignore
 
         finally:
+            selector.close()
             server_socket.close()
 
         pmnc.log.message("stopped listening")
@@ -862,6 +1152,12 @@ class TcpResource: # called such so as not to be confused with "real" Resource's
     respects the request timeout and is not blocking.
     """
 
+    # the last TLS session with each server is kept, so that the next connection,
+    # possibly by another instance, can resume it instead of a full handshake
+
+    _ssl_sessions = {}
+    _ssl_sessions_lock = Lock()
+
     @typecheck
     def __init__(self,
                  name: str,
@@ -941,6 +1237,17 @@ class TcpResource: # called such so as not to be confused with "real" Resource's
         return self._ssl_retry("reading data from", pmnc.request,
                                lambda: self._socket.read(n))
 
+    # with TLS 1.3 the session arrives after the handshake, therefore
+    # it is saved again upon disconnect
+
+    def _save_ssl_session(self):
+        ssl_session = self._socket.session
+        if ssl_session is not None:
+            with self._ssl_sessions_lock:
+                self._ssl_sessions[self._ssl_session_key] = (self._socket.context, ssl_session)
+
+    ssl_session_reused = property(lambda self: self._socket.session_reused)
+
     ###################################
 
     def connect(self):
@@ -967,11 +1274,18 @@ class TcpResource: # called such so as not to be confused with "real" Resource's
                 self._socket.settimeout(timeout.remain or 0.01)
                 self._socket.connect(self._server_address)
                 self._socket.setblocking(False)
+                self._socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1) # otherwise the request following an abbreviated
+                                                                     # SSL handshake waits for delayed acknowledgement
 
                 if self._use_ssl: # perform SSL handshake
 
                     self._socket.getpeername() # fixme - remove, see http://bugs.python.org/issue4171
 
+                    self._ssl_session_key = (self._server_address, ssl_server_hostname,
+                                             self._ssl_key_cert_file)
+                    with self._ssl_sessions_lock:
+                        ssl_session = self._ssl_sessions.get(self._ssl_session_key)
+
                     self._tcp_socket = self._socket
                     self._socket = _wrap_socket(self._tcp_socket,
                                                 server_side = False,
@@ -982,12 +1296,14 @@ class TcpResource: # called such so as not to be confused with "real" Resource's
                                                 ssl_protocol = self._ssl_protocol,
                                                 ssl_server_hostname = ssl_server_hostname,
                                                 ssl_ignore_hostname = self._ssl_ignore_hostname,
+                                                ssl_session = ssl_session,
                                                 cert_reqs = CERT_REQUIRED)
                     self._socket.setblocking(False)
 
                     # perform asynchronous handshake within the rest of connect_timeout
 
                     self._ssl_retry("waiting for handshake with", timeout, self._socket.do_handshake)
+                    self._save_ssl_session()
 
                     # extract peer's certificate info, there has to be one, because we use CERT_REQUIRED
 
@@ -1071,6 +1387,8 @@ class TcpResource: # called such so as not to be confused with "real" Resource's
         try:
             if pmnc.log.debug:
                 pmnc.log.debug("disconnecting from {0:s}".format(self._server_info))
+            if self._use_ssl:
+                self._save_ssl_session()
             self._socket.close()
         except:
             pmnc.log.error(exc_string()) # log and ignore
@@ -1079,10 +1397,11 @@ class TcpResource: # called such so as not to be confused with "real" Resource's
 
 def self_test():
 
-    from time import time, sleep
+    from time import time, sleep, process_time
     from random import random, randint
     from threading import Thread
     from os import urandom
+    from hashlib import sha1
     from pmnc.request import fake_request
 
     request_timeout = pmnc.config_interfaces.get("request_timeout")
@@ -1262,6 +1581,324 @@ def self_test():
 
         ###############################
 
+        pmnc.log.message("****************** RESPONSE BUFFERS ******************")
+
+        class BuffersLineEchoParser(LineEchoParser):
+            def produce_buffers(self):
+                data = self._response.getvalue()
+                return [ data[:1], b"", bytearray(data[1:-1]), memoryview(data)[-1:] ]
+
+        def test_response_buffers():
+            ifc = start_interface(BuffersLineEchoParser)
+            try:
+                s = connect_to(ifc)
+                r = s.makefile("rb")
+                for i in range(1, 20):
+                    data = urandom(randint(2 ** (i - 1), 2 ** i)).\
+                           replace(b"\n", b" ").replace(b"\r", b" ").replace(b"\x00", b" ") + b"\n"
+                    s.sendall(data)
+                    resp = r.readline()
+                    assert resp == data
+            finally:
+                ifc.cease(); ifc.stop()
+
+        test_response_buffers()
+
+        # a large response is sent by the handler copying it into a stream
+        # and producing it piecewise vs. by giving out header and content
+
+        class LargeResponseParser(LineEchoParser):
+            _header, _content = b"x" * 100, b"x" * 16777216
+            def process_tcp_request(self):
+                self._response = BytesIO(self._header + self._content)
+            def produce_buffers(self):
+                return [ self._header, self._content ]
+
+        class LargeResponseStreamParser(LargeResponseParser):
+            produce_buffers = None
+
+        def measure_large_response(handler_factory):
+            ifc = start_interface(handler_factory)
+            try:
+                s = connect_to(ifc)
+                try:
+                    b = bytearray(1048576)
+                    cpu_start, start = process_time(), time()
+                    for i in range(8):
+                        s.sendall(b"\n")
+                        n = 16777316
+                        while n > 0:
+                            n -= s.recv_into(b, min(n, len(b)))
+                    cpu, elapsed = process_time() - cpu_start, time() - start
+                    return 128 / elapsed, cpu * 1000 / 128
+                finally:
+                    s.close()
+            finally:
+                ifc.cease(); ifc.stop()
+
+        pmnc.log.message("large response produced piecewise: {0[0]:.0f} MB/s, {0[1]:.01f} CPU ms/MB, "
+                         "given out as buffers: {1[0]:.0f} MB/s, {1[1]:.01f} CPU ms/MB".\
+                         format(measure_large_response(LargeResponseStreamParser),
+                                measure_large_response(LargeResponseParser)))
+
+        ###############################
+
+        pmnc.log.message("****************** LARGE REQUEST ******************")
+
+        # a large request is read in pieces into the connection's buffer,
+        # which grows to fit, vs. each piece being received as new bytes
+
+        class LargeRequestParser(LineEchoParser):
+            allocations, buffers, reads = 0, {}, 0
+            def __init__(self, prev_handler):
+                self._hash = sha1()
+            def consume(self, data):
+                if isinstance(data, memoryview):
+                    self.buffers[id(data.obj)] = data.obj
+                else:
+                    LargeRequestParser.allocations += 1
+                LargeRequestParser.reads += 1
+                self._hash.update(data)
+                return data[-1:] == b"\n"
+            def process_tcp_request(self):
+                self._response = BytesIO(self._hash.hexdigest().encode("ascii") + b"\n")
+
+        large_request = urandom(16777215).replace(b"\n", b" ") + b"\n"
+        large_request_hash = sha1(large_request).hexdigest().encode("ascii") + b"\n"
+
+        def measure_large_request():
+            LargeRequestParser.allocations, LargeRequestParser.reads = 0, 0
+            LargeRequestParser.buffers.clear()
+            ifc = start_interface(LargeRequestParser)
+            try:
+                s = connect_to(ifc)
+                try:
+                    r = s.makefile("rb")
+                    cpu_start, start = process_time(), time()
+                    for i in range(4):
+                        s.sendall(large_request)
+                        assert r.readline() == large_request_hash
+                    cpu, elapsed = process_time() - cpu_start, time() - start
+                    return 64 / elapsed, cpu * 1000 / 64, LargeRequestParser.reads, \
+                           LargeRequestParser.allocations + len(LargeRequestParser.buffers)
+                finally:
+                    s.close()
+            finally:
+                ifc.cease(); ifc.stop()
+
+        if not ssl_key_cert_file: # SSL connection does not accept that much data at once
+
+            recv_into = TcpConnection._recv
+            TcpConnection._recv = lambda self: (self._socket.recv(16384), "read")
+            try:
+                recv = measure_large_request()
+            finally:
+                TcpConnection._recv = recv_into
+
+            pmnc.log.message("large request received as new bytes: {0[0]:.0f} MB/s, {0[1]:.01f} CPU ms/MB, "
+                             "{0[2]:d} read(s), {0[3]:d} allocation(s), into the buffer: {1[0]:.0f} MB/s, "
+                             "{1[1]:.01f} CPU ms/MB, {1[2]:d} read(s), {1[3]:d} allocation(s)".\
+                             format(recv, measure_large_request()))
+
+        ###############################
+
+        pmnc.log.message("****************** MANY IDLE CONNECTIONS ******************")
+
+        def test_many_idle_connections():
+
+            try:
+                from resource import getrlimit, RLIMIT_NOFILE
+            except ImportError: # not on Windows
+                return
+            n = min(10000, (getrlimit(RLIMIT_NOFILE)[0] - 1000) // 2) # each connection takes two descriptors here
+            if n <= 1024:
+                return
+
+            ifc = TcpInterface("test", LineEchoParser, 60.0, listener_address = ("127.0.0.1", 0),
+                               max_connections = n + 1, ssl_key_cert_file = None, ssl_ca_cert_file = None,
+                               ssl_ciphers = None, ssl_protocol = None)
+            ifc.start()
+            try:
+
+                ss = []
+                try:
+
+                    start = time()
+                    for i in range(n):
+                        s = socket(AF_INET, SOCK_STREAM)
+                        ss.append(s)
+                        s.connect(ifc.listener_address)
+                    pmnc.log.message("{0:d} connections established in {1:.01f} second(s)".\
+                                     format(n, time() - start))
+
+                    # the descriptors of the most recent connections are beyond FD_SETSIZE
+
+                    s = socket(AF_INET, SOCK_STREAM)
+                    ss.append(s)
+                    s.connect(ifc.listener_address)
+                    assert s.fileno() > 1024
+                    r = s.makefile("rb")
+
+                    sleep(3.0) # let the I/O thread register all the connections
+
+                    cpu_start, start = process_time(), time()
+                    sleep(5.0)
+                    cpu_idle = (process_time() - cpu_start) / (time() - start)
+
+                    start = time()
+                    for i in range(100):
+                        s.sendall(b"foo\n")
+                        assert r.readline() == b"foo\n"
+                    round_trip = (time() - start) / 100
+
+                    pmnc.log.message("with {0:d} idle connections the cage uses {1:.01f}% CPU, "
+                                     "request round trip takes {2:.01f} ms".\
+                                     format(n, cpu_idle * 100, round_trip * 1000))
+
+                    # the idle connections are all still there
+
+                    for s in ss[:-1]:
+                        s.setblocking(False)
+                        try:
+                            s.recv(1)
+                        except BlockingIOError:
+                            pass
+                        else:
+                            assert False, "idle connection dropped"
+
+                finally:
+                    for s in ss:
+                        s.close()
+
+            finally:
+                ifc.cease(); ifc.stop()
+
+        if not ssl_key_cert_file:
+            test_many_idle_connections()
+
+        ###############################
+
+        pmnc.log.message("****************** MULTIPLE I/O THREADS ******************")
+
+        class IoThreadLineEchoParser(LineEchoParser):
+            io_threads = set()
+            def consume(self, data):
+                self.io_threads.add(current_thread().name)
+                return LineEchoParser.consume(self, data)
+
+        def test_io_threads(listener_address):
+            IoThreadLineEchoParser.io_threads.clear()
+            ifc = start_interface(IoThreadLineEchoParser, listener_address = listener_address,
+                                  max_connections = 30, io_threads = 3)
+            try:
+                ss = [ connect_to(ifc) for i in range(30) ]
+                try:
+                    for s in ss:
+                        s.sendall(b"foo\n")
+                        assert s.makefile("rb").readline() == b"foo\n"
+                    assert peer_drops_connection(connect_to(ifc), 1.0) # the limit is shared by the I/O threads
+                finally:
+                    for s in ss:
+                        s.close()
+            finally:
+                ifc.cease(); ifc.stop()
+            return IoThreadLineEchoParser.io_threads
+
+        io_threads = test_io_threads(("127.0.0.1", 0)) # listeners share the port
+        assert len(io_threads) > 1 and io_threads <= { "test:i/o:0", "test:i/o:1", "test:i/o:2" }
+
+        io_threads = test_io_threads(("127.0.0.1", -54300)) # single listener
+        assert io_threads == { "test:i/o:0", "test:i/o:1", "test:i/o:2" }
+
+        def test_io_threads_port_in_use():
+            ifc = start_interface(LineEchoParser, io_threads = 3)
+            try:
+                try:
+                    ifc2 = start_interface(LineEchoParser, listener_address = ifc.listener_address, io_threads = 3)
+                except Exception as e:
+                    assert str(e) == "failed to start listening"
+                else:
+                    ifc2.cease(); ifc2.stop()
+                    assert False, "the port should not have been shared"
+            finally:
+                ifc.cease(); ifc.stop()
+
+        test_io_threads_port_in_use()
+
+        def measure_io_threads(io_threads):
+            ifc = start_interface(LineEchoParser, max_connections = 20, io_threads = io_threads)
+            try:
+                def th_proc():
+                    s = connect_to(ifc)
+                    try:
+                        r = s.makefile("rb")
+                        for i in range(100):
+                            s.sendall(b"x" * 1000 + b"\n")
+                            assert r.readline() == b"x" * 1000 + b"\n"
+                    finally:
+                        s.close()
+                ths = [ Thread(target = th_proc) for i in range(20) ]
+                start = time()
+                for th in ths: th.start()
+                for th in ths: th.join()
+                return 2000 / (time() - start)
+            finally:
+                ifc.cease(); ifc.stop()
+
+        pmnc.log.message("{0:.0f} request(s)/s with 1 I/O thread, {1:.0f} request(s)/s with 4 I/O threads".\
+                         format(measure_io_threads(1), measure_io_threads(4)))
+
+        ###############################
+
+        pmnc.log.message("****************** BACKPRESSURE ******************")
+
+        class SlowCountingLineEchoParser(LineEchoParser):
+            parsed = 0
+            def consume(self, data):
+                if LineEchoParser.consume(self, data):
+                    SlowCountingLineEchoParser.parsed += 1
+                    return True
+            def process_tcp_request(self):
+                sleep(1.0)
+                LineEchoParser.process_tcp_request(self)
+
+        def test_backpressure(max_queued_requests):
+            thread_count = pmnc.config_interfaces.get("thread_count")
+            SlowCountingLineEchoParser.parsed = 0
+            ifc = start_interface(SlowCountingLineEchoParser, max_connections = thread_count * 4,
+                                  max_queued_requests = max_queued_requests)
+            try:
+                ss = [ connect_to(ifc) for i in range(thread_count * 4) ]
+                try:
+                    for s in ss:
+                        s.sendall(b"foo\n")
+                    sleep(0.5)
+                    parsed = SlowCountingLineEchoParser.parsed # while the first requests are processed
+                    start = time()
+                    for s in ss:
+                        assert s.makefile("rb").readline() == b"foo\n"
+                    assert SlowCountingLineEchoParser.parsed == thread_count * 4 # reading has resumed
+                    return parsed, time() - start
+                finally:
+                    for s in ss:
+                        s.close()
+            finally:
+                ifc.cease(); ifc.stop()
+
+        thread_count = pmnc.config_interfaces.get("thread_count")
+
+        parsed, elapsed = test_backpressure(1000)
+        assert parsed == thread_count * 4
+        pmnc.log.message("without backpressure {0:d} request(s) are parsed at once, "
+                         "all processed in {1:.01f} second(s)".format(parsed, elapsed))
+
+        parsed, elapsed = test_backpressure(4)
+        assert thread_count <= parsed <= thread_count + 4
+        pmnc.log.message("with backpressure {0:d} request(s) are parsed at once, "
+                         "all processed in {1:.01f} second(s)".format(parsed, elapsed))
+
+        ###############################
+
         pmnc.log.message("****************** LOOPBACK CONNECTION FAILURE TEST ******************")
 
         def test_loopback_connection_failure():
@@ -1390,6 +2027,81 @@ def self_test():
 
         ###############################
 
+        pmnc.log.message("****************** SSL CONTEXTS AND SESSIONS ******************")
+
+        def test_ssl_context_cache():
+
+            ssl_context = _ssl_context(ssl_protocol, ssl_ciphers, ssl_key_cert_file,
+                                       ssl_ca_cert_file, CERT_REQUIRED, False)
+            assert _ssl_context(ssl_protocol, ssl_ciphers, ssl_key_cert_file,
+                                ssl_ca_cert_file, CERT_REQUIRED, False) is ssl_context
+            assert _ssl_context(ssl_protocol, ssl_ciphers, None,
+                                ssl_ca_cert_file, CERT_REQUIRED, False) is not ssl_context
+
+            st = os.stat(ssl_ca_cert_file) # the context is reloaded when a file changes
+            os.utime(ssl_ca_cert_file, (st.st_atime, st.st_mtime + 1.0))
+            try:
+                ssl_context2 = _ssl_context(ssl_protocol, ssl_ciphers, ssl_key_cert_file,
+                                            ssl_ca_cert_file, CERT_REQUIRED, False)
+                assert ssl_context2 is not ssl_context
+                assert _ssl_context(ssl_protocol, ssl_ciphers, ssl_key_cert_file,
+                                    ssl_ca_cert_file, CERT_REQUIRED, False) is ssl_context2
+            finally:
+                os.utime(ssl_ca_cert_file, (st.st_atime, st.st_mtime))
+
+        def test_ssl_session_reuse():
+
+            ifc = start_interface(LineEchoParser)
+            try:
+
+                fake_request(30.0)
+
+                def connect_once():
+                    r = pmnc.protocol_tcp.TcpResource("tres", server_address = ifc.listener_address,
+                                                      connect_timeout = 3.0,
+                                                      ssl_key_cert_file = ifc._ssl_key_cert_file,
+                                                      ssl_ca_cert_file = ifc._ssl_ca_cert_file,
+                                                      ssl_ciphers = ifc._ssl_ciphers,
+                                                      ssl_protocol = ifc._ssl_protocol,
+                                                      ssl_server_hostname = None,
+                                                      ssl_ignore_hostname = True)
+                    r.connect()
+                    try:
+                        assert r.send_request(b"foo\n", lambda b: b.endswith(b"\n") and b or None) == b"foo\n"
+                        return r.ssl_session_reused
+                    finally:
+                        r.disconnect()
+
+                TcpResource._ssl_sessions.clear()
+                assert not connect_once()
+                assert connect_once() # the next connection resumes the session
+                assert connect_once()
+
+                def measure_handshakes(reuse_contexts, reuse_sessions):
+                    start = time()
+                    for i in range(50):
+                        if not reuse_contexts:
+                            with _ssl_contexts_lock:
+                                _ssl_contexts.clear()
+                        if not reuse_sessions:
+                            TcpResource._ssl_sessions.clear()
+                        connect_once()
+                    return 50 / (time() - start)
+
+                pmnc.log.message("{0:.0f} handshake(s)/s with new contexts, {1:.0f} handshake(s)/s with "
+                                 "cached contexts, {2:.0f} handshake(s)/s with resumed sessions".\
+                                 format(measure_handshakes(False, False), measure_handshakes(True, False),
+                                        measure_handshakes(True, True)))
+
+            finally:
+                ifc.cease(); ifc.stop()
+
+        if ssl_key_cert_file:
+            test_ssl_context_cache()
+            test_ssl_session_reuse()
+
+        ###############################
+
         pmnc.log.message("****************** LOOPBACK INCOMPATIBLE PROTOCOLS ******************")
 
         def test_loopback_protocols():
@@ -12,6 +12,8 @@
 # request_timeout = None,                                    # meta, optional
 # listener_address = ("127.0.0.1", 8000),                    # tcp
 # max_connections = 100,                                     # tcp
+# io_threads = 1,                                            # tcp, optional, I/O threads
+# max_queued_requests = None,                                # tcp, optional, stop reading above, 2 * thread_count by default
 # ssl_key_cert_file = None,                                  # ssl, optional filename
 # ssl_ca_cert_file = None,                                   # ssl, optional filename
 # ssl_ciphers = None,                                        # ssl, optional str
@@ -103,6 +105,8 @@ class Interface: # XMLRPC interface built on top of HTTP interface
                  keep_alive_idle_timeout: float,
                  keep_alive_max_requests: int,
                  request_timeout: optional(float) = None,
+                 io_threads: optional(int) = None,
+                 max_queued_requests: optional(int) = None,
                  allow_none: optional(bool) = False,
                  **kwargs): # this kwargs allows for extra application-specific
                             # settings in config_interface_xmlrpc_X.py
@@ -127,7 +131,9 @@ class Interface: # XMLRPC interface built on top of HTTP interface
                                          keep_alive_idle_timeout = keep_alive_idle_timeout,
                                          keep_alive_max_requests = keep_alive_max_requests,
                                          gzip_content_types = (),
-                                         request_timeout = request_timeout)
+                                         request_timeout = request_timeout,
+                                         io_threads = io_threads,
+                                         max_queued_requests = max_queued_requests)
 
         # override the default process_http_request method of the created HTTP interface,
         # having the HTTP handler method to be called through a pmnc call allows
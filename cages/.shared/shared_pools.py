@@ -6,18 +6,69 @@
 # grouped in pairs) and used by the transaction machinery and other modules
 # that need them a private thread pool for something.
 #
+# Resource caches can be made to survive cage restarts, for that the resource
+# configuration file should contain
+#
+# >> pool__cache_snapshot_period = N.N,
+#
+# in which case the contents of the cache are saved to cache/resource_name.snapshot
+# file in the cage directory every N.N seconds and upon cage shutdown, and the
+# unexpired entries are restored from it when the resource pool is first used.
+# The snapshot is stamped with the digest of the resource configuration and is
+# discarded should the configuration change.
+#
+# A resource which is down can be cut off by a circuit breaker, so that the
+# transactions fail instantly instead of waiting for connect timeouts while
+# occupying the resource threads. For that the resource configuration file
+# should contain
+#
+# >> pool__breaker_failures = N,
+#
+# in which case the breaker opens after N consecutive failed participations,
+# and optionally
+#
+# >> pool__breaker_failure_rate = 0.N,
+#
+# in which case it also opens whenever such share of the most recent
+# participations has failed. While the breaker is open, the transactions
+# fail with recoverable ResourceError without touching the resource, unless
+# the result is found in the resource cache. Cached results do not count as
+# participations either way. After
+#
+# >> pool__breaker_timeout = N.N, # 10.0 seconds by default
+#
+# the breaker becomes half-open and lets a single probe through, which closes
+# it back upon success or reopens it for another timeout upon failure.
+#
+# A resource can execute concurrent transactions in batches (see transaction.py),
+# for that the resource configuration file should contain
+#
+# >> pool__batch_linger = N.N,
+#
+# in which case the participants of the transactions created with batch = True
+# wait for up to N.N seconds for other such participants to join the batch, and
+#
+# >> pool__batch_size = N, # 100 by default
+#
+# limits the number of participants in a batch.
+#
 # Pythomnic3k project
 # (c) 2005-2015, Dmitry Dvoinikov <dmitry@targeted.org>
 # Distributed under BSD license
 #
 ################################################################################
 
-__all__ = [ "get_thread_pool", "get_resource_pool", "get_private_thread_pool" ]
+__all__ = [ "get_thread_pool", "get_resource_pool", "get_private_thread_pool",
+            "get_circuit_breaker", "get_breaker_stats", "get_batching", "get_pool_stats" ]
 __reloadable__ = False
 
 ################################################################################
 
 import threading; from threading import Lock
+import os; from os import path as os_path, mkdir
+import errno; from errno import EEXIST
+import hashlib; from hashlib import md5
+import collections; from collections import deque
 
 if __name__ == "__main__": # add pythomnic/lib to sys.path
     import os; import sys
@@ -25,6 +76,8 @@ if __name__ == "__main__": # add pythomnic/lib to sys.path
     sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..", "..", "lib")))
 
 import typecheck; from typecheck import typecheck, optional, callable
+import exc_string; from exc_string import exc_string
+import pmnc.timeout; from pmnc.timeout import Timeout
 import pmnc.thread_pool; from pmnc.thread_pool import ThreadPool
 import pmnc.resource_pool; from pmnc.resource_pool import TransactionalResource, RegisteredResourcePool
 import pmnc.resource_pool_cache; from pmnc.resource_pool_cache import ResourcePoolReadWriteCache
@@ -49,6 +102,7 @@ class ResourceFactory: # callable factory object
         # load the configuration file
 
         self._config, self._config_version = self._get_config()
+        config_stamp = _config_stamp(self._config)
 
         # pool size for a resource is a static setting and is by default
         # equal to the number of the interfaces worker threads
@@ -67,14 +121,31 @@ class ResourceFactory: # callable factory object
         self._pool_cache_default_ttl = self._config.pop("pool__cache_default_ttl", None)
         self._pool_cache_evict_period = self._config.pop("pool__cache_evict_period", None)
         self._pool_cache_group_interval = self._config.pop("pool__cache_group_interval", None)
+        self._pool_cache_stale_ttl = self._config.pop("pool__cache_stale_ttl", None)
+        self._pool_cache_refresh_ahead = self._config.pop("pool__cache_refresh_ahead", None)
+        self._pool_cache_snapshot_period = self._config.pop("pool__cache_snapshot_period", None)
 
         if self._pool_cache_size:
+            if self._pool_cache_snapshot_period is not None:
+                snapshot_file = _cache_snapshot_file(resource_name)
+                snapshot_stamp = config_stamp
+            else:
+                snapshot_file = snapshot_stamp = None
             self._pool_cache = ResourcePoolReadWriteCache(resource_name,
                                             size = self._pool_cache_size,
                                             policy = self._pool_cache_policy,
                                             default_ttl = self._pool_cache_default_ttl,
                                             evict_period = self._pool_cache_evict_period,
-                                            group_interval = self._pool_cache_group_interval)
+                                            group_interval = self._pool_cache_group_interval,
+                                            stale_ttl = self._pool_cache_stale_ttl,
+                                            refresh_ahead = self._pool_cache_refresh_ahead,
+                                            snapshot_file = snapshot_file,
+                                            snapshot_stamp = snapshot_stamp,
+                                            snapshot_period = self._pool_cache_snapshot_period,
+                                            snapshot_failed = self._cache_snapshot_failed,
+                                            refresh_timeout = pmnc.config_interfaces.get("request_timeout"))
+            if snapshot_file:
+                self._load_cache_snapshot()
         else:
             self._pool_cache = None
 
@@ -85,9 +156,58 @@ class ResourceFactory: # callable factory object
         self._pool_min_time = self._config.pop("pool__min_time", None)
         self._pool_max_time = self._config.pop("pool__max_time", None)
 
+        # circuit breaker settings are optional
+
+        self._pool_breaker_failures = self._config.pop("pool__breaker_failures", None)
+        self._pool_breaker_failure_rate = self._config.pop("pool__breaker_failure_rate", None)
+        self._pool_breaker_timeout = self._config.pop("pool__breaker_timeout", 10.0)
+
+        if self._pool_breaker_failures:
+            self._circuit_breaker = CircuitBreaker(resource_name,
+                                                   failures = self._pool_breaker_failures,
+                                                   failure_rate = self._pool_breaker_failure_rate,
+                                                   timeout = self._pool_breaker_timeout)
+        else:
+            self._circuit_breaker = None
+
+        # batching settings are optional
+
+        self._pool_batch_linger = self._config.pop("pool__batch_linger", None)
+        self._pool_batch_size = self._config.pop("pool__batch_size", 100)
+
+        if self._pool_batch_linger is not None: # pool__batch_linger = 1 is just as good
+            self._pool_batch_linger = float(self._pool_batch_linger)
+
     pool_size = property(lambda self: self._pool_size)
     pool_standby = property(lambda self: self._pool_standby)
     pool_cache = property(lambda self: self._pool_cache)
+    circuit_breaker = property(lambda self: self._circuit_breaker)
+    batching = property(lambda self: (self._pool_batch_linger, self._pool_batch_size)
+                                     if self._pool_batch_linger is not None else None)
+
+    # the cache is warmed up from the snapshot saved before the previous
+    # cage shutdown, failure to do so is not fatal and the cache starts empty
+
+    def _load_cache_snapshot(self):
+
+        try:
+            restored = self._pool_cache.load_snapshot()
+        except:
+            pmnc.log.warning("cache snapshot for resource {0:s} could not be loaded: "
+                             "{1:s}".format(self._resource_name, exc_string()))
+        else:
+            if restored is None:
+                pmnc.log.warning("cache snapshot for resource {0:s} has been discarded "
+                                 "because of configuration change".format(self._resource_name))
+            elif pmnc.log.noise:
+                pmnc.log.noise("{0:d} cached value(s) for resource {1:s} have been restored "
+                               "from snapshot".format(restored, self._resource_name))
+
+    # failure to save the snapshot is not fatal either, but the next startup has nothing to restore
+
+    def _cache_snapshot_failed(self, error):
+        pmnc.log.warning("cache snapshot for resource {0:s} could not be saved: "
+                         "{1:s}".format(self._resource_name, error))
 
     @typecheck
     def __call__(self, resource_instance_name: str) -> TransactionalResource:
@@ -118,19 +238,40 @@ class ResourceFactory: # callable factory object
             pool_cache_default_ttl = config.pop("pool__cache_default_ttl", None)
             pool_cache_evict_period = config.pop("pool__cache_evict_period", None)
             pool_cache_group_interval = config.pop("pool__cache_group_interval", None)
+            pool_cache_stale_ttl = config.pop("pool__cache_stale_ttl", None)
+            pool_cache_refresh_ahead = config.pop("pool__cache_refresh_ahead", None)
+            pool_cache_snapshot_period = config.pop("pool__cache_snapshot_period", None)
 
             if self._pool_cache:
                 if pool_cache_size != self._pool_cache_size or \
                    pool_cache_policy != self._pool_cache_policy or \
                    pool_cache_default_ttl != self._pool_cache_default_ttl or \
                    pool_cache_evict_period != self._pool_cache_evict_period or \
-                   pool_cache_group_interval != self._pool_cache_group_interval:
+                   pool_cache_group_interval != self._pool_cache_group_interval or \
+                   pool_cache_stale_ttl != self._pool_cache_stale_ttl or \
+                   pool_cache_refresh_ahead != self._pool_cache_refresh_ahead or \
+                   pool_cache_snapshot_period != self._pool_cache_snapshot_period:
                     pmnc.log.warning("change in cache settings for resource {0:s} at "
                                      "runtime has no effect".format(self._resource_name))
             elif pool_cache_size:
                 pmnc.log.warning("caching for resource {0:s} cannot be "
                                  "enabled at runtime".format(self._resource_name))
 
+            # circuit breaker settings cannot be changed at runtime
+
+            if config.pop("pool__breaker_failures", None) != self._pool_breaker_failures or \
+               config.pop("pool__breaker_failure_rate", None) != self._pool_breaker_failure_rate or \
+               config.pop("pool__breaker_timeout", 10.0) != self._pool_breaker_timeout:
+                pmnc.log.warning("change in circuit breaker settings for resource {0:s} at "
+                                 "runtime has no effect".format(self._resource_name))
+
+            # batching settings cannot be changed at runtime
+
+            if config.pop("pool__batch_linger", None) != self._pool_batch_linger or \
+               config.pop("pool__batch_size", 100) != self._pool_batch_size:
+                pmnc.log.warning("change in batching settings for resource {0:s} at "
+                                 "runtime has no effect".format(self._resource_name))
+
             # instance adjustment settings can be changed at runtime
 
             self._pool_idle_timeout = config.pop("pool__idle_timeout", None)
@@ -193,12 +334,176 @@ class ResourceFactory: # callable factory object
 
         return config, module_properties["version"]
 
+###############################################################################
+# circuit breaker tracks the outcomes of the participations of a resource
+# in transactions, and once it opens, the participants are failed instantly
+
+class CircuitBreaker:
+
+    _window = 20 # the number of the most recent outcomes to calculate the failure rate
+
+    @typecheck
+    def __init__(self, resource_name: str, *,
+                 failures: int,
+                 failure_rate: optional(float) = None,
+                 timeout: float):
+
+        self._resource_name = resource_name
+        self._failures = failures
+        self._failure_rate = failure_rate
+        self._timeout = timeout
+
+        self._lock = Lock()
+        self._state = "closed"
+        self._consecutive_failures = 0
+        self._outcomes = deque(maxlen = self._window)
+        self._open_timeout = None  # expires when the open breaker becomes half-open
+        self._probe_timeout = None # expires when the probe is presumed lost
+
+    name = property(lambda self: self._resource_name)
+
+    # the breaker state is one of "closed", "open" and "half-open"
+
+    def _get_state(self):
+        with self._lock:
+            if self._state == "open" and self._open_timeout.expired:
+                self._state = "half-open"
+            return self._state
+
+    state = property(_get_state)
+
+    # this method is called before each participation and
+    # returns False if the participant should fail instantly
+
+    def allow(self) -> bool:
+
+        with self._lock:
+
+            if self._state == "closed":
+                return True
+
+            if self._state == "open":
+                if not self._open_timeout.expired:
+                    return False
+                self._state = "half-open"
+
+            # only one probe at a time is let through the half-open breaker,
+            # unless the previous one has not reported back for too long
+
+            if self._probe_timeout is None or self._probe_timeout.expired:
+                self._probe_timeout = Timeout(self._timeout)
+                probing = True
+            else:
+                probing = False
+
+        if probing and pmnc.log.noise:
+            pmnc.log.noise("circuit breaker for resource {0:s} lets a probe "
+                           "through".format(self._resource_name))
+
+        return probing
+
+    # this method is called after each allowed participation to register its outcome
+
+    @typecheck
+    def register(self, success: bool):
+
+        with self._lock:
+
+            self._outcomes.append(success)
+            prev_state = self._state
+
+            if success:
+                self._consecutive_failures = 0
+                if self._state != "closed":
+                    self._state = "closed"
+                    self._probe_timeout = None
+                    self._outcomes.clear() # the failures before the recovery do not count
+            else:
+                self._consecutive_failures += 1
+                if self._state == "half-open" or \
+                   (self._state == "closed" and self._tripped()):
+                    self._state = "open"
+                    self._open_timeout = Timeout(self._timeout)
+                    self._probe_timeout = None
+
+            state = self._state
+
+        if state == "open" and prev_state != "open":
+            pmnc.log.warning("circuit breaker for resource {0:s} is open for {1:.01f} "
+                             "second(s)".format(self._resource_name, self._timeout))
+        elif state == "closed" and prev_state != "closed":
+            pmnc.log.message("circuit breaker for resource {0:s} is closed".\
+                             format(self._resource_name))
+
+    def _tripped(self):
+
+        if self._consecutive_failures >= self._failures:
+            return True
+
+        if self._failure_rate is not None and len(self._outcomes) == self._window:
+            return self._outcomes.count(False) >= self._failure_rate * self._window
+
+        return False
+
+    # this method returns the current state and statistics for display
+
+    def get_stats(self) -> (str, int, float):
+
+        state = self.state
+        with self._lock:
+            outcomes = len(self._outcomes)
+            failure_rate = outcomes and self._outcomes.count(False) / outcomes or 0.0
+            return state, self._consecutive_failures, failure_rate
+
+###############################################################################
+# cache snapshots are kept in a separate directory, one file per resource
+
+@typecheck
+def _cache_snapshot_file(resource_name: str) -> str:
+
+    cache_dir = os_path.join(__cage_dir__, "cache")
+    if not os_path.isdir(cache_dir):
+        try:
+            mkdir(cache_dir)
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+
+    return os_path.join(cache_dir, "{0:s}.snapshot".format(resource_name))
+
+###############################################################################
+# a snapshot is only valid for the configuration it has been saved with,
+# and the module version cannot be used since it restarts with the cage,
+# only the cache settings and the resource parameters that are literals
+# count, because the repr of a function or an object differs from run to
+# run, and so does the repr of a set, its order depends on string hashing
+
+def _literal(value) -> bool:
+
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        return True
+    elif isinstance(value, (tuple, list)):
+        return all(_literal(v) for v in value)
+    elif isinstance(value, dict):
+        return all(_literal(k) and _literal(v) for k, v in value.items())
+    else:
+        return False
+
+@typecheck
+def _config_stamp(config: dict) -> str:
+
+    config = sorted((k, repr(v)) for k, v in config.items()
+                    if (k.startswith("pool__cache_") or not k.startswith("pool__")) and
+                       k != "pool__cache_snapshot_period" and _literal(v))
+    return md5(repr(config).encode("utf-8")).hexdigest()
+
 ###############################################################################
 # this method returns (creating if necessary) a pair of a thread pool and
 # resource pool for the specified resource
 
 @typecheck
-def _get_pools(resource_name: str) -> (ThreadPool, RegisteredResourcePool):
+def _get_pools(resource_name: str) -> (ThreadPool, RegisteredResourcePool,
+                                       optional(CircuitBreaker), optional((float, int))):
 
     pool_name = resource_name
 
@@ -222,7 +527,8 @@ def _get_pools(resource_name: str) -> (ThreadPool, RegisteredResourcePool):
                                                    resource_factory.pool_standby,
                                                    resource_factory.pool_cache)
 
-            _combined_pools[pool_name] = (thread_pool, resource_pool)
+            _combined_pools[pool_name] = (thread_pool, resource_pool, resource_factory.circuit_breaker,
+                                          resource_factory.batching)
 
         return _combined_pools[pool_name]
 
@@ -238,6 +544,45 @@ def get_resource_pool(resource_name: str) -> RegisteredResourcePool:
 
 ###############################################################################
 
+def get_circuit_breaker(resource_name: str) -> optional(CircuitBreaker):
+    return _get_pools(resource_name)[2]
+
+###############################################################################
+# this method returns (linger, size) for the resources configured for batching, None otherwise
+
+def get_batching(resource_name: str) -> optional((float, int)):
+    return _get_pools(resource_name)[3]
+
+###############################################################################
+# this method returns the states of the circuit breakers of the resources
+# that have been used so far, as resource name -> (state, consecutive
+# failures, recent failure rate)
+
+def get_breaker_stats() -> dict:
+
+    with _pools_lock:
+        circuit_breakers = [ circuit_breaker for _, _, circuit_breaker, _ in _combined_pools.values()
+                             if circuit_breaker is not None ]
+
+    return { circuit_breaker.name: circuit_breaker.get_stats()
+             for circuit_breaker in circuit_breakers }
+
+###############################################################################
+# this method returns the utilization of the pools of the resources that
+# have been used so far, as resource name -> (busy threads, free threads,
+# queued work units, busy resource instances, free resource instances)
+
+def get_pool_stats() -> dict:
+
+    with _pools_lock:
+        pools = [ (thread_pool, resource_pool) for thread_pool, resource_pool, _, _ in _combined_pools.values() ]
+
+    return { thread_pool.name: (thread_pool.busy, thread_pool.free, thread_pool.over,
+                                resource_pool.busy, resource_pool.free)
+             for thread_pool, resource_pool in pools }
+
+###############################################################################
+
 def get_private_thread_pool(pool_name: optional(str) = None,
                             pool_size: optional(int) = None,
                             *, __source_module_name) -> ThreadPool:
@@ -282,6 +627,11 @@ def self_test():
         assert r.pool_name == "void" and r.pool_size == 3
         rp1.release(r)
 
+        pool_stats = pmnc.shared_pools.get_pool_stats()
+        assert list(pool_stats.keys()) == [ "void" ]
+        assert pool_stats["void"][:3] == (0, 0, 0)
+        assert pool_stats["void"][3] + pool_stats["void"][4] >= 1 # warmup may be connecting instances
+
     test_pools()
 
     ###################################
@@ -314,6 +664,95 @@ def self_test():
 
     ###################################
 
+    def test_config_stamp():
+
+        stamp = _config_stamp(dict(a = 1, b = "2"))
+        assert stamp == _config_stamp(dict(b = "2", a = 1))
+        assert stamp == _config_stamp(dict(a = 1, b = "2", pool__cache_snapshot_period = 60.0))
+        assert stamp != _config_stamp(dict(a = 1, b = 2))
+        assert stamp != _config_stamp(dict(a = 1, b = "2", c = None))
+        assert stamp != _config_stamp(dict(a = 1, b = "2", pool__cache_size = 10))
+
+        # the values that differ from run to run and the other pool settings do not count
+
+        assert stamp == _config_stamp(dict(a = 1, b = "2", c = lambda: None, d = object()))
+        assert stamp == _config_stamp(dict(a = 1, b = "2", c = [ 1, { "d": lambda: None } ]))
+        assert stamp == _config_stamp(dict(a = 1, b = "2", c = { "d", "e" }))
+        assert stamp == _config_stamp(dict(a = 1, b = "2", pool__size = 10, pool__max_time = 1.0))
+        assert stamp != _config_stamp(dict(a = 1, b = "2", c = [ 1, { "d": (None, b"e") } ]))
+
+        snapshot_file = _cache_snapshot_file("void")
+        assert snapshot_file == os_path.join(__cage_dir__, "cache", "void.snapshot")
+        assert os_path.isdir(os_path.dirname(snapshot_file))
+
+    test_config_stamp()
+
+    ###################################
+
+    def test_circuit_breaker():
+
+        assert pmnc.shared_pools.get_circuit_breaker("void") is None
+        assert pmnc.shared_pools.get_breaker_stats() == {}
+        assert pmnc.shared_pools.get_batching("void") is None
+
+        # consecutive failures
+
+        cb = CircuitBreaker("foo", failures = 3, timeout = 1.0)
+        assert cb.state == "closed" and cb.allow()
+
+        cb.register(False); cb.register(False); cb.register(True)
+        cb.register(False); cb.register(False)
+        assert cb.state == "closed" and cb.allow()
+        assert cb.get_stats() == ("closed", 2, 0.8)
+
+        cb.register(False)
+        assert cb.state == "open" and not cb.allow()
+        assert cb.get_stats()[:2] == ("open", 3)
+
+        # half-open breaker lets a single probe through
+
+        sleep(1.1)
+        assert cb.state == "half-open"
+        assert cb.allow()
+        assert not cb.allow()
+
+        cb.register(False) # the probe fails
+        assert cb.state == "open" and not cb.allow()
+
+        sleep(1.1)
+        assert cb.allow()
+        assert not cb.allow()
+        cb.register(True) # the probe succeeds
+        assert cb.state == "closed" and cb.allow()
+        assert cb.get_stats() == ("closed", 0, 0.0)
+
+        # lost probe is replaced after a timeout
+
+        for i in range(3):
+            cb.register(False)
+        sleep(1.1)
+        assert cb.allow()
+        assert not cb.allow()
+        sleep(1.1)
+        assert cb.allow()
+        cb.register(True)
+        assert cb.state == "closed"
+
+        # failure rate
+
+        cb = CircuitBreaker("bar", failures = 100, failure_rate = 0.5, timeout = 1.0)
+
+        for i in range(CircuitBreaker._window - 1):
+            cb.register(i % 2 == 0)
+        assert cb.state == "closed" # not enough outcomes yet
+
+        cb.register(False)
+        assert cb.state == "open"
+
+    test_circuit_breaker()
+
+    ###################################
+
 if __name__ == "__main__": import pmnc.self_test; pmnc.self_test.run()
 
 ###############################################################################
@@ -24,9 +24,14 @@ _stop = Event()
 
 ###############################################################################
 
-def _update_log_level(): # pick up log_level from config_interfaces.py
+def _update_log_level(): # pick up the logging settings from config_interfaces.py
     try:
         pmnc._loader.set_log_level(pmnc.config_interfaces.get("log_level", "LOG"))
+        pmnc._loader.set_log_limits(pmnc.config_interfaces.get("log_repeat_limits") or {})
+        if not pmnc._loader.set_log_overflow(pmnc.config_interfaces.get("log_overflow", "block")):
+            pmnc.log.debug("log overflow policy is not supported by the log function")
+        if not pmnc._loader.set_log_format(pmnc.config_interfaces.get("log_format", "text")):
+            pmnc.log.debug("log format is not supported by the log function")
     except:
         pmnc.log.error(exc_string()) # log and ignore
 
@@ -30,6 +30,9 @@
 # xa.db_resource.execute("SELECT ...")
 # db_result = xa.execute()[0]
 #
+# except that such transaction is executed in the calling thread whenever
+# the resource thread pool is not saturated, thus saving thread switching.
+#
 # Not all of the resources may support "true" transactions, for instance
 # in the above examples, sending HTTP request is irreversible and not really
 # transaction-capable. Anyway, for uniformity access to all resources is
@@ -124,6 +127,67 @@
 # all of the resources are waited to commit, and should any of them become slow
 # it defeats the entire purpose of the "fastest" result.
 #
+# Hedging:
+#
+# To cut the tail latency a transaction can be created with
+#
+# xa = pmnc.transaction.create(hedge_after = "p95")
+#
+# in which case each of its participants which has not returned a result in time
+# longer than 95th percentile of the recent latencies of the same resource gets
+# a duplicate (hedge) executed on another instance of the same resource pool.
+# The first good result is accepted and the other instance is rolled back.
+# Hedging only starts after a resource has collected enough latency readings,
+# which are only taken from the participants of the hedged transactions that
+# have actually been executed, the results returned from the cache do not count.
+# The losing attempts are sampled as well once they complete, otherwise the
+# percentile would only reflect the winners and drift low.
+# The numbers of hedges launched and won are counted per resource and can be
+# obtained by Transaction.get_hedge_stats(), they are also registered as
+# resource.X.hedge_rate.success and resource.X.hedge_rate.failure events.
+# Note that the duplicate calls should be safe to execute, the rollback of the
+# losing instance is only as good as the resource transactions are.
+#
+# Tracing:
+#
+# To find out where a slow transaction spends its time, it can be created with
+#
+# xa = pmnc.transaction.create(trace_threshold = 1.0)
+#
+# or trace_threshold can be set in config_transaction.py for all transactions,
+# in which case each participant records a timeline of the phases it goes
+# through: thread (waiting for a resource thread), cache (looking up and possibly
+# waiting for the cached result), allocate (allocating and possibly connecting
+# a resource instance, unless the result has been cached), begin (beginning
+# a resource transaction), execute, decision (waiting for the transaction
+# decision), and commit or rollback. The time spent in each phase is sampled as resource.X.phase_time,
+# for instance resource.X.allocate_time, and should the transaction take
+# longer than trace_threshold seconds, the timelines of all its participants
+# are written to the log.
+#
+# Batching:
+#
+# High rate writers that execute lots of small transactions against the same
+# resource may have them executed in batches, which is the group commit pattern
+# applied to transactions. If the resource is configured with pool__batch_linger
+# (see shared_pools.py) and has no cache, the participants of the transactions
+# created with
+#
+# xa = pmnc.transaction.create(batch = True)
+#
+# that access it with the same resource arguments join a batch, which is
+# executed by a single resource thread on a single instance in a single resource
+# transaction. Each caller gets its own result or error, but the batch commits
+# or rolls back as a whole. Specifically, if a participant fails terminally
+# or irrecoverably, the other participants in the batch fail with recoverable
+# ResourceError, and if any of the transactions in the batch decides to rollback,
+# the others get TransactionCommitError, unless they are not sync_commit.
+# A batch goes through the same circuit breaker, min_time and max_time checks
+# as a single participant, and each of its participants is traced separately.
+# Only the participants that have actually been executed, and the failure to
+# allocate an instance or begin the batch, count towards the circuit breaker,
+# the participants failing because the batch is aborted do not.
+#
 # Caching (see resource_pool_cache.py for more information):
 #
 # You can control the cache behaviour by supplying the following optional
@@ -152,6 +216,13 @@
 # >> xa.resource.foo(1, biz = "baz", pool__cache_put = lambda key, value: ...)
 # Callable to override cache put behaviour altogether.
 #
+# If the resource cache is configured with pool__cache_stale_ttl or
+# pool__cache_refresh_ahead, a hit to an expired (or soon to expire) cached
+# value returns it immediately, but also initiates a background transaction
+# with the same participant, which executes the same call as the original
+# and replaces the cached value with its result. The background transaction
+# runs as a separate request from interface "__cache__".
+#
 # Pythomnic3k project
 # (c) 2005-2019, Dmitry Dvoinikov <dmitry@targeted.org>
 # Distributed under BSD license
@@ -164,8 +235,8 @@ __all__ = [ "create", "Transaction", "__get_module_attr__" ]
 
 import os; from os import urandom
 import binascii; from binascii import b2a_hex
-import threading; from threading import Event
-import time; from time import time, strftime
+import threading; from threading import Event, Lock
+import time; from time import time, strftime, monotonic
 import inspect; from inspect import isfunction
 
 if __name__ == "__main__": # add pythomnic/lib to sys.path
@@ -174,12 +245,13 @@ if __name__ == "__main__": # add pythomnic/lib to sys.path
     sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..", "..", "lib")))
 
 import exc_string; from exc_string import exc_string
-import typecheck; from typecheck import typecheck, callable, optional
+import typecheck; from typecheck import typecheck, callable, optional, by_regex
 import interlocked_queue; from interlocked_queue import InterlockedQueue
 import interlocked_counter; from interlocked_counter import InterlockedCounter
 import pmnc.thread_pool; from pmnc.thread_pool import WorkUnitTimedOut
-import pmnc.samplers; from pmnc.samplers import RateSampler
+import pmnc.samplers; from pmnc.samplers import RateSampler, PercentileSampler
 import pmnc.timeout; from pmnc.timeout import Timeout
+import pmnc.request; from pmnc.request import Request
 import pmnc.resource_pool; from pmnc.resource_pool import ResourceError, \
                                 TransactionCommitError, TransactionExecutionError
 
@@ -199,15 +271,27 @@ class Transaction:
     _transaction_rate_sampler = RateSampler(10.0)
     _transaction_count = InterlockedCounter()
 
+    _stats_lock = Lock()
+    _latency_samplers = {} # resource name -> PercentileSampler of recent participant latencies
+    _hedge_counts = {}     # resource name -> [ hedges launched, hedges won ]
+    _hedge_min_readings = 20
+
+    _batches_lock = Lock()
+    _batches = {} # (resource name, resource args, resource kwargs) -> batch still accepting participants
+
     @typecheck
     def __init__(self, source_module_name, *,
                  accept: optional(callable) = None,
                  sync_commit: optional(bool) = True,
+                 hedge_after: optional(by_regex("^p[1-9][0-9]?(?:\\.[0-9]+)?$")) = None,
+                 trace_threshold: optional(float) = None,
+                 batch: optional(bool) = False,
                  **options):
 
         self._source_module_name = source_module_name
         self._accept = accept or self._default_accept
         self._sync_commit = sync_commit
+        self._hedge_after = float(hedge_after[1:]) if hedge_after is not None else None
         self._options = options
 
         transaction_time = strftime("%Y%m%d%H%M%S")
@@ -217,6 +301,14 @@ class Transaction:
 
         self._resources, self._results = [], InterlockedQueue()
         self._decision, self._commit = Event(), Event()
+        self._winners = {} # participant index -> attempt whose result has been accepted
+        self._batch, self._batched = batch, set() # indices of the participants that joined batches
+
+        if trace_threshold is None:
+            trace_threshold = pmnc.config.get("trace_threshold")
+        self._trace_threshold = trace_threshold
+        self._timelines = {} if trace_threshold is not None else None # (participant index, attempt) -> timeline
+
         self._transaction_rate_sampler.tick()
 
     ###################################
@@ -244,6 +336,31 @@ class Transaction:
     def get_transaction_rate(cls):
         return cls._transaction_rate_sampler.avg
 
+    # latencies of the participants are collected per resource for hedging
+
+    @classmethod
+    def _latency_sampler(cls, resource_name):
+        with cls._stats_lock:
+            latency_sampler = cls._latency_samplers.get(resource_name)
+            if latency_sampler is None:
+                latency_sampler = cls._latency_samplers[resource_name] = PercentileSampler(1000)
+            return latency_sampler
+
+    @classmethod
+    def _count_hedge(cls, resource_name, launched, won):
+        with cls._stats_lock:
+            hedge_counts = cls._hedge_counts.setdefault(resource_name, [ 0, 0 ])
+            hedge_counts[0] += launched
+            hedge_counts[1] += won
+
+    # this method returns the numbers of hedges launched and won per resource
+
+    @classmethod
+    def get_hedge_stats(cls):
+        with cls._stats_lock:
+            return { resource_name: tuple(hedge_counts)
+                     for resource_name, hedge_counts in cls._hedge_counts.items() }
+
     ###################################
 
     # this method is executed in context of a worker thread from the resource thread pool,
@@ -251,7 +368,7 @@ class Transaction:
     # original transaction thread, waits for a decision and performs commit/rollback
 
     def wu_participate(self, transaction_start, participant_index,
-                       resource_name, attrs, args, kwargs, res_args, res_kwargs):
+                       resource_name, attrs, args, kwargs, res_args, res_kwargs, attempt = 0, attempt_start = None):
 
         # see whether the request by which this transaction was created
         # has expired in the meantime, and if it has, simply bail out
@@ -266,8 +383,21 @@ class Transaction:
                            "{1:s} was late".format(resource_name, self))
             return
 
+        return self._participate(self._results.push, transaction_start, participant_index,
+                                 resource_name, attrs, args, kwargs, res_args, res_kwargs, attempt, attempt_start)
+
+    # this method does the actual work of a participant, the intermediate result
+    # is passed to deliver, which either hands it over to the transaction thread,
+    # or, for an inline transaction, makes the decision right away
+
+    def _participate(self, deliver, transaction_start, participant_index,
+                     resource_name, attrs, args, kwargs, res_args, res_kwargs, attempt = 0, attempt_start = None):
+
         try:
 
+            timeline = self._timelines.get((participant_index, attempt)) if self._timelines is not None else None
+            self._mark(timeline, "thread")
+
             if pmnc.log.noise:
                 pmnc.log.noise("resource {0:s} joins transaction {1:s}".format(resource_name, self))
 
@@ -277,10 +407,12 @@ class Transaction:
             cache_key = None                # cache key to refer to this transaction's result
             cached_result = None            # value returned from the cache
             result = None                   # the actual execution result
+            circuit_breaker = None          # circuit breaker to register the outcome with
+            restricted_deadline = None      # request deadline before it has been restricted
 
             while True: # breaks when the result is obtained, either value or exception
 
-                # any failure prior to actual resource allocation results
+                # any failure prior to the cache lookup results
                 # in a recoverable ResourceError, pointlessly terminal
 
                 try:
@@ -292,165 +424,183 @@ class Transaction:
                     pmnc.performance.sample("resource.{0:s}.pending_time".\
                                             format(resource_name), pending_ms)
 
-                    # allocate a resource instance from a specific resource pool
-
                     resource_pool = pmnc.shared_pools.get_resource_pool(resource_name)
-                    resource_instance = resource_pool.allocate()
 
-                except: # tested
-                    result = ResourceError.snap_exception(
-                                    participant_index = participant_index,
-                                    recoverable = True, terminal = True) # but not really terminal,
-                    break # while True                                   # no instance to terminate
+                    # see if there is a cached result
 
-                # some resource instance has been allocated
+                    cache_kwargs = { k: v for k, v in kwargs.items() if k.startswith("pool__cache_") }
+                    for k in cache_kwargs:
+                        del kwargs[k]
 
-                try:
+                    refresh_kwargs = cache_kwargs.copy() # to replay the call in background refresh
 
-                    # see if request deadline should be restricted for the course of transaction
+                    # cache key may be passed in pool__cache_key as a literal value
+                    # or as a callable taking (attrs, args, kwargs) as parameters,
+                    # and if it is not specified, the default cache key is simply
+                    # a tuple of frozen (attrs, args, kwargs)
 
-                    max_time = resource_instance.max_time
-                    if max_time is not None:
-                        request_start, request_remain = time(), pmnc.request.remain
-                        if request_remain > max_time:
-                            pmnc.request.remain = max_time
-                            if pmnc.log.noise:
-                                pmnc.log.noise("request deadline is restricted for the course of transaction")
-                        else:
-                            max_time = None # to not restore timeout to a bigger value than it already has now
+                    if not resource_pool.has_cache:
+                        cache_key = None
+                    elif "pool__cache_key" in cache_kwargs:
+                        cache_key = cache_kwargs.pop("pool__cache_key") # but this still can be None
+                    else:
+                        cache_key = lambda attrs, args, kwargs: (tuple(attrs), args, frozenset(kwargs.items()))
 
-                    try: # finally restore the timeout
+                    if isfunction(cache_key):
+                        cache_key = cache_key(attrs, args, kwargs)
 
-                        # see if there is a cached result
+                    # if cache key evaluated to None after all, the cache is bypassed at all
 
-                        cache_kwargs = { k: v for k, v in kwargs.items() if k.startswith("pool__cache_") }
-                        for k in cache_kwargs:
-                            del kwargs[k]
+                    if cache_key is not None:
+                        cache_get = cache_kwargs.pop("pool__cache_get", None) or resource_pool.cache_get
+                        cache_put = cache_kwargs.pop("pool__cache_put", None) or resource_pool.cache_put
 
-                        # cache key may be passed in pool__cache_key as a literal value
-                        # or as a callable taking (attrs, args, kwargs) as parameters,
-                        # and if it is not specified, the default cache key is simply
-                        # a tuple of frozen (attrs, args, kwargs)
+                    # the cache may decide to return a stale value, in which case this
+                    # transaction initiates a background refresh, unless it is the refresh
 
-                        if not resource_pool.has_cache:
-                            cache_key = None
-                        elif "pool__cache_key" in cache_kwargs:
-                            cache_key = cache_kwargs.pop("pool__cache_key") # but this still can be None
-                        else:
-                            cache_key = lambda attrs, args, kwargs: (tuple(attrs), args, frozenset(kwargs.items()))
+                    if cache_key is not None and not cache_kwargs.get("pool__cache_refreshing"):
+                        refresh_kwargs.update(kwargs, pool__cache_key = cache_key, pool__cache_refreshing = True)
+                        cache_kwargs["pool__cache_refresh"] = \
+                            lambda: self._refresh_cache(resource_name, attrs, args, refresh_kwargs, res_args, res_kwargs)
 
-                        if isfunction(cache_key):
-                            cache_key = cache_key(attrs, args, kwargs)
+                    # weight can be overridden by the caller
 
-                        # if cache key evaluated to None after all, the cache is bypassed at all
+                    cache_weight = cache_kwargs.pop("pool__cache_weight", None)
 
-                        if cache_key is not None:
-                            cache_get = cache_kwargs.pop("pool__cache_get", None) or resource_pool.cache_get
-                            cache_put = cache_kwargs.pop("pool__cache_put", None) or resource_pool.cache_put
+                    # executable to wrap the result before it's cached
 
-                        # weight can be overridden by the caller
+                    cache_wrap = cache_kwargs.pop("pool__cache_wrap", None)
 
-                        cache_weight = cache_kwargs.pop("pool__cache_weight", None)
+                    # this id allows the cache to match get/put calls from the same transaction
 
-                        # executable to wrap the result before it's cached
+                    transaction_id = self._transaction_count.next()
 
-                        cache_wrap = cache_kwargs.pop("pool__cache_wrap", None)
+                except: # tested
+                    result = ResourceError.snap_exception(
+                                    participant_index = participant_index,
+                                    recoverable = True, terminal = True) # but not really terminal,
+                    break # while True                                   # no instance to terminate
 
-                        # this id allows the cache to match get/put calls from the same transaction
+                # getting result from the cache may not be instant, therefore
+                # the timeout is passed, moreover it could block for a while
+                # and still return None
 
-                        transaction_id = self._transaction_count.next()
+                try:
+                    if cache_key is not None:
+                        cached_result = cache_get(cache_key,
+                                                  pool__cache_timeout = pmnc.request.remain,
+                                                  pool__cache_transaction_id = transaction_id,
+                                                  **cache_kwargs)
+                except:
+                    pmnc.log.error("cache get failed in {0:s}: {1:s}".format(self, exc_string())) # log and proceed without cache
+                    cache_failed = True
+                else:
+                    cache_failed = False
 
-                        # getting result from the cache may not be instant, therefore
-                        # the timeout is passed, moreover it could block for a while
-                        # and still return None
+                self._mark(timeline, "cache")
 
-                        try:
-                            if cache_key is not None:
-                                cached_result = cache_get(cache_key,
-                                                          pool__cache_timeout = pmnc.request.remain,
-                                                          pool__cache_transaction_id = transaction_id,
-                                                          **cache_kwargs)
-                        except:
-                            pmnc.log.error("cache get failed in {0:s}: {1:s}".format(self, exc_string())) # log and proceed without cache
-                            cache_failed = True
-                        else:
-                            cache_failed = False
+                # a resource instance is only allocated if the result has not been
+                # found in the cache, and so is the circuit breaker consulted
 
-                        try:
+                try:
 
-                            if cached_result is None: # not found in the cache, but this transaction is allowed to proceed
+                    try:
 
-                                # see if the transaction should be started in as little time as the request has left
+                        if cached_result is None: # not found in the cache, but this transaction is allowed to proceed
 
-                                if pmnc.request.remain < resource_instance.min_time:
-                                    raise ResourceError(description = "transaction {0:s} is declined by resource instance "
-                                                                      "{1:s}".format(self, resource_instance.name),
-                                                        recoverable = True, terminal = False)
+                            # the resource may be cut off by its circuit breaker, in which case
+                            # the participant fails right away and its outcome is not registered
 
-                                if pmnc.log.noise:
-                                    pmnc.log.noise("resource instance {0:s} is used in transaction {1:s}, {2:s}".\
-                                                   format(resource_instance.name, self, self._resource_ttl(resource_instance)))
+                            circuit_breaker = pmnc.shared_pools.get_circuit_breaker(resource_name)
+                            if circuit_breaker is not None and not circuit_breaker.allow():
+                                circuit_breaker = None
+                                raise ResourceError(description = "circuit breaker for resource {0:s} "
+                                                                  "is open".format(resource_name),
+                                                    recoverable = True, terminal = False) # tested
 
-                                # begin a new transaction, this is presumably a reversible operation
+                            # allocate a resource instance from a specific resource pool
 
-                                resource_instance.begin_transaction(self._xid,
-                                                                    source_module_name = self._source_module_name,
-                                                                    transaction_options = self._options,
-                                                                    resource_args = res_args,
-                                                                    resource_kwargs = res_kwargs)
+                            try:
+                                resource_instance = resource_pool.allocate()
+                            except: # tested
+                                ResourceError.rethrow(recoverable = True, terminal = True) # but not really terminal,
+                                                                                           # no instance to terminate
+                            self._mark(timeline, "allocate")
 
-                                resource_in_transaction = True
+                            # see if request deadline should be restricted for the course of transaction
 
-                                # replay attribute accesses to obtain the actual target method
+                            restricted_deadline = self._restrict_deadline(resource_instance)
 
-                                target_method = resource_instance
-                                for attr in attrs:
-                                    target_method = getattr(target_method, attr)
+                            # see if the transaction should be started in as little time as the request has left,
+                            # the declined participant tells nothing about the resource to its circuit breaker
 
-                                # execute the request, registering the execution time
+                            if pmnc.request.remain < resource_instance.min_time:
+                                circuit_breaker = None
+                                raise ResourceError(description = "transaction {0:s} is declined by resource instance "
+                                                                  "{1:s}".format(self, resource_instance.name),
+                                                    recoverable = True, terminal = False)
 
-                                processing_start = time()
-                                try:
-                                    with pmnc.performance.timing("resource.{0:s}.processing_time".format(resource_name)):
-                                        result = target_method(*args, **kwargs)
-                                finally:
-                                    if cache_weight is None:                               # by default cache weight
-                                        cache_weight = max(time() - processing_start, 0.0) # is the execution time
+                            if pmnc.log.noise:
+                                pmnc.log.noise("resource instance {0:s} is used in transaction {1:s}, {2:s}".\
+                                               format(resource_instance.name, self, self._resource_ttl(resource_instance)))
 
-                                # technically the resource call may return None, but then it wouldn't be cached
+                            # begin a new transaction, this is presumably a reversible operation
 
-                                if result is not None and cache_wrap: # note that wrapping takes place even when
-                                    try:                              # cache_key is None or cache_failed because
-                                        result = cache_wrap(result)   # the caller expects a uniform result format
-                                    except:
-                                        result = None # this invalidates the execution result because
-                                        raise         # now it can neither be cached nor returned
+                            resource_instance.begin_transaction(self._xid,
+                                                                source_module_name = self._source_module_name,
+                                                                transaction_options = self._options,
+                                                                resource_args = res_args,
+                                                                resource_kwargs = res_kwargs)
 
-                            elif cached_result is Timeout: # not found in the cache and timeout has expired, technically this is
-                                                           # the same as pmnc.request.expired but comparing time could be unreliable
+                            resource_in_transaction = True
+                            self._mark(timeline, "begin")
 
-                                raise ResourceError(description = "request deadline waiting for cached result from resource {0:s} "
-                                                                  "in transaction {1:s}".format(resource_instance.name, self),
-                                                    recoverable = True, terminal = False)
+                            # replay attribute accesses to obtain the actual target method
 
-                        finally:
-                            if cache_key is not None and not cache_failed:
-                                try:
-                                    cache_put(cache_key, result, # contains actual execution result or None upon exception
-                                              pool__cache_weight = cache_weight, # contains actual execution time or None
-                                              pool__cache_transaction_id = transaction_id,
-                                              **cache_kwargs)
-                                except:
-                                    pmnc.log.error("cache put failed in {0:s}: {1:s}".format(self, exc_string())) # log and ignore cache error only
+                            target_method = resource_instance
+                            for attr in attrs:
+                                target_method = getattr(target_method, attr)
 
-                        if cached_result is not None and cached_result is not Timeout: # now the cached result is put into place
-                            result = cached_result
+                            # execute the request, registering the execution time
 
-                    finally: # restore the request timeout if it has been restricted
-                        if max_time is not None:
-                            pmnc.request.remain = request_start + request_remain - time()
-                            if pmnc.log.noise:
-                                pmnc.log.noise("request deadline is restored")
+                            processing_start = time()
+                            try:
+                                with pmnc.performance.timing("resource.{0:s}.processing_time".format(resource_name)):
+                                    result = target_method(*args, **kwargs)
+                            finally:
+                                self._mark(timeline, "execute")
+                                if cache_weight is None:                               # by default cache weight
+                                    cache_weight = max(time() - processing_start, 0.0) # is the execution time
+
+                            # technically the resource call may return None, but then it wouldn't be cached
+
+                            if result is not None and cache_wrap: # note that wrapping takes place even when
+                                try:                              # cache_key is None or cache_failed because
+                                    result = cache_wrap(result)   # the caller expects a uniform result format
+                                except:
+                                    result = None # this invalidates the execution result because
+                                    raise         # now it can neither be cached nor returned
+
+                        elif cached_result is Timeout: # not found in the cache and timeout has expired, technically this is
+                                                       # the same as pmnc.request.expired but comparing time could be unreliable
+
+                            raise ResourceError(description = "request deadline waiting for cached result from resource {0:s} "
+                                                              "in transaction {1:s}".format(resource_name, self),
+                                                recoverable = True, terminal = False)
+
+                    finally:
+                        self._restore_deadline(restricted_deadline)
+                        if cache_key is not None and not cache_failed:
+                            try:
+                                cache_put(cache_key, result, # contains actual execution result or None upon exception
+                                          pool__cache_weight = cache_weight, # contains actual execution time or None
+                                          pool__cache_transaction_id = transaction_id,
+                                          **cache_kwargs)
+                            except:
+                                pmnc.log.error("cache put failed in {0:s}: {1:s}".format(self, exc_string())) # log and ignore cache error only
+
+                    if cached_result is not None and cached_result is not Timeout: # now the cached result is put into place
+                        result = cached_result
 
                 except ResourceError as e:
                     result = self._apply_error(participant_index, resource_instance, e)
@@ -459,10 +609,12 @@ class Transaction:
                     result = ResourceError.snap_exception(
                                     participant_index = participant_index,
                                     recoverable = not resource_in_transaction, terminal = True)
-                    resource_instance.expire()
+                    if resource_instance is not None:
+                        resource_instance.expire()
                     break # while True
                 else:
-                    resource_instance.reset_idle_timeout()
+                    if resource_instance is not None:
+                        resource_instance.reset_idle_timeout()
                     resource_failed = False
                     break # while True
 
@@ -470,22 +622,34 @@ class Transaction:
 
             try:
 
+                # only the results actually returned by the resource count towards its latency,
+                # those of the losing attempts as well, and an attempt that fails after the
+                # transaction has been decided counts with the time it took to give up
+
+                if self._hedge_after is not None and resource_in_transaction and \
+                   (not resource_failed or self._decision.is_set()):
+                    latency_sampler = self._latency_sampler(resource_name)
+                    latency_sampler += time() - attempt_start
+
                 # deliver the result to the pending transaction
 
-                self._results.push((participant_index, result))
+                deliver((participant_index, result, attempt))
 
                 # register the actual result of this participant
 
                 pmnc.performance.event("resource.{0:s}.transaction_rate.{1:s}".\
                                        format(resource_name, resource_failed and "failure" or "success"))
 
+                if circuit_breaker is not None:
+                    circuit_breaker.register(not resource_failed)
+
                 # the result may have been taken from cache in which case there
                 # has been no transaction and we simply acknowledge the commit
 
                 if result is cached_result and cached_result is not None:
                     if pmnc.log.noise:
-                        pmnc.log.noise("resource instance {0:s} is returning cached result in transaction "
-                                       "{1:s}".format(resource_instance.name, self))
+                        pmnc.log.noise("resource {0:s} is returning cached result in transaction "
+                                       "{1:s}".format(resource_name, self))
                     return "commit"
 
                 if not resource_in_transaction: # as we couldn't begin a transaction,
@@ -501,7 +665,11 @@ class Transaction:
 
                 if pmnc.request.wait(self._decision): # wait for transaction's decision
                     if self._commit.is_set():
-                        if not resource_failed:
+                        if self._winners.get(participant_index, 0) != attempt:
+                            if pmnc.log.noise:
+                                pmnc.log.noise("resource instance {0:s} lost the race and decided to rollback "
+                                               "in transaction {1:s}".format(resource_instance.name, self))
+                        elif not resource_failed:
                             commit_transaction = True
                             if pmnc.log.noise:
                                 pmnc.log.noise("resource instance {0:s} decided to commit in transaction "
@@ -517,17 +685,21 @@ class Transaction:
                     pmnc.log.warning("resource instance {0:s} had to abandon waiting for decision and "
                                      "rollback in transaction {1:s}".format(resource_instance.name, self))
 
+                self._mark(timeline, "decision")
+
                 # complete the transaction and return the final outcome
 
                 if commit_transaction:
                     try:
                         resource_instance.commit()
                     except:
+                        self._mark(timeline, "commit")
                         pmnc.log.error("resource instance {0:s} failed to commit in transaction {1:s}: "
                                        "{2:s}".format(resource_instance.name, self, exc_string())) # this is a severe problem
                         resource_instance.expire()
                         return "failure"
                     else:
+                        self._mark(timeline, "commit")
                         if pmnc.log.noise:
                             pmnc.log.noise("resource instance {0:s} committed in transaction "
                                            "{1:s}".format(resource_instance.name, self))
@@ -536,11 +708,13 @@ class Transaction:
                     try:
                         resource_instance.rollback()
                     except:
+                        self._mark(timeline, "rollback")
                         pmnc.log.warning("resource instance {0:s} failed to rollback in transaction {1:s}: "
                                          "{2:s}".format(resource_instance.name, self, exc_string())) # this is not a big deal
                         resource_instance.expire()
                         return "failure"
                     else:
+                        self._mark(timeline, "rollback")
                         if pmnc.log.noise:
                             pmnc.log.noise("resource instance {0:s} rolled back in transaction "
                                            "{1:s}".format(resource_instance.name, self))
@@ -552,6 +726,8 @@ class Transaction:
                         pmnc.log.noise("resource instance {0:s} is being released, {1:s}".\
                                        format(resource_instance.name, self._resource_ttl(resource_instance)))
                     resource_pool.release(resource_instance)
+                if timeline is not None:
+                    self._sample_timeline(resource_name, timeline)
 
         except:
             pmnc.log.error(exc_string()) # this should not normally happen, but do
@@ -559,6 +735,64 @@ class Transaction:
 
     ###################################
 
+    # this method is called by the cache from wu_participate above whenever
+    # a stale cached value is returned, it enqueues a separate request which
+    # will replay the same call to the resource, bypassing the cache
+
+    def _refresh_cache(self, resource_name, attrs, args, kwargs, res_args, res_kwargs):
+
+        request = Request(timeout = pmnc.config_interfaces.get("request_timeout"),
+                          interface = "__cache__", protocol = "n/a",
+                          parameters = pmnc.request.to_dict()["parameters"],
+                          description = "refreshing cached result of resource {0:s}".format(resource_name))
+
+        pmnc.interfaces.enqueue(request, self.wu_refresh_cache,
+                                (resource_name, attrs, args, kwargs, res_args, res_kwargs))
+
+    # this method is executed in context of a worker thread from the interfaces thread pool,
+    # the refreshing transaction puts its result to the cache, the result itself is discarded
+
+    def wu_refresh_cache(self, resource_name, attrs, args, kwargs, res_args, res_kwargs):
+
+        if pmnc.log.noise:
+            pmnc.log.noise("refreshing cached result of resource {0:s} from transaction {1:s}".\
+                           format(resource_name, self))
+        try:
+            xa = pmnc.transaction.Transaction(self._source_module_name, **self._options)
+            xa._collect(resource_name, attrs, args, kwargs, res_args, res_kwargs)
+            xa.execute()
+        except:
+            pmnc.log.warning("refreshing cached result of resource {0:s} failed: "
+                             "{1:s}".format(resource_name, exc_string())) # the stale value is kept
+
+    ###################################
+
+    # these utility methods restrict the request deadline to max_time of the resource
+    # instance for the course of transaction, and restore it afterwards
+
+    @staticmethod
+    def _restrict_deadline(resource_instance):
+
+        max_time = resource_instance.max_time
+        if max_time is None or pmnc.request.remain <= max_time: # to not restore timeout to a bigger
+            return None                                         # value than it already has now
+
+        restricted_deadline = time(), pmnc.request.remain
+        pmnc.request.remain = max_time
+        if pmnc.log.noise:
+            pmnc.log.noise("request deadline is restricted for the course of transaction")
+
+        return restricted_deadline
+
+    @staticmethod
+    def _restore_deadline(restricted_deadline):
+
+        if restricted_deadline is not None:
+            request_start, request_remain = restricted_deadline
+            pmnc.request.remain = request_start + request_remain - time()
+            if pmnc.log.noise:
+                pmnc.log.noise("request deadline is restored")
+
     # this utility methods applies a thrown ResourceError to a resource instance
     # that threw it, updates the participant index, presumably unknown to the instance
 
@@ -566,7 +800,9 @@ class Transaction:
 
         resource_error.participant_index = participant_index
 
-        if resource_error.terminal:
+        if resource_instance is None: # the error occured before an instance has been allocated
+            pass
+        elif resource_error.terminal:
             resource_instance.expire()
         else:
             resource_instance.reset_idle_timeout()
@@ -584,6 +820,16 @@ class Transaction:
 
     def execute(self):
 
+        if self._timelines is None:
+            return self._execute()
+
+        try:
+            return self._execute()
+        finally:
+            self._dump_timelines()
+
+    def _execute(self):
+
         if not self._resources: # shortcut to handle (useless) empty transactions
             return ()
 
@@ -592,19 +838,23 @@ class Transaction:
 
         if pmnc.log.noise:
             pmnc.log.noise("transaction {0:s} begins".format(self))
+
+        work_units = [] # one list per participant, the original work unit followed by the hedge
         try:
 
             # initiate execution of all the individual resources, each through
             # its own thread pool but having an identical cloned request
 
             transaction_start = time()
-            work_units = []
+            attempts = {} # (participant index, attempt) -> start time, for the pending attempts
 
-            for participant_index, (resource_name, attrs, args, kwargs, res_args, res_kwargs) in enumerate(self._resources):
-                thread_pool = pmnc.shared_pools.get_thread_pool(resource_name)
-                work_units.append(thread_pool.enqueue(pmnc.request.clone(), self.wu_participate,
-                                                      (transaction_start, participant_index, resource_name,
-                                                       attrs, args, kwargs, res_args, res_kwargs), {}))
+            for participant_index in range(len(self._resources)):
+                work_units.append([ self._enqueue_attempt(transaction_start, participant_index, 0, attempts) ])
+
+            # the participants that take longer than their resource's latency percentile
+            # will be hedged, unless the resource has not collected enough readings yet
+
+            hedge_timeouts = self._hedge_timeouts()
 
             # wait for all the individual resources to deliver intermediate results,
             # which are pushed by each participant to a _results queue as it completes
@@ -617,7 +867,7 @@ class Transaction:
 
             while result_count < len(results):
 
-                idx_result = pmnc.request.pop(self._results) # wait for another result
+                idx_result = self._pop_result(hedge_timeouts, transaction_start, attempts, work_units)
                 if idx_result is None:
                     for i, result in enumerate(results): # find the first resource that did not return a result
                         if result is self.NoValue:
@@ -628,7 +878,19 @@ class Transaction:
                     else:
                         assert False # this should not happen
 
-                results[idx_result[0]] = idx_result[1] # register the result
+                participant_index, result, attempt = idx_result
+                attempts.pop((participant_index, attempt))
+                hedge_timeouts.pop(participant_index, None) # there is no point hedging after any result
+
+                if results[participant_index] is not self.NoValue: # the other attempt has already won
+                    continue
+                if isinstance(result, Exception) and \
+                   any(i == participant_index for i, a in attempts): # the other attempt may yet succeed
+                    continue
+
+                results[participant_index] = result # register the result
+                if not isinstance(result, Exception): # a failed attempt wins nothing
+                    self._winners[participant_index] = attempt
                 result_count += 1
 
                 result = self._accept(self, results) # this gets executed upon each incoming result,
@@ -650,11 +912,15 @@ class Transaction:
                 pmnc.log.noise("transaction {0:s} is being committed".format(self))
         finally:
             self._decision.set()
+            for participant_index, attempt_work_units in enumerate(work_units):
+                if len(attempt_work_units) > 1:
+                    self._register_hedge(participant_index)
 
         if self._sync_commit: # wait for all the individual resources to commit
 
-            for participant_index, work_unit in enumerate(work_units):
+            for participant_index, attempt_work_units in enumerate(work_units):
                 resource_name = self._resources[participant_index][0]
+                work_unit = attempt_work_units[self._winners.get(participant_index, 0)] # the loser rolls back
                 try:
                     resource_decision = work_unit.wait() # blocks until work_unit completes or request deadline
                 except WorkUnitTimedOut:
@@ -686,6 +952,548 @@ class Transaction:
 
         return result
 
+    # this method starts the original attempt of a participant or its hedge,
+    # each attempt is executed by a separate thread with a separate instance
+
+    def _enqueue_attempt(self, transaction_start, participant_index, attempt, attempts):
+
+        if attempt == 0 and self._batch:
+            work_unit = self._join_batch(transaction_start, participant_index)
+            if work_unit is not None:
+                attempts[(participant_index, attempt)] = time()
+                return work_unit
+
+        resource_name, attrs, args, kwargs, res_args, res_kwargs = self._resources[participant_index]
+        if self._hedge_after is not None: # the participant strips caching kwargs and the resource
+            kwargs, res_kwargs = kwargs.copy(), res_kwargs.copy() # may consume its own, the hedge needs them intact
+
+        thread_pool = pmnc.shared_pools.get_thread_pool(resource_name)
+        attempt_start = attempts[(participant_index, attempt)] = time()
+        self._start_timeline(participant_index, attempt)
+        return thread_pool.enqueue(pmnc.request.clone(), self.wu_participate,
+                                   (transaction_start, participant_index, resource_name,
+                                    attrs, args, kwargs, res_args, res_kwargs),
+                                   { "attempt": attempt, "attempt_start": attempt_start })
+
+    # this method returns the timeouts after which the participants are to be hedged
+
+    def _hedge_timeouts(self):
+
+        hedge_timeouts = {}
+        if self._hedge_after is not None:
+            for participant_index, (resource_name, *_) in enumerate(self._resources):
+                if participant_index in self._batched: # a batch cannot be hedged
+                    continue
+                latency_sampler = self._latency_sampler(resource_name)
+                if latency_sampler.count >= self._hedge_min_readings:
+                    hedge_timeouts[participant_index] = Timeout(latency_sampler.percentile(self._hedge_after))
+
+        return hedge_timeouts
+
+    # this method waits for another intermediate result just like pmnc.request.pop,
+    # but meanwhile launches the hedges for the participants that take too long
+
+    def _pop_result(self, hedge_timeouts, transaction_start, attempts, work_units):
+
+        while hedge_timeouts:
+            participant_index, hedge_timeout = min(hedge_timeouts.items(), key = lambda i_t: i_t[1].remain)
+            idx_result = self._results.pop(min(hedge_timeout.remain, pmnc.request.remain))
+            if idx_result is not None:
+                return idx_result
+            if pmnc.request.expired:
+                return None
+            if hedge_timeout.expired:
+                del hedge_timeouts[participant_index]
+                if pmnc.log.noise:
+                    pmnc.log.noise("resource {0:s} is hedged in transaction {1:s}".\
+                                   format(self._resources[participant_index][0], self))
+                work_units[participant_index].append(
+                    self._enqueue_attempt(transaction_start, participant_index, 1, attempts))
+
+        return pmnc.request.pop(self._results)
+
+    # this method registers the outcome of a launched hedge
+
+    def _register_hedge(self, participant_index):
+
+        resource_name = self._resources[participant_index][0]
+        won = self._winners.get(participant_index) == 1
+        self._count_hedge(resource_name, 1, won and 1 or 0)
+        pmnc.performance.event("resource.{0:s}.hedge_rate.{1:s}".\
+                               format(resource_name, won and "success" or "failure"))
+
+    ###################################
+
+    # this method executes a transaction with a single participant in the calling
+    # thread, saving the hops to the resource thread pool and back, but only if one
+    # of the pool threads can be reserved right away, otherwise it resorts to execute,
+    # the semantics is the same except that rollback is complete upon return
+
+    def _execute_inline(self):
+
+        if len(self._resources) != 1 or self._hedge_after is not None or self._batch:
+            return self.execute()
+
+        resource_name, attrs, args, kwargs, res_args, res_kwargs = self._resources[0]
+
+        thread_pool = pmnc.shared_pools.get_thread_pool(resource_name)
+        thread = thread_pool.reserve()
+        if thread is None:
+            return self.execute()
+
+        try:
+
+            self._details = "{0:s}.{1:s}".format(resource_name, ".".join(attrs))
+
+            if pmnc.log.noise:
+                pmnc.log.noise("transaction {0:s} begins inline".format(self))
+
+            if pmnc.request.expired: # this is what the participant would have done
+                raise TransactionExecutionError(
+                        description = "request deadline waiting for intermediate result from resource "
+                                      "{0:s} in transaction {1:s}".format(resource_name, self),
+                        participant_index = 0)
+
+            transaction_start = time()
+            self._start_timeline(0, 0)
+
+            # the participant delivers its intermediate result, which is accepted
+            # or rejected right away, then commits or rolls back respectively
+
+            resource_decision = self._participate(self._deliver_inline, transaction_start, 0,
+                                                  resource_name, attrs, args, kwargs, res_args, res_kwargs)
+
+        finally:
+            thread_pool.unreserve(thread)
+
+        if self._timelines is not None:
+            self._dump_timelines()
+
+        result = self._inline_result
+        if not self._commit.is_set():
+            if pmnc.log.noise:
+                pmnc.log.noise("transaction {0:s} has been rolled back".format(self))
+            raise result
+
+        if self._sync_commit and resource_decision != "commit":
+            raise TransactionCommitError(
+                    description = "transaction {0:s} got unexpected commit outcome from resource "
+                                  "{1:s}: {2:s}".format(self, resource_name, resource_decision),
+                    participant_index = 0)
+
+        if pmnc.log.noise:
+            pmnc.log.noise("transaction {0:s} completes successfully in {1:.01f} "
+                           "second(s)".format(self, time() - transaction_start))
+
+        return result
+
+    # this method is called by the inline participant with its intermediate result,
+    # it makes the decision just like execute does, but it must not throw, because
+    # the participant has yet to commit or rollback, the outcome is kept instead
+
+    def _deliver_inline(self, idx_result):
+
+        try:
+            result = self._accept(self, [ idx_result[1] ])
+            if result is None:
+                raise TransactionExecutionError(
+                        description = "intermediate results of transaction {0:s} "
+                                      "have not been accepted".format(self)) # participant index is None
+        except Exception as e:
+            self._inline_result = e
+        else:
+            self._inline_result = result
+            self._commit.set()
+        finally:
+            self._decision.set()
+
+    ###################################
+
+    # batch collects the participants of concurrent transactions against
+    # the same resource, to be executed in a single resource transaction
+
+    class Batch:
+
+        def __init__(self, resource_name, res_args, res_kwargs, linger):
+            self.resource_name = resource_name
+            self.res_args, self.res_kwargs = res_args, res_kwargs
+            self.members = [] # (transaction, participant index, attrs, args, kwargs, request, transaction start, timeline)
+            self.linger = Timeout(linger)
+            self.full = Event()
+            self.work_unit = None
+
+    # this method adds a participant to the batch that is accepting participants
+    # for the same resource, starting a new one if necessary, and returns the work
+    # unit that executes the batch, or None if the participant cannot be batched
+
+    def _join_batch(self, transaction_start, participant_index):
+
+        resource_name, attrs, args, kwargs, res_args, res_kwargs = self._resources[participant_index]
+
+        batching = pmnc.shared_pools.get_batching(resource_name)
+        if batching is None or pmnc.shared_pools.get_resource_pool(resource_name).has_cache:
+            return None
+
+        # only the participants with the same resource arguments can share an instance
+
+        batch_key = (resource_name, res_args, tuple(sorted(res_kwargs.items())))
+        try:
+            hash(batch_key)
+        except TypeError:
+            return None
+
+        linger, size = batching
+
+        # the cache options have no use without a cache, but they must not reach the resource
+
+        kwargs = { k: v for k, v in kwargs.items() if not k.startswith("pool__cache_") }
+
+        self._start_timeline(participant_index, 0)
+        timeline = self._timelines.get((participant_index, 0)) if self._timelines is not None else None
+
+        with self._batches_lock:
+            batch = self._batches.get(batch_key)
+            if batch is None:
+                batch = self._batches[batch_key] = self.Batch(resource_name, res_args, res_kwargs, linger)
+                thread_pool = pmnc.shared_pools.get_thread_pool(resource_name)
+                batch.work_unit = thread_pool.enqueue(pmnc.request.clone(), self.wu_execute_batch,
+                                                      (batch_key, batch), {})
+            batch.members.append((self, participant_index, attrs, args, kwargs, pmnc.request.clone(),
+                                  transaction_start, timeline))
+            if len(batch.members) >= size:
+                del self._batches[batch_key]
+                batch.full.set()
+
+        self._batched.add(participant_index)
+
+        if pmnc.log.noise:
+            pmnc.log.noise("resource {0:s} joins a batch in transaction {1:s}".format(resource_name, self))
+
+        return batch.work_unit
+
+    # this method is executed in context of a worker thread from the resource thread pool,
+    # it waits for the batch to fill up, executes all of its participants in one resource
+    # transaction, delivers their results, waits for all of their decisions and commits
+    # or rolls back the batch as a whole
+
+    def wu_execute_batch(self, batch_key, batch):
+
+        try:
+
+            batch.linger.wait(batch.full) # wait for more participants unless the batch is full
+
+            with self._batches_lock:
+                if self._batches.get(batch_key) is batch:
+                    del self._batches[batch_key]
+
+            resource_name = batch.resource_name
+
+            # the participants whose requests have expired are skipped, just like in wu_participate,
+            # and the pending intervals of the others are registered, just like in _participate
+
+            members = []
+            for member in batch.members:
+                if member[5].expired:
+                    pmnc.log.error("execution of resource {0:s} in transaction "
+                                   "{1:s} was late".format(resource_name, member[0]))
+                else:
+                    pending_ms = int((time() - member[6]) * 1000)
+                    pmnc.performance.sample("resource.{0:s}.pending_time".\
+                                            format(resource_name), pending_ms)
+                    self._mark(member[7], "thread")
+                    members.append(member)
+
+            try:
+
+                if not members:
+                    return "failure"
+
+                if pmnc.log.noise:
+                    pmnc.log.noise("batch of {0:d} participant(s) of resource {1:s} is being "
+                                   "executed".format(len(members), resource_name))
+
+                # the resource may be cut off by its circuit breaker, in which case
+                # all the members fail right away and their outcomes are not registered
+
+                circuit_breaker = pmnc.shared_pools.get_circuit_breaker(resource_name)
+                if circuit_breaker is not None and not circuit_breaker.allow():
+                    for xa, participant_index, *_ in members:
+                        self._deliver_batched(xa, participant_index,
+                                              ResourceError(description = "circuit breaker for resource {0:s} "
+                                                                          "is open".format(resource_name),
+                                                            participant_index = participant_index,
+                                                            recoverable = True, terminal = False)) # tested
+                    return "failure"
+
+                resource_pool = pmnc.shared_pools.get_resource_pool(resource_name)
+                try:
+                    resource_instance = resource_pool.allocate()
+                except: # tested
+                    for xa, participant_index, *_ in members:
+                        self._deliver_batched(xa, participant_index,
+                                              ResourceError.snap_exception(participant_index = participant_index,
+                                                                           recoverable = True, terminal = True))
+                    if circuit_breaker is not None:
+                        circuit_breaker.register(False) # one failure for the whole batch
+                    return "failure"
+
+                self._mark_batch(members, "allocate")
+
+                try:
+                    return self._execute_batch(batch, members, resource_instance, circuit_breaker)
+                finally:
+                    resource_pool.release(resource_instance)
+
+            finally:
+                for member in batch.members:
+                    if member[7] is not None:
+                        self._sample_timeline(resource_name, member[7])
+
+        except:
+            pmnc.log.error(exc_string()) # this should not normally happen, but do
+            raise                        # not allow such exception to be silenced
+
+    def _execute_batch(self, batch, members, resource_instance, circuit_breaker):
+
+        resource_name = batch.resource_name
+        abort_error = None # the error after which the batch cannot be committed
+        abort_index = None # the member that caused it
+
+        # the members that should not be started in as little time as their requests
+        # have left are declined, and tell nothing about the resource to its circuit breaker
+
+        accepted_members = []
+        for member in members:
+            xa, participant_index, *_ = member
+            if member[5].remain < resource_instance.min_time:
+                self._deliver_batched(xa, participant_index,
+                                      ResourceError(description = "transaction {0:s} is declined by resource instance "
+                                                                  "{1:s}".format(xa, resource_instance.name),
+                                                    participant_index = participant_index,
+                                                    recoverable = True, terminal = False))
+            else:
+                accepted_members.append(member)
+
+        members = accepted_members
+        if not members:
+            return "failure"
+
+        # begin one resource transaction for all the members, the request deadline
+        # is restricted for the course of it, just like for a single participant
+
+        restricted_deadline = self._restrict_deadline(resource_instance)
+
+        xa = members[0][0]
+        try:
+            resource_instance.begin_transaction(xa._xid,
+                                                source_module_name = xa._source_module_name,
+                                                transaction_options = xa._options,
+                                                resource_args = batch.res_args,
+                                                resource_kwargs = batch.res_kwargs)
+        except ResourceError as e:
+            abort_error = e
+            if e.terminal:
+                resource_instance.expire()
+        except Exception:
+            abort_error = ResourceError.snap_exception(recoverable = True, terminal = True)
+            resource_instance.expire()
+        else:
+            self._mark_batch(members, "begin")
+
+        # execute the members one by one until one of them fails irrecoverably
+
+        results = []
+        for i, (xa, participant_index, attrs, args, kwargs, *_, timeline) in enumerate(members):
+            if abort_error is not None:
+                break
+            try:
+                target_method = resource_instance
+                for attr in attrs:
+                    target_method = getattr(target_method, attr)
+                with pmnc.performance.timing("resource.{0:s}.processing_time".format(resource_name)):
+                    result = target_method(*args, **kwargs)
+            except ResourceError as e:
+                result = self._batch_error(e, participant_index)
+                if e.terminal:
+                    resource_instance.expire()
+                if e.terminal or not e.recoverable:
+                    abort_error, abort_index = e, i
+            except Exception:
+                result = ResourceError.snap_exception(participant_index = participant_index,
+                                                      recoverable = False, terminal = True)
+                resource_instance.expire()
+                abort_error, abort_index = result, i
+            finally:
+                self._mark(timeline, "execute")
+            results.append(result)
+
+        self._restore_deadline(restricted_deadline)
+
+        # the circuit breaker learns the outcome of each member actually executed,
+        # or of the batch as a whole if it could not begin, but not of the members
+        # that are about to fail only because some other member has aborted the batch
+
+        if circuit_breaker is not None:
+            if results:
+                for result in results:
+                    circuit_breaker.register(not isinstance(result, Exception))
+            else: # the resource transaction could not even begin
+                circuit_breaker.register(False)
+
+        # once the batch has been aborted, the rest of the members fail recoverably,
+        # because whatever they have done is rolled back along with the batch
+
+        if abort_error is not None:
+            for i, (xa, participant_index, *_) in enumerate(members):
+                if i == abort_index:
+                    continue
+                elif abort_index is None: # the resource transaction could not even begin
+                    result = self._batch_error(abort_error, participant_index, recoverable = True)
+                else:
+                    result = ResourceError(description = "batch execution of resource {0:s} has been aborted: "
+                                                         "{1:s}".format(resource_name, str(abort_error)),
+                                           participant_index = participant_index,
+                                           recoverable = True, terminal = False)
+                if i < len(results):
+                    results[i] = result
+                else:
+                    results.append(result)
+        else:
+            resource_instance.reset_idle_timeout()
+
+        # deliver the results to the pending transactions
+
+        for (xa, participant_index, *_), result in zip(members, results):
+            self._deliver_batched(xa, participant_index, result)
+
+        if abort_error is not None and abort_index is None:
+            return "failure" # there has been no resource transaction
+
+        # the batch is committed only if all the transactions with successful participants decide to commit
+
+        commit_batch = abort_error is None
+        for (xa, participant_index, *_), result in zip(members, results):
+            if not commit_batch:
+                break
+            if isinstance(result, Exception): # its transaction will surely rollback, but that's its own business
+                continue
+            if not pmnc.request.wait(xa._decision):
+                pmnc.log.warning("resource instance {0:s} had to abandon waiting for decision and "
+                                 "rollback the batch in transaction {1:s}".format(resource_instance.name, xa))
+                commit_batch = False
+            elif not xa._commit.is_set():
+                if pmnc.log.noise:
+                    pmnc.log.noise("resource instance {0:s} has to rollback the batch because of "
+                                   "transaction {1:s}".format(resource_instance.name, xa))
+                commit_batch = False
+
+        self._mark_batch(members, "decision")
+
+        # complete the resource transaction and return the outcome shared by all the members
+
+        if commit_batch:
+            try:
+                resource_instance.commit()
+            except:
+                self._mark_batch(members, "commit")
+                pmnc.log.error("resource instance {0:s} failed to commit batch of {1:d} participant(s): "
+                               "{2:s}".format(resource_instance.name, len(members), exc_string()))
+                resource_instance.expire()
+                return "failure"
+            else:
+                self._mark_batch(members, "commit")
+                if pmnc.log.noise:
+                    pmnc.log.noise("resource instance {0:s} committed batch of {1:d} participant(s)".\
+                                   format(resource_instance.name, len(members)))
+                return "commit"
+        else:
+            try:
+                resource_instance.rollback()
+            except:
+                self._mark_batch(members, "rollback")
+                pmnc.log.warning("resource instance {0:s} failed to rollback batch of {1:d} participant(s): "
+                                 "{2:s}".format(resource_instance.name, len(members), exc_string()))
+                resource_instance.expire()
+                return "failure"
+            else:
+                self._mark_batch(members, "rollback")
+                if pmnc.log.noise:
+                    pmnc.log.noise("resource instance {0:s} rolled back batch of {1:d} participant(s)".\
+                                   format(resource_instance.name, len(members)))
+                return "rollback"
+
+    @staticmethod
+    def _deliver_batched(xa, participant_index, result):
+        xa._results.push((participant_index, result, 0))
+        resource_failed = isinstance(result, Exception)
+        pmnc.performance.event("resource.{0:s}.transaction_rate.{1:s}".\
+                               format(xa._resources[participant_index][0],
+                                      resource_failed and "failure" or "success"))
+
+    @staticmethod
+    def _batch_error(resource_error, participant_index, *, recoverable = None):
+        return ResourceError(code = resource_error.code, description = resource_error.description,
+                             recoverable = resource_error.recoverable if recoverable is None else recoverable,
+                             terminal = resource_error.terminal, participant_index = participant_index)
+
+    ###################################
+
+    # the following methods record the timelines of the participants of a traced
+    # transaction, each timeline is a list of (phase, time at which it ended)
+    # preceded by ("start", time at which the participant has been enqueued)
+
+    def _start_timeline(self, participant_index, attempt):
+        if self._timelines is not None:
+            self._timelines[(participant_index, attempt)] = [ ("start", monotonic()) ]
+
+    @staticmethod
+    def _mark(timeline, phase):
+        if timeline is not None:
+            timeline.append((phase, monotonic()))
+
+    @classmethod
+    def _mark_batch(cls, members, phase):
+        for member in members:
+            cls._mark(member[7], phase)
+
+    @staticmethod
+    def _phases(timeline):
+        return [ (phase, t - pt) for (_, pt), (phase, t) in zip(timeline, timeline[1:]) ]
+
+    # this method is called by each participant upon completion
+    # and registers the time it has spent in each phase
+
+    def _sample_timeline(self, resource_name, timeline):
+        for phase, duration in self._phases(timeline):
+            pmnc.performance.sample("resource.{0:s}.{1:s}_time".format(resource_name, phase),
+                                    int(duration * 1000))
+
+    # this method is called upon the transaction completion and writes
+    # the timelines of all the participants to the log, if it took too long
+
+    def _dump_timelines(self):
+
+        timelines = sorted(self._timelines.items())
+        if not timelines:
+            return
+
+        transaction_start = min(timeline[0][1] for _, timeline in timelines)
+        duration = monotonic() - transaction_start
+        if duration < self._trace_threshold:
+            return
+
+        participants = []
+        for (participant_index, attempt), timeline in timelines:
+            phases = ", ".join("{0:s} {1:.01f}".format(phase, phase_duration * 1000)
+                               for phase, phase_duration in self._phases(timeline))
+            participants.append("#{0:d} {1:s}{2:s} at +{3:.01f}: {4:s}".format(
+                                participant_index, self._resources[participant_index][0],
+                                attempt and " (hedge)" or "",
+                                (timeline[0][1] - transaction_start) * 1000, phases or "none"))
+
+        pmnc.log.warning("transaction {0:s} took {1:.01f} ms, participant timelines "
+                         "(ms): {2:s}".format(self, duration * 1000, "; ".join(participants)))
+
     ###################################
 
     # this method analyzes the raw results of the not yet committed individual transactions and
@@ -741,7 +1549,7 @@ def __get_module_attr__(resource_name, *, __source_module_name):
         for attr in __call_attributes:
             resource = getattr(resource, attr)
         resource(*args, **kwargs)
-        return xa.execute()[0]
+        return xa._execute_inline()[0]
 
     return execute_transaction
 
@@ -751,8 +1559,8 @@ def self_test():
 
     from pmnc.request import fake_request
     from expected import expected
-    from typecheck import by_regex
-    from threading import Thread
+    from typecheck import by_regex, InputParameterError
+    from threading import Thread, current_thread
     from random import randint
     from time import sleep
     from pmnc.timeout import Timeout
@@ -943,6 +1751,41 @@ def self_test():
 
     ###################################
 
+    def test_stale_cache():
+
+        calls = []
+
+        def execute(res, *args, **kwargs):
+            calls.append(pmnc.request.interface)
+            return "value {0:d}".format(len(calls))
+
+        def get_value():
+            fake_request(1.0)
+            xa = pmnc.transaction.create()
+            xa.callable_5(execute = execute).execute("stale")
+            return xa.execute()[0]
+
+        assert get_value() == "value 1" and calls == [ "__fake__" ]
+        assert get_value() == "value 1" and len(calls) == 1
+
+        sleep(2.5) # expired but stale value is returned and refreshed in background
+
+        start = time()
+        assert get_value() == "value 1"
+        assert time() - start < 0.5
+        sleep(0.5)
+        assert calls == [ "__fake__", "__cache__" ]
+
+        assert get_value() == "value 2" and len(calls) == 2
+
+        sleep(4.5) # the value has perished, and is not returned
+
+        assert get_value() == "value 3" and calls[-1] == "__fake__"
+
+    test_stale_cache()
+
+    ###################################
+
     def test_connect_fails():
 
         # connect fails
@@ -1396,6 +2239,149 @@ def self_test():
 
     ###################################
 
+    def test_inline_transaction():
+
+        fake_request(10.0)
+
+        # the inline transaction is executed in the calling thread
+
+        def f():
+            return current_thread()
+
+        assert pmnc.transaction.void.execute(f) is current_thread()
+
+        xa = pmnc.transaction.create()
+        xa.void.execute(f)
+        assert xa.execute()[0] is not current_thread()
+
+        # but only if the resource thread pool has a thread to spare
+
+        tp = pmnc.shared_pools.get_thread_pool("void")
+        ths = []
+        th = tp.reserve()
+        while th is not None:
+            ths.append(th)
+            th = tp.reserve()
+        try:
+            with expected(TransactionExecutionError, "request deadline waiting for intermediate result from resource void .*"):
+                fake_request(1.0)
+                pmnc.transaction.void.execute(f)
+        finally:
+            for th in ths:
+                tp.unreserve(th)
+
+        fake_request(10.0)
+        assert pmnc.transaction.void.execute(f) is current_thread()
+
+        # commit, rollback and cached results are the same as with execute
+
+        def trace(): # events traced by callable_1, possibly connecting a new instance first
+            events = [ e[0] for e in iter(lambda: q.pop(0.0), None) ]
+            return events[1:] if events[:1] == [ "connect" ] else events
+
+        hooks = hooks_.copy()
+
+        xa = pmnc.transaction.create()
+        xa.callable_1(**hooks).execute()
+        assert xa._execute_inline() == ("ok", )
+        assert trace() == [ "begin_transaction", "execute", "commit" ]
+
+        def reject(xa, results):
+            raise Exception("rejected")
+
+        xa = pmnc.transaction.create(accept = reject)
+        xa.callable_1(**hooks).execute()
+        with expected(Exception("rejected")):
+            xa._execute_inline()
+        assert trace() == [ "begin_transaction", "execute", "rollback" ] # rollback is complete before the caller gets the error
+
+        def execute(res, *args, **kwargs):
+            1 / 0
+        hooks["execute"] = execute
+
+        xa = pmnc.transaction.create()
+        xa.callable_1(**hooks).execute()
+        try:
+            xa._execute_inline()
+        except ResourceError as e:
+            assert e.participant_index == 0 and e.terminal and not e.recoverable
+        else:
+            assert False
+        assert trace() == [ "begin_transaction", "rollback", "disconnect" ]
+
+        def commit(res):
+            raise Exception("commit failed")
+        hooks = hooks_.copy(); hooks["commit"] = commit
+
+        xa = pmnc.transaction.create()
+        xa.callable_1(**hooks).execute()
+        try:
+            xa._execute_inline()
+        except TransactionCommitError as e:
+            assert str(e) == "transaction {0:s} got unexpected commit outcome " \
+                             "from resource callable_1: failure".format(xa)
+            assert e.participant_index == 0
+        else:
+            assert False
+        sleep(1.0)
+        assert trace() == [ "begin_transaction", "execute", "disconnect" ]
+
+        calls = []
+
+        def execute(res, *args, **kwargs):
+            calls.append(args)
+            return "cached"
+
+        xa = pmnc.transaction.create()
+        xa.callable_4(execute = execute).execute(10, pool__cache_get = lambda key, **kwargs: None,
+                                                 pool__cache_put = lambda key, value, **kwargs: None)
+        assert xa._execute_inline() == ("cached", ) and calls == [ (10, ) ]
+
+        # resource max_time is respected and the request deadline is restored
+
+        def f():
+            return pmnc.request.remain
+
+        fake_request(10.0)
+        assert 4.0 < pmnc.transaction.void.execute(f) < 6.0
+        assert pmnc.request.remain > 9.0
+
+    test_inline_transaction()
+
+    ###################################
+
+    def test_inline_latency():
+
+        N = 1000
+
+        def pooled():
+            xa = pmnc.transaction.create()
+            xa.void.success()
+            xa.execute()
+
+        def inline():
+            pmnc.transaction.void.success()
+
+        def latency(f):
+            fake_request(60.0)
+            start = time()
+            for i in range(N):
+                f()
+            return (time() - start) * 1000 / N
+
+        pmnc._loader.set_log_level("LOG")
+        try:
+            pooled_ms, inline_ms = latency(pooled), latency(inline)
+        finally:
+            pmnc._loader.set_log_level("DEBUG")
+
+        pmnc.log("single participant transaction latency: {0:.03f} ms pooled, "
+                 "{1:.03f} ms inline".format(pooled_ms, inline_ms))
+
+    test_inline_latency()
+
+    ###################################
+
     def test_no_accept():
 
         fake_request(1.0)
@@ -1459,6 +2445,511 @@ def self_test():
 
     ###################################
 
+    def test_hedging():
+
+        fake_request(10.0)
+
+        with expected(InputParameterError):
+            pmnc.transaction.create(hedge_after = "95")
+
+        with expected(InputParameterError):
+            pmnc.transaction.create(hedge_after = "p100")
+
+        Transaction._latency_samplers.pop("callable_1", None)
+        Transaction._hedge_counts.pop("callable_1", None)
+
+        def trace():
+            return [ e[0] for e in iter(lambda: q.pop(0.0), None) if e[0] in ("commit", "rollback") ]
+
+        delays = []
+
+        def execute(res, *args, **kwargs): # each attempt takes the next delay
+            delay = delays.pop(0)
+            sleep(abs(delay))
+            if delay < 0.0:
+                raise Exception("failure")
+            return delay
+
+        hooks = hooks_.copy(); hooks["execute"] = execute
+
+        def hedged_transaction():
+            fake_request(3.0)
+            xa = pmnc.transaction.create(hedge_after = "p90")
+            xa.callable_1(**hooks).execute()
+            try:
+                return xa.execute()[0]
+            finally:
+                sleep(1.2) # let the loser complete
+
+        # no hedging before the latency statistics is collected
+
+        delays.extend([ 0.1 ] * Transaction._hedge_min_readings)
+        for i in range(Transaction._hedge_min_readings):
+            assert hedged_transaction() == 0.1
+        assert trace() == [ "commit" ] * Transaction._hedge_min_readings
+
+        latency_sampler = Transaction._latency_samplers["callable_1"]
+        assert latency_sampler.count == Transaction._hedge_min_readings
+        assert 0.1 < latency_sampler.percentile(90.0) < 0.2
+        assert Transaction.get_hedge_stats().get("callable_1") is None
+
+        for i in range(80): # so that the few slow readings below do not move the percentile
+            latency_sampler += 0.1
+
+        def latencies_since(count):
+            return sorted(latency_sampler._data[count:])
+
+        # the hedge wins, the losing original is sampled once it completes
+
+        count = latency_sampler.count
+        delays.extend([ 1.0, 0.01 ])
+        assert hedged_transaction() == 0.01
+        assert sorted(trace()) == [ "commit", "rollback" ]
+        assert Transaction.get_hedge_stats()["callable_1"] == (1, 1)
+        latencies = latencies_since(count)
+        assert len(latencies) == 2 and latencies[0] < 0.1 and latencies[1] >= 1.0
+
+        # the hedge wins, the original fails afterwards and is sampled with the time it took
+
+        count = latency_sampler.count
+        delays.extend([ -1.0, 0.01 ])
+        assert hedged_transaction() == 0.01
+        assert sorted(trace()) == [ "commit", "rollback" ]
+        assert Transaction.get_hedge_stats()["callable_1"] == (2, 2)
+        latencies = latencies_since(count)
+        assert len(latencies) == 2 and latencies[0] < 0.1 and latencies[1] >= 1.0
+
+        # the original wins, the losing hedge is sampled once it completes
+
+        count = latency_sampler.count
+        delays.extend([ 0.3, 1.0 ])
+        assert hedged_transaction() == 0.3
+        assert sorted(trace()) == [ "commit", "rollback" ]
+        assert Transaction.get_hedge_stats()["callable_1"] == (3, 2)
+        latencies = latencies_since(count)
+        assert len(latencies) == 2 and 0.3 <= latencies[0] < 1.0 <= latencies[1]
+
+        # the original fails, but the hedge succeeds, the failure before the decision is not sampled
+
+        count = latency_sampler.count
+        delays.extend([ -0.3, 0.5 ])
+        assert hedged_transaction() == 0.5
+        assert sorted(trace()) == [ "commit", "rollback" ]
+        assert Transaction.get_hedge_stats()["callable_1"] == (4, 3)
+        latencies = latencies_since(count)
+        assert len(latencies) == 1 and latencies[0] >= 0.5
+
+        # both fail
+
+        count = latency_sampler.count
+        delays.extend([ -0.3, -0.4 ])
+        with expected(ResourceError, "failure"):
+            hedged_transaction()
+        assert trace() == [ "rollback", "rollback" ]
+        assert Transaction.get_hedge_stats()["callable_1"] == (5, 3)
+        assert latency_sampler.count == count
+
+        # the original fails before the hedge is launched
+
+        delays.extend([ -0.001 ])
+        with expected(ResourceError, "failure"):
+            hedged_transaction()
+        assert trace() == [ "rollback" ]
+        assert Transaction.get_hedge_stats()["callable_1"] == (5, 3)
+
+        # transactions without hedging are not hedged
+
+        fake_request(3.0)
+        delays.extend([ 0.5 ])
+        xa = pmnc.transaction.create()
+        xa.callable_1(**hooks).execute()
+        assert xa.execute() == (0.5, )
+        assert trace() == [ "commit" ]
+        assert Transaction.get_hedge_stats()["callable_1"] == (5, 3)
+
+        assert delays == []
+
+    test_hedging()
+
+    ###################################
+
+    def test_hedging_cached():
+
+        Transaction._latency_samplers.pop("callable_4", None)
+        Transaction._hedge_counts.pop("callable_4", None)
+
+        def execute(res, delay):
+            sleep(delay)
+            return delay
+
+        def transaction(delay, cache_key, **options):
+            fake_request(3.0)
+            xa = pmnc.transaction.create(**options)
+            xa.callable_4(execute = execute).execute(delay, pool__cache_key = cache_key)
+            return xa.execute()[0]
+
+        # mostly cached workload, the cache hits do not count as latency readings
+
+        assert transaction(0.1, "hit", hedge_after = "p90") == 0.1
+        for i in range(Transaction._hedge_min_readings - 1):
+            assert transaction(0.1, None, hedge_after = "p90") == 0.1
+            for j in range(10):
+                assert transaction(0.0, "hit", hedge_after = "p90") == 0.1
+
+        latency_sampler = Transaction._latency_samplers["callable_4"]
+        assert latency_sampler.count == Transaction._hedge_min_readings
+        assert latency_sampler.percentile(90.0) > 0.1
+
+        # neither do the transactions without hedging
+
+        assert transaction(0.0, None) == 0.0
+        assert latency_sampler.count == Transaction._hedge_min_readings
+
+        # therefore a cache miss is not hedged right away
+
+        assert transaction(0.05, None, hedge_after = "p90") == 0.05
+        assert Transaction.get_hedge_stats().get("callable_4") is None
+
+    test_hedging_cached()
+
+    ###################################
+
+    def test_circuit_breaker():
+
+        executed = []
+
+        def execute(res, *args, **kwargs):
+            executed.append(args[0])
+            if args[0] == "fail":
+                raise Exception("failure")
+            return args[0]
+
+        def breaker_transaction(arg):
+            fake_request(1.0)
+            xa = pmnc.transaction.create()
+            xa.callable_6(execute = execute).execute(arg)
+            return xa.execute()[0]
+
+        assert pmnc.shared_pools.get_circuit_breaker("void") is None
+        assert breaker_transaction("ok") == "ok"
+        assert pmnc.shared_pools.get_breaker_stats()["callable_6"] == ("closed", 0, 0.0)
+
+        # the breaker opens after consecutive failures
+
+        for i in range(3):
+            with expected(ResourceError, "failure"):
+                breaker_transaction("fail")
+
+        assert pmnc.shared_pools.get_breaker_stats()["callable_6"][:2] == ("open", 3)
+        assert executed == [ "ok", "fail", "fail", "fail" ]
+
+        # while it is open, the participants fail instantly
+
+        fake_request(1.0)
+        xa = pmnc.transaction.create()
+        xa.callable_6(execute = execute).execute("ok")
+        try:
+            xa.execute()
+        except ResourceError as e:
+            assert str(e) == "circuit breaker for resource callable_6 is open"
+            assert e.participant_index == 0 and e.recoverable
+        else:
+            assert False
+
+        assert executed == [ "ok", "fail", "fail", "fail" ]
+        assert pmnc.shared_pools.get_breaker_stats()["callable_6"][:2] == ("open", 3)
+
+        # the failed probe reopens it
+
+        sleep(1.1)
+        assert pmnc.shared_pools.get_breaker_stats()["callable_6"][0] == "half-open"
+        with expected(ResourceError, "failure"):
+            breaker_transaction("fail")
+        with expected(ResourceError, "circuit breaker for resource callable_6 is open"):
+            breaker_transaction("ok")
+
+        # and the successful probe closes it
+
+        sleep(1.1)
+        assert breaker_transaction("ok") == "ok"
+        assert breaker_transaction("ok") == "ok"
+        assert pmnc.shared_pools.get_breaker_stats()["callable_6"] == ("closed", 0, 0.0)
+        assert executed == [ "ok", "fail", "fail", "fail", "fail", "ok", "ok" ]
+
+    test_circuit_breaker()
+
+    ###################################
+
+    def test_circuit_breaker_cache():
+
+        executed = []
+
+        def execute(res, *args, **kwargs):
+            executed.append(args[0])
+            if args[0].startswith("fail"):
+                raise Exception("failure")
+            return args[0]
+
+        def cached_transaction(arg):
+            fake_request(1.0)
+            xa = pmnc.transaction.create()
+            xa.callable_8(execute = execute).execute(arg)
+            return xa.execute()[0]
+
+        def breaker_state():
+            return pmnc.shared_pools.get_breaker_stats()["callable_8"][:2]
+
+        assert cached_transaction("ok") == "ok"
+        assert breaker_state() == ("closed", 0)
+
+        # the cache hits do not reset the consecutive failures
+
+        with expected(ResourceError, "failure"):
+            cached_transaction("fail-1")
+        assert cached_transaction("ok") == "ok"
+        assert breaker_state() == ("closed", 1)
+        with expected(ResourceError, "failure"):
+            cached_transaction("fail-2")
+        assert breaker_state() == ("open", 2)
+
+        # while it is open, the cached results are still returned
+
+        assert cached_transaction("ok") == "ok"
+        with expected(ResourceError, "circuit breaker for resource callable_8 is open"):
+            cached_transaction("new")
+        assert executed == [ "ok", "fail-1", "fail-2" ]
+
+        # the cache hits are not taken for probes, and do not close it
+
+        sleep(1.1)
+        assert cached_transaction("ok") == "ok"
+        assert cached_transaction("ok") == "ok"
+        assert breaker_state() == ("half-open", 2)
+        with expected(ResourceError, "failure"):
+            cached_transaction("fail-3")
+        assert breaker_state() == ("open", 3)
+        assert cached_transaction("ok") == "ok"
+
+        sleep(1.1)
+        assert cached_transaction("ok") == "ok"
+        assert cached_transaction("new") == "new"
+        assert breaker_state() == ("closed", 0)
+        assert executed == [ "ok", "fail-1", "fail-2", "fail-3", "new" ]
+
+    test_circuit_breaker_cache()
+
+    ###################################
+
+    def test_tracing():
+
+        fake_request(3.0)
+
+        xa = pmnc.transaction.create()
+        assert xa._timelines is None
+
+        def phases(xa):
+            return [ (idx, [ phase for phase, duration in xa._phases(timeline) ])
+                     for idx, timeline in sorted(xa._timelines.items()) ]
+
+        def duration(xa, idx, phase):
+            return dict(xa._phases(xa._timelines[idx]))[phase]
+
+        hooks = hooks_.copy(); hooks["execute"] = lambda res, *args, **kwargs: sleep(0.2) or "ok"
+
+        # pooled transaction
+
+        xa = pmnc.transaction.create(trace_threshold = 0.0)
+        xa.callable_1(**hooks).execute()
+        xa.callable_1(**hooks_).execute()
+        assert xa.execute() == ("ok", "ok")
+
+        assert phases(xa) == [ ((0, 0), [ "thread", "cache", "allocate", "begin", "execute", "decision", "commit" ]),
+                               ((1, 0), [ "thread", "cache", "allocate", "begin", "execute", "decision", "commit" ]) ]
+        assert 0.2 <= duration(xa, (0, 0), "execute") < 0.3
+        assert duration(xa, (1, 0), "execute") < 0.1
+        assert 0.1 < duration(xa, (1, 0), "decision") < 0.3 # waiting for the other participant
+
+        # inline transaction
+
+        hooks = hooks_.copy(); hooks["execute"] = lambda res, *args, **kwargs: 1 / 0
+
+        xa = pmnc.transaction.create(trace_threshold = 10.0)
+        xa.callable_1(**hooks).execute()
+        with expected(ResourceError):
+            xa._execute_inline()
+
+        assert phases(xa) == [ ((0, 0), [ "thread", "cache", "allocate", "begin", "execute", "decision", "rollback" ]) ]
+        assert duration(xa, (0, 0), "thread") < 0.01
+
+        # participant that fails to allocate
+
+        xa = pmnc.transaction.create(trace_threshold = 0.0)
+        xa.callable_2(**hooks_).execute()
+        with expected(ResourceError):
+            xa.execute()
+
+        assert phases(xa) == [ ((0, 0), [ "thread", "cache" ]) ]
+
+        while q.pop(0.0) is not None:
+            pass
+
+    test_tracing()
+
+    ###################################
+
+    def test_batching():
+
+        calls = []
+
+        def begin_transaction(res, *args, **kwargs):
+            calls.append("begin")
+
+        def execute(res, arg):
+            calls.append(arg)
+            if arg.startswith("fail"):
+                raise ResourceError(description = "fail", recoverable = True, terminal = False)
+            elif arg == "abort":
+                raise Exception("abort")
+            return arg
+
+        hooks = dict(begin_transaction = begin_transaction, execute = execute,
+                     commit = lambda res: calls.append("commit"),
+                     rollback = lambda res: calls.append("rollback"))
+
+        def accept(xa, results):
+            if results[0] == "reject":
+                raise Exception("rejected")
+            return xa._default_accept(xa, results)
+
+        def batched_transaction(arg, results):
+            fake_request(arg == "short" and 1.2 or 3.0)
+            xa = pmnc.transaction.create(batch = True, accept = accept)
+            xa.callable_7(**hooks).execute(arg)
+            try:
+                results[arg] = xa.execute()[0]
+            except Exception as e:
+                results[arg] = e
+
+        def run_batch(*args):
+            del calls[:]
+            results = {}
+            ths = []
+            for arg in args:
+                th = Thread(target = batched_transaction, args = (arg, results))
+                th.start(); ths.append(th)
+                sleep(0.05)
+            for th in ths:
+                th.join()
+            return results
+
+        assert pmnc.shared_pools.get_batching("callable_7") == (0.5, 3)
+
+        # full batch is executed right away
+
+        start = time()
+        assert run_batch("a", "b", "c") == dict(a = "a", b = "b", c = "c")
+        assert time() - start < 0.4
+        assert calls == [ "begin", "a", "b", "c", "commit" ]
+
+        # incomplete batch waits for the linger time
+
+        start = time()
+        assert run_batch("a", "b") == dict(a = "a", b = "b")
+        assert time() - start > 0.5
+        assert calls == [ "begin", "a", "b", "commit" ]
+
+        # recoverable failure affects only its own transaction
+
+        results = run_batch("a", "fail", "b")
+        assert calls == [ "begin", "a", "fail", "b", "commit" ]
+        assert results["a"] == "a" and results["b"] == "b"
+        assert isinstance(results["fail"], ResourceError) and str(results["fail"]) == "fail"
+        assert results["fail"].recoverable and results["fail"].participant_index == 0
+
+        # irrecoverable failure aborts the batch
+
+        results = run_batch("a", "abort", "b")
+        assert calls == [ "begin", "a", "abort", "rollback" ]
+        assert isinstance(results["abort"], ResourceError) and str(results["abort"]) == "abort"
+        assert not results["abort"].recoverable
+        for arg in ("a", "b"):
+            assert isinstance(results[arg], ResourceError) and results[arg].recoverable
+            assert str(results[arg]) == "batch execution of resource callable_7 has been aborted: abort"
+
+        # transaction deciding to rollback rolls back the batch
+
+        results = run_batch("a", "reject", "b")
+        assert calls == [ "begin", "a", "reject", "b", "rollback" ]
+        assert str(results["reject"]) == "rejected"
+        for arg in ("a", "b"):
+            assert isinstance(results[arg], TransactionCommitError)
+            assert str(results[arg]).endswith("got unexpected commit outcome from resource callable_7: rollback")
+
+        # transactions that are not batched execute separately
+
+        del calls[:]
+        fake_request(3.0)
+        xa = pmnc.transaction.create()
+        xa.callable_7(**hooks).execute("x")
+        assert xa.execute() == ("x", )
+        assert calls == [ "begin", "x", "commit" ]
+
+        # the cache options are not passed to the resource
+
+        del calls[:]
+        fake_request(3.0)
+        xa = pmnc.transaction.create(batch = True)
+        xa.callable_7(**hooks).execute("k", pool__cache_key = None)
+        assert xa.execute() == ("k", )
+        assert calls == [ "begin", "k", "commit" ]
+
+        # batched participants are traced just like the others
+
+        del calls[:]
+        fake_request(3.0)
+        xa = pmnc.transaction.create(batch = True, trace_threshold = 0.0)
+        xa.callable_7(**hooks).execute("t")
+        assert xa.execute() == ("t", )
+        assert calls == [ "begin", "t", "commit" ]
+
+        phases = xa._phases(xa._timelines[(0, 0)])
+        assert [ phase for phase, duration in phases ] == [ "thread", "allocate", "begin", "execute", "decision", "commit" ]
+        assert phases[0][1] >= 0.5 # waiting for the batch to fill up
+
+        # the participant with too little time left is declined
+
+        results = run_batch("a", "short")
+        assert calls == [ "begin", "a", "commit" ]
+        assert results["a"] == "a"
+        assert isinstance(results["short"], ResourceError) and results["short"].recoverable
+        assert str(results["short"]).startswith("transaction XA-")
+        assert " is declined by resource instance callable_7/" in str(results["short"])
+
+        # the batches go through the circuit breaker
+
+        assert pmnc.shared_pools.get_breaker_stats()["callable_7"][:2] == ("closed", 0)
+        run_batch("abort", "a", "b") # only the member that has failed counts
+        assert calls == [ "begin", "abort", "rollback" ]
+        assert pmnc.shared_pools.get_breaker_stats()["callable_7"][:2] == ("closed", 1)
+        run_batch("fail-1", "fail-2")
+        assert pmnc.shared_pools.get_breaker_stats()["callable_7"][:2] == ("closed", 3)
+        run_batch("fail-3")
+        assert pmnc.shared_pools.get_breaker_stats()["callable_7"][:2] == ("open", 4)
+
+        results = run_batch("a", "b")
+        assert calls == []
+        for arg in ("a", "b"):
+            assert isinstance(results[arg], ResourceError) and results[arg].recoverable
+            assert str(results[arg]) == "circuit breaker for resource callable_7 is open"
+
+        sleep(1.1)
+        assert run_batch("a", "b", "c") == dict(a = "a", b = "b", c = "c")
+        assert pmnc.shared_pools.get_breaker_stats()["callable_7"] == ("closed", 0, 0.0)
+
+    test_batching()
+
+    ###################################
+
     def test_partial_commit():
 
         def accept_anything(xa, results):
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+#-*- coding: iso-8859-1 -*-
+################################################################################
+#
+# This module implements reading of the structured cage-yyyymmdd.jsonl logs
+# written by log_writer.py. The log file is memory mapped, and the lines are
+# fetched without scanning the entire file:
+#
+# request_lines("RQ-89AB") uses the sidecar index cage-yyyymmdd.jsonl.idx
+# to find the lines logged on behalf of a request, the request can be
+# specified either by its full unique id, or by the short id "RQ-XXXX"
+# as it appears in the log, in which case all the requests of that day
+# with matching ids are returned, the index is a hash table (see its
+# format in log_writer.py) and only the records in the bucket of the
+# request are visited,
+#
+# time_lines(start, end) uses binary search over the file to find the
+# lines logged within a time range, this works because the lines are
+# written in order of time.
+#
+# It is used by the command line tool tools/logsearch.py.
+#
+# Pythomnic3k project
+# (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
+# Distributed under BSD license
+#
+################################################################################
+
+__all__ = [ "LogReader" ]
+
+################################################################################
+
+import os; from os import path as os_path
+import mmap; from mmap import mmap, ACCESS_READ
+import json; from json import loads
+import struct; from struct import unpack
+
+if __name__ == "__main__": # add pythomnic/lib to sys.path
+    import os; import sys
+    main_module_dir = os.path.dirname(sys.modules["__main__"].__file__) or os.getcwd()
+    sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..")))
+
+import typecheck; from typecheck import typecheck
+import pmnc.log_writer; from pmnc.log_writer import LogWriter
+
+################################################################################
+
+class LogReader:
+
+    @typecheck
+    def __init__(self, filename: os_path.isfile):
+
+        self._index_file_name = filename + ".idx"
+
+        # the lines appended after the file has been mapped are not seen
+
+        self._file = open(filename, "rb")
+        try:
+            self._size = os.fstat(self._file.fileno()).st_size
+            self._map = self._size and mmap(self._file.fileno(), 0, access = ACCESS_READ) or b""
+        except:
+            self._file.close()
+            raise
+
+    def close(self):
+        if self._size:
+            self._map.close()
+        self._file.close()
+
+    ###################################
+
+    # format a parsed line the same way the plain text log does
+
+    @staticmethod
+    def format_line(record: dict) -> str:
+        return "{0:s} {1:s} [{2:s}] {3:s}".format(record["time"], record["level"],
+                                                  record["thread"], record["message"])
+
+    ###################################
+
+    # returns the parsed line at the offset, or None if the line is incomplete
+
+    def _line(self, offset):
+        end = self._map.find(b"\n", offset, self._size)
+        if end < 0:
+            return None
+        return loads(self._map[offset:end].decode("ascii"))
+
+    # returns the offset of the first line starting at or after the position
+
+    def _line_start(self, position):
+        if position == 0:
+            return 0
+        end = self._map.find(b"\n", position - 1, self._size)
+        return end + 1 if end >= 0 else self._size
+
+    def _next_line(self, offset):
+        end = self._map.find(b"\n", offset, self._size)
+        return end + 1 if end >= 0 else self._size
+
+    ###################################
+
+    @typecheck
+    def request_lines(self, request_id: str) -> list:
+
+        bucket = LogWriter.index_bucket(request_id) # the same for the full and the short id
+        request_id = request_id.encode("ascii")
+        short_id = len(request_id) == 7 and request_id[3:] or None
+
+        # the index is mapped anew for each lookup, because it is still being written
+        # to, the head of a bucket never points to a record that has not been written
+
+        try:
+            index_file = open(self._index_file_name, "rb")
+        except FileNotFoundError:
+            return []
+
+        offsets = set()
+        try:
+            if os.fstat(index_file.fileno()).st_size < LogWriter.index_header_size:
+                return []
+            index = mmap(index_file.fileno(), 0, access = ACCESS_READ)
+            try:
+                record = unpack(">Q", index[bucket * 8:bucket * 8 + 8])[0]
+                while record:
+                    end = index.find(b"\n", record)
+                    if end < 0:
+                        break
+                    index_id, offset, previous = index[record:end].split(b" ")
+                    if index_id == request_id or (short_id and index_id.endswith(short_id)):
+                        offsets.add(int(offset))
+                    previous = int(previous)
+                    if previous >= record: # the chain only goes back
+                        break
+                    record = previous
+            finally:
+                index.close()
+        finally:
+            index_file.close()
+
+        lines = [ self._line(offset) for offset in sorted(offsets) if offset < self._size ]
+        return [ line for line in lines if line is not None ]
+
+    ###################################
+
+    @typecheck
+    def time_lines(self, start: float, end: float) -> list:
+
+        # find the first line logged at or after start, the invariant is that
+        # it starts somewhere between the first lines starting at lo and hi
+
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self._line_start(mid)
+            line = offset < hi and self._line(offset) or None
+            if line is not None and line["ts"] < start:
+                lo = self._next_line(offset)
+            else:
+                hi = mid
+
+        lines = []
+        offset = self._line_start(lo)
+        while offset < self._size:
+            line = self._line(offset)
+            if line is None or line["ts"] > end:
+                break
+            lines.append(line)
+            offset = self._next_line(offset)
+
+        return lines
+
+################################################################################
+
+if __name__ == "__main__":
+
+    print("self-testing module log_reader.py:")
+
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from time import time
+    from threading import current_thread
+    from pmnc.log_writer import LogWriter
+    from pmnc.request import Request
+
+    temp_dir = mkdtemp()
+    try:
+
+        ###################################
+
+        # lines logged by two interleaving requests and with no request
+
+        lw = LogWriter(temp_dir, "test", log_format = "jsonl")
+        try:
+            th = current_thread()
+            th.name = "main"
+            requests = [ Request(timeout = 10.0, interface = "foo", protocol = "n/a"),
+                         Request(timeout = 10.0, interface = "bar", protocol = "n/a") ]
+            for i in range(1000):
+                th._request = i % 10 != 9 and requests[i % 2] or None
+                lw("line {0:d}".format(i), msg_level = 4)
+            del th._request
+            lw("", msg_level = 1)
+        finally:
+            lw.close()
+
+        filename = os_path.join(temp_dir, os.listdir(temp_dir)[0])
+        if filename.endswith(".idx"):
+            filename = filename[:-4]
+
+        lr = LogReader(filename)
+        try:
+
+            # all the lines of one request are fetched through the index
+
+            lines = lr.request_lines(requests[0].unique_id)
+            assert [ line["message"] for line in lines ] == [ "line {0:d}".format(i) for i in range(1000) if i % 2 == 0 ]
+            assert all(line["request"] == requests[0].unique_id and line["interface"] == "foo" for line in lines)
+            assert LogReader.format_line(lines[0]).endswith(" LOG [main] line 0")
+
+            short_id = "RQ-" + requests[1].unique_id[-4:]
+            assert [ line["message"] for line in lr.request_lines(short_id) ] == \
+                   [ "line {0:d}".format(i) for i in range(1000) if i % 2 == 1 and i % 10 != 9 ]
+
+            assert lr.request_lines("RQ-NONE") == []
+
+            # lines within a time range are found by binary search
+
+            all_lines = lr.time_lines(0.0, time() + 1.0)
+            assert [ line["message"] for line in all_lines ] == [ "line {0:d}".format(i) for i in range(1000) ]
+            assert all_lines[9]["request"] is None and all_lines[9]["interface"] is None
+
+            t = [ line["ts"] for line in all_lines ]
+            start, end = t[250], t[750]
+            lines = lr.time_lines(start, end)
+            assert lines and lines[0]["ts"] >= start and lines[-1]["ts"] <= end
+            assert [ line["message"] for line in lines ] == \
+                   [ line["message"] for line in all_lines if start <= line["ts"] <= end ]
+
+            assert lr.time_lines(t[-1] + 1.0, t[-1] + 2.0) == []
+            assert lr.time_lines(0.0, t[0] - 1.0) == []
+
+        finally:
+            lr.close()
+
+        ###################################
+
+        # an incomplete last line is ignored, a missing index is not an error
+
+        with open(filename, "ab") as f:
+            f.write(b"{\"ts\": 0")
+        os.remove(filename + ".idx")
+
+        lr = LogReader(filename)
+        try:
+            assert len(lr.time_lines(0.0, time() + 1.0)) == 1000
+            assert lr.request_lines(requests[0].unique_id) == []
+        finally:
+            lr.close()
+
+        ###################################
+
+        # an empty file
+
+        filename = os_path.join(temp_dir, "empty.jsonl")
+        open(filename, "wb").close()
+
+        lr = LogReader(filename)
+        try:
+            assert lr.time_lines(0.0, time()) == []
+            assert lr.request_lines("RQ-0000") == []
+        finally:
+            lr.close()
+
+        ###################################
+
+        # a request among many lines of many other requests in a large file
+
+        filename = os_path.join(temp_dir, "large")
+        os.mkdir(filename)
+        lw = LogWriter(filename, "test", capacity = 1000000, log_format = "jsonl")
+        try:
+            request = Request(timeout = 10.0, interface = "foo", protocol = "n/a")
+            others = [ Request(timeout = 10.0, interface = "foo", protocol = "n/a") for i in range(1000) ]
+            for i in range(200000):
+                th._request = i % 10000 == 5000 and request or others[i % 1000]
+                lw("some log message of moderate length {0:d}".format(i), msg_level = 5)
+            del th._request
+            lw("", msg_level = 1)
+        finally:
+            lw.close()
+
+        filename = os_path.join(filename, [ fn for fn in os.listdir(filename) if fn.endswith(".jsonl") ][0])
+
+        start = time()
+        with open(filename, "rb") as f:
+            scanned = [ line for line in f if request.unique_id.encode("ascii") in line ]
+        scan_time = time() - start
+
+        lr = LogReader(filename)
+        try:
+            start = time()
+            lines = lr.request_lines(request.unique_id)
+            index_time = time() - start
+        finally:
+            lr.close()
+
+        assert len(lines) == len(scanned) == 20
+        print("{0:.02f} ms to scan the log, {1:.02f} ms with the index".\
+              format(scan_time * 1000, index_time * 1000))
+
+    finally:
+        rmtree(temp_dir)
+
+    print("ok")
+
+################################################################################
+# EOF
@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+#-*- coding: iso-8859-1 -*-
+################################################################################
+#
+# This module implements the cage log writer used by startup.py. An instance
+# of LogWriter is the log function passed to the module loader:
+#
+# log(message, msg_level = 4)
+#
+# The calling thread only appends the message to a bounded buffer, the lines
+# are formatted, encoded and written by a separate writer thread, which
+# coalesces all the lines accumulated since its previous pass into a single
+# write. The time prefix of a line is formatted once per second. The log file
+# is rotated daily, as cage-yyyymmdd.log.
+#
+# An error (msg_level = 1) is not only written but also synced to disk before
+# the logging thread proceeds, the same happens with an empty message, which
+# is therefore used to flush the log explicitly. Any number of threads waiting
+# for a flush at the same time are released by a single fsync. The lines that
+# fail to be written are lost, but the writer keeps going. The writer is closed
+# at exit, if it has not been closed before, so that the buffered lines are
+# written out even if the process exits abnormally.
+#
+# When the buffer is full, one of the following overflow policies applies:
+#
+# "block"  - the logging thread waits until there is room in the buffer,
+# "drop"   - the line is dropped,
+# "sample" - one line in sample_rate waits for room, the rest are dropped.
+#
+# The number of dropped lines is reported in the log once the writer catches
+# up. Errors are never dropped.
+#
+# The log can also be written in the structured "jsonl" format, as
+# cage-yyyymmdd.jsonl, one JSON object per line, with time, level, thread,
+# request, interface and module as separate fields, for example
+#
+# {"ts": 1400000000.12, "time": "20:53:20.12", "level": "LOG", "thread": "interface:1",
+#  "request": "RQ-20140513205320-0123456789AB", "interface": "rpc", "module": "foo",
+#  "message": "bar # foo.py:12 in baz() by RQ-89AB (...) via rpc +0.0s"}
+#
+# Along with it, a sidecar index cage-yyyymmdd.jsonl.idx is written, so that
+# all the lines of a request can be found without scanning the entire log,
+# see log_reader.py. The index is a hash table of chains. It starts with
+# a fixed header of index_buckets 8-byte big-endian offsets, each pointing
+# to the last record in its bucket, or 0 if there is none. The header is
+# followed by one "request_id offset previous\n" record for each log line
+# written on behalf of a request, where previous is the offset of the previous
+# record in the same bucket, or 0. A request hashes into a bucket by its last
+# four characters, the same as its short id "RQ-XXXX" in the log, therefore
+# a lookup by either id only follows the records of the requests that share
+# that bucket. The format can be changed at runtime, the next line is then
+# written to the file of the new format.
+#
+# Pythomnic3k project
+# (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
+# Distributed under BSD license
+#
+################################################################################
+
+__all__ = [ "LogWriter" ]
+
+################################################################################
+
+import os; from os import path as os_path, write, pwrite, pread, fsync, ftruncate, close
+import threading; from threading import Lock, Condition, current_thread
+import time; from time import time, localtime, strftime
+import collections; from collections import deque
+import json; from json import dumps
+import re; from re import compile as regex
+import struct; from struct import pack, unpack
+import zlib; from zlib import crc32
+import atexit; from atexit import register as atexit_register
+
+if __name__ == "__main__": # add pythomnic/lib to sys.path
+    import os; import sys
+    main_module_dir = os.path.dirname(sys.modules["__main__"].__file__) or os.getcwd()
+    sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..")))
+
+import typecheck; from typecheck import typecheck, one_of
+import pmnc.popen; from pmnc.popen import fopen
+import pmnc.threads; from pmnc.threads import LightThread
+
+################################################################################
+
+valid_overflow_policy = one_of("block", "drop", "sample")
+valid_log_format = one_of("text", "jsonl")
+
+################################################################################
+
+class LogWriter:
+
+    log_abbrevs = { 1: "ERR", 2: "MSG", 3: "WRN", 4: "LOG", 5: "INF", 6: "DBG", 7: "NSE" }
+    log_encoding = "windows-1251"
+    log_translate = b"         \t                      " + bytes(range(32, 256))
+    log_source = regex("^ # ([A-Za-z0-9_.]+)\\.py:[0-9]+ in ")
+    index_buckets = 65536
+    index_header_size = index_buckets * 8
+
+    @typecheck
+    def __init__(self, logs_dir: str, cage: str,
+                 capacity: int = 16384, overflow: valid_overflow_policy = "block",
+                 sample_rate: int = 100, log_format: valid_log_format = "text"):
+
+        self._logs_dir, self._cage = logs_dir, cage
+        self._capacity, self._overflow, self._sample_rate = capacity, overflow, sample_rate
+        self._format = log_format
+
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._written = Condition(self._lock)
+
+        self._buffer = deque()
+        self._queued = 0    # sequence number of the last queued line
+        self._synced = 0    # sequence number of the last line written and synced
+        self._sync_at = 0   # sequence number of the last line requiring a sync
+        self._overflows = 0 # lines arrived to the full buffer
+        self._dropped = 0   # lines dropped since the last report
+        self._stopped = False
+
+        self._log_key = None    # (yyyymmdd, format) of the current log file
+        self._log_file = None
+        self._log_offset = 0    # size of the current log file
+        self._index_file = None
+        self._index_heads = None  # bucket -> offset of its last record in the index
+        self._index_offset = 0    # size of the current index file
+        self._prefix_second = None
+        self._prefix = None
+
+        self._writer = LightThread(target = self._writer_proc, name = "log_writer")
+        self._writer.start()
+
+        atexit_register(self.close) # the writer thread is a daemon and would not drain the buffer
+
+    ###################################
+
+    # the overflow policy can be changed at runtime
+
+    @typecheck
+    def set_overflow(self, overflow: valid_overflow_policy):
+        self._overflow = overflow
+
+    # so can be the log format
+
+    @typecheck
+    def set_format(self, log_format: valid_log_format):
+        self._format = log_format
+
+    ###################################
+
+    # this method is called by any thread to log a message
+
+    def __call__(self, message, *, msg_level):
+
+        thread = current_thread()
+        log_format = self._format
+        if log_format == "jsonl": # the request is only of interest to the structured log
+            request = getattr(thread, "_request", None)
+            interface = request is not None and request.interface or None
+            request_id = interface is not None and request.unique_id or None
+        else:
+            request_id = interface = None
+
+        line = (time(), msg_level, thread.name, message, log_format, request_id, interface)
+        sync = msg_level == 1 or not message
+
+        with self._lock:
+
+            if self._stopped:
+                return
+
+            if len(self._buffer) >= self._capacity and not sync:
+                self._overflows += 1
+                if self._overflow == "drop" or \
+                   (self._overflow == "sample" and self._overflows % self._sample_rate != 0):
+                    self._dropped += 1
+                    return
+
+            while len(self._buffer) >= self._capacity and not self._stopped:
+                self._not_full.wait()
+
+            if not self._buffer: # the writer only waits when the buffer is empty
+                self._not_empty.notify()
+            self._buffer.append(line)
+            self._queued += 1
+            seq = self._queued
+
+            if sync: # errors and flushes wait for the writer to sync the file
+                self._sync_at = seq
+                while self._synced < seq and not self._stopped:
+                    self._written.wait()
+
+    ###################################
+
+    # this method stops the writer after it has written everything,
+    # it can be called more than once
+
+    def close(self):
+
+        with self._lock:
+            self._stopped = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+            self._written.notify_all()
+
+        self._writer.join()
+
+        self._close_files()
+
+    ###################################
+
+    def _writer_proc(self):
+
+        while True:
+
+            seq, stopped = None, False
+
+            try:
+
+                with self._lock:
+                    while not self._buffer and not self._stopped:
+                        self._not_empty.wait()
+                    lines = list(self._buffer)
+                    self._buffer.clear()
+                    seq = self._queued
+                    sync = self._sync_at > self._synced
+                    dropped, self._dropped = self._dropped, 0
+                    stopped = self._stopped
+                    self._not_full.notify_all()
+
+                if dropped:
+                    lines.append((time(), 3, current_thread().name,
+                                  "{0:d} log line(s) dropped due to buffer overflow".format(dropped),
+                                  self._format, None, None))
+
+                self._write_lines(lines, sync or stopped)
+
+            except:
+                pass # whatever has failed, the lines are lost, but the logging threads are released anyway
+
+            if seq is not None:
+                with self._lock:
+                    self._synced = seq
+                    self._written.notify_all()
+
+            if stopped:
+                break
+
+    ###################################
+
+    # the time prefix is only formatted when the second changes
+
+    def _format_prefix(self, line_time):
+        line_second = int(line_time)
+        if line_second != self._prefix_second:
+            self._prefix = strftime("%Y%m%d %H:%M:%S", localtime(line_second)).split(" ")
+            self._prefix_second = line_second
+        return self._prefix
+
+    def _write_lines(self, lines, sync):
+
+        data, index, offset = [], [], self._log_offset
+        for line_time, msg_level, thread_name, message, log_format, request_id, interface in lines:
+            line_yyyymmdd, line_hhmmss = self._format_prefix(line_time)
+            if (line_yyyymmdd, log_format) != self._log_key: # rotate log file, writing what is formatted so far
+                self._write_data(data, index)
+                data, index = [], []
+                self._rotate(line_yyyymmdd, log_format)
+                offset = self._log_offset
+            if not message:
+                continue
+            line_time_cc = "{0:s}.{1:02d}".format(line_hhmmss, int(line_time * 100) % 100)
+            level = self.log_abbrevs.get(msg_level, "???")
+            if self._log_key is not None and self._log_key[1] == "jsonl":
+                log_line = self._format_record(line_time, line_time_cc, level, thread_name,
+                                               message, request_id, interface)
+                if request_id is not None:
+                    index.append((request_id, offset))
+            else:
+                log_line = "{0:s} {1:s} [{2:s}] {3:s}".format(line_time_cc, level, thread_name, message).\
+                           encode(self.log_encoding, "replace").translate(self.log_translate) + b"\n"
+            data.append(log_line)
+            offset += len(log_line)
+
+        self._write_data(data, index)
+
+        if sync and self._log_file is not None:
+            fsync(self._log_file)
+
+    # the module is taken from the " # module.py:123 in func()" suffix appended by the module loader
+
+    def _format_record(self, line_time, line_time_cc, level, thread_name, message, request_id, interface):
+        source = self.log_source.match(message[message.rfind(" # "):])
+        record = dumps({ "ts": int(line_time * 100) / 100.0, "time": line_time_cc, "level": level,
+                         "thread": thread_name, "request": request_id, "interface": interface,
+                         "module": source and source.group(1) or None, "message": message })
+        return record.encode("ascii") + b"\n"
+
+    # the index is written after the lines it refers to
+
+    def _write_data(self, data, index):
+        if data and self._log_file is not None:
+            data = b"".join(data)
+            write(self._log_file, data)
+            self._log_offset += len(data)
+            if index and self._index_file is not None:
+                self._write_index(index)
+
+    # a request hashes into a bucket by its short id
+
+    @classmethod
+    def index_bucket(cls, request_id: str) -> int:
+        return crc32(request_id[-4:].encode("ascii")) % cls.index_buckets
+
+    # the records are written first, and then the heads of the buckets they have
+    # been prepended to, a reader therefore never follows an incomplete record
+
+    def _write_index(self, index):
+        records, heads, offset = [], {}, self._index_offset
+        for request_id, line_offset in index:
+            bucket = self.index_bucket(request_id)
+            record = "{0:s} {1:d} {2:d}\n".format(request_id, line_offset, self._index_heads[bucket]).encode("ascii")
+            records.append(record)
+            self._index_heads[bucket] = heads[bucket] = offset
+            offset += len(record)
+        pwrite(self._index_file, b"".join(records), self._index_offset)
+        self._index_offset = offset
+        for bucket, head in heads.items():
+            pwrite(self._index_file, pack(">Q", head), bucket * 8)
+
+    # an existing index continues with its heads, a new one starts with an empty header
+
+    def _open_index(self, index_file_name):
+        index_file = fopen(index_file_name, os.O_RDWR | os.O_CREAT)
+        try:
+            index_offset = os.fstat(index_file).st_size
+            if index_offset >= self.index_header_size:
+                index_heads = list(unpack(">{0:d}Q".format(self.index_buckets),
+                                          pread(index_file, self.index_header_size, 0)))
+            else:
+                ftruncate(index_file, 0)
+                ftruncate(index_file, self.index_header_size) # the header is a sparse run of zeroes
+                index_offset = self.index_header_size
+                index_heads = [ 0 ] * self.index_buckets
+        except:
+            close(index_file)
+            raise
+        return index_file, index_heads, index_offset
+
+    def _rotate(self, line_yyyymmdd, log_format):
+        try:
+            new_log_file_name = os_path.join(self._logs_dir, "{0:s}-{1:s}.{2:s}".\
+                                             format(self._cage, line_yyyymmdd, log_format == "text" and "log" or log_format))
+            new_log_file = fopen(new_log_file_name, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            try:
+                new_log_offset = os.fstat(new_log_file).st_size
+                if log_format == "jsonl":
+                    new_index_file, new_index_heads, new_index_offset = self._open_index(new_log_file_name + ".idx")
+                else:
+                    new_index_file, new_index_heads, new_index_offset = None, None, 0
+            except:
+                close(new_log_file)
+                raise
+        except:
+            pass # if rotation fails, previous log file will still be used
+        else:
+            self._close_files()
+            self._log_file, self._index_file = new_log_file, new_index_file
+            self._log_offset = new_log_offset
+            self._index_heads, self._index_offset = new_index_heads, new_index_offset
+            self._log_key = (line_yyyymmdd, log_format)
+
+    def _close_files(self):
+        for f in (self._log_file, self._index_file):
+            try:
+                close(f)
+            except:
+                pass # this also catches the attempt to close None
+        self._log_file = self._index_file = None
+
+################################################################################
+
+if __name__ == "__main__":
+
+    print("self-testing module log_writer.py:")
+
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from threading import Thread
+    from time import sleep
+    from json import loads
+    from subprocess import call
+    from pmnc.request import Request
+
+    ###################################
+
+    def read_log(logs_dir):
+        lines = []
+        for filename in sorted(os.listdir(logs_dir)):
+            with open(os_path.join(logs_dir, filename), "rb") as f:
+                lines.extend(f.read().decode(LogWriter.log_encoding).split("\n")[:-1])
+        return lines
+
+    temp_dir = mkdtemp()
+    try:
+
+        ###################################
+
+        # the lines are written in order, errors and flushes are written
+        # by the time the call returns
+
+        logs_dir = os_path.join(temp_dir, "order"); os.mkdir(logs_dir)
+        lw = LogWriter(logs_dir, "test")
+        try:
+            current_thread().name = "main"
+            lw("foo", msg_level = 4)
+            lw("bar\tbaz\x01", msg_level = 1)
+            lines = read_log(logs_dir)
+            assert len(lines) == 2
+            assert lines[0].endswith(" LOG [main] foo")
+            assert lines[1].endswith(" ERR [main] bar\tbaz ")
+            lw("\u0436\u20ac\u2603", msg_level = 2)
+            lw("", msg_level = 1)
+            assert read_log(logs_dir)[2].endswith(" MSG [main] \u0436\u20ac?")
+        finally:
+            lw.close()
+
+        lw("not logged after close", msg_level = 1)
+        assert len(read_log(logs_dir)) == 3
+
+        ###################################
+
+        # the log file is rotated daily
+
+        logs_dir = os_path.join(temp_dir, "rotate"); os.mkdir(logs_dir)
+        lw = LogWriter(logs_dir, "test")
+        try:
+            lw._write_lines([ (86400.0 * 10000 + 43200, 2, "main", "day one", "text", None, None),
+                              (86400.0 * 10001 + 43200, 2, "main", "day two", "text", None, None) ], False)
+        finally:
+            lw.close()
+        assert sorted(os.listdir(logs_dir)) == [ "test-{0:s}.log".format(strftime("%Y%m%d", localtime(86400 * d + 43200)))
+                                                 for d in (10000, 10001) ]
+
+        ###################################
+
+        # the structured log is written to a separate file, along with the index
+
+        logs_dir = os_path.join(temp_dir, "jsonl"); os.mkdir(logs_dir)
+        lw = LogWriter(logs_dir, "test")
+        try:
+            lw("text", msg_level = 2)
+            lw.set_format("jsonl")
+            current_thread()._request = Request(timeout = 10.0, interface = "foo", protocol = "n/a")
+            try:
+                lw("foo # mod_1.py:12 in bar() by RQ-ABCD via foo +0.0s", msg_level = 4)
+            finally:
+                del current_thread()._request
+            lw("bar\n\u0436 # not.py:1 in this() # mod_2.py:34 in baz()", msg_level = 1)
+        finally:
+            lw.close()
+
+        file_names = sorted(os.listdir(logs_dir))
+        assert [ file_name.split(".", 1)[1] for file_name in file_names ] == [ "jsonl", "jsonl.idx", "log" ]
+        assert read_log(logs_dir)[-1].endswith(" MSG [main] text")
+
+        with open(os_path.join(logs_dir, file_names[0]), "rb") as f:
+            data = f.read()
+        line1, line2 = [ loads(line.decode("ascii")) for line in data.split(b"\n")[:-1] ]
+        assert list(line1.keys()) == [ "ts", "time", "level", "thread", "request", "interface", "module", "message" ]
+        assert line1["level"] == "LOG" and line1["thread"] == "main" and line1["interface"] == "foo"
+        assert line1["request"].startswith("RQ-") and line1["module"] == "mod_1"
+        assert line1["message"] == "foo # mod_1.py:12 in bar() by RQ-ABCD via foo +0.0s"
+        assert line2["level"] == "ERR" and line2["request"] is None and line2["interface"] is None
+        assert line2["module"] == "mod_2" and line2["message"] == "bar\n\u0436 # not.py:1 in this() # mod_2.py:34 in baz()"
+
+        def read_index(request_id):
+            with open(os_path.join(logs_dir, file_names[1]), "rb") as f:
+                index = f.read()
+            assert len(index) > LogWriter.index_header_size
+            bucket = LogWriter.index_bucket(request_id)
+            head = unpack(">Q", index[bucket * 8:bucket * 8 + 8])[0]
+            return index[head:index.index(b"\n", head)]
+
+        assert read_index(line1["request"]) == "{0:s} 0 0".format(line1["request"]).encode("ascii")
+
+        # the offsets continue from the end of an existing file
+
+        lw = LogWriter(logs_dir, "test", log_format = "jsonl")
+        try:
+            current_thread()._request = Request(timeout = 10.0, interface = "foo", protocol = "n/a")
+            try:
+                lw("baz", msg_level = 1)
+                request_id = current_thread()._request.unique_id
+            finally:
+                del current_thread()._request
+        finally:
+            lw.close()
+
+        assert read_index(request_id) == "{0:s} {1:d} {2:d}".\
+               format(request_id, len(data), LogWriter.index_bucket(request_id) == LogWriter.index_bucket(line1["request"])
+                                             and LogWriter.index_header_size or 0).encode("ascii")
+        with open(os_path.join(logs_dir, file_names[0]), "rb") as f:
+            f.seek(len(data))
+            assert loads(f.readline().decode("ascii"))["request"] == request_id
+
+        ###################################
+
+        # a failure to write some lines does not stop the writer
+
+        logs_dir = os_path.join(temp_dir, "failure"); os.mkdir(logs_dir)
+        lw = LogWriter(logs_dir, "test", capacity = 10)
+        try:
+            format_prefix = lw._format_prefix
+            def failing_format_prefix(line_time):
+                lw._format_prefix = format_prefix # this only fails once
+                raise Exception("format failure")
+            lw._format_prefix = failing_format_prefix
+            lw("lost", msg_level = 1) # the error is lost, but the logging thread is released
+            for i in range(100): # this would block forever if the writer has died
+                lw("line {0:d}".format(i), msg_level = 4)
+            lw("", msg_level = 1)
+            assert lw._writer.is_alive()
+        finally:
+            lw.close()
+        lw.close() # closing again is harmless
+
+        lines = read_log(logs_dir)
+        assert len(lines) == 100 and lines[0].endswith(" LOG [main] line 0")
+
+        # the buffered lines are written at exit if the writer has not been closed
+
+        logs_dir = os_path.join(temp_dir, "exit"); os.mkdir(logs_dir)
+        assert call([ sys.executable, "-c", "import sys; sys.path.insert(0, {0!r}); "
+                                        "from pmnc.log_writer import LogWriter; "
+                                        "lw = LogWriter({1!r}, 'test'); "
+                                        "[ lw('line', msg_level = 4) for i in range(10000) ]; "
+                                        "sys.exit(1)".format(os_path.normpath(os_path.join(main_module_dir, "..")), logs_dir) ]) == 1
+        assert len(read_log(logs_dir)) == 10000
+
+        ###################################
+
+        # overflow policies
+
+        def overflow(policy):
+            logs_dir = os_path.join(temp_dir, policy); os.mkdir(logs_dir)
+            lw = LogWriter(logs_dir, "test", capacity = 10, overflow = policy, sample_rate = 10)
+            try:
+                write_lines = lw._write_lines
+                def slow_write_lines(lines, sync): # the writer is lagging behind
+                    sleep(0.01)
+                    write_lines(lines, sync)
+                lw._write_lines = slow_write_lines
+                for i in range(1000):
+                    lw("line {0:d}".format(i), msg_level = 4)
+                lw("", msg_level = 1)
+            finally:
+                lw.close()
+            lines = read_log(logs_dir)
+            written = [ line for line in lines if "dropped due to buffer overflow" not in line ]
+            dropped = sum(int(line.split("] ")[1].split(" ")[0]) for line in lines if line not in written)
+            assert len(written) + dropped == 1000
+            assert [ int(line.split(" ")[-1]) for line in written ] == sorted(int(line.split(" ")[-1]) for line in written)
+            return len(written), dropped
+
+        assert overflow("block") == (1000, 0)
+
+        written, dropped = overflow("drop")
+        assert written >= 10 and dropped > 0
+
+        written_sampled, dropped = overflow("sample")
+        assert written_sampled >= 100 and dropped > 0 and written_sampled > written
+
+        ###################################
+
+        # throughput compared to writing each line synchronously under a lock,
+        # the two are about the same, the writer thread is not there to log
+        # faster but to keep the writes and syncs off the logging threads
+
+        def sync_log(logs_dir):
+            log_lock = Lock()
+            log_file = fopen(os_path.join(logs_dir, "sync.log"), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            def log(message, *, msg_level):
+                line_time = time()
+                line_yyyymmdd, line_hhmmss = strftime("%Y%m%d %H:%M:%S", localtime(line_time)).split(" ")
+                log_line = "{0:s}.{1:02d} {2:s} [{3:s}] {4:s}".format(line_hhmmss, int(line_time * 100) % 100,
+                                    LogWriter.log_abbrevs.get(msg_level, "???"), current_thread().name, message)
+                with log_lock:
+                    write(log_file, log_line.encode(LogWriter.log_encoding, "replace").\
+                                    translate(LogWriter.log_translate) + b"\n")
+            return log, lambda: close(log_file)
+
+        def measure(log, threads, n):
+            ths = [ Thread(target = lambda: [ log("some log message of moderate length", msg_level = 5)
+                                              for i in range(n) ]) for j in range(threads) ]
+            start = time()
+            for th in ths: th.start()
+            for th in ths: th.join()
+            log("", msg_level = 1)
+            return threads * n / (time() - start)
+
+        logs_dir = os_path.join(temp_dir, "perf"); os.mkdir(logs_dir)
+
+        log, close_log = sync_log(logs_dir)
+        try:
+            sync_rate = measure(log, 10, 10000)
+        finally:
+            close_log()
+
+        lw = LogWriter(logs_dir, "test")
+        try:
+            async_rate = measure(lw, 10, 10000)
+        finally:
+            lw.close()
+
+        print("{0:.0f} lines/s written synchronously, {1:.0f} lines/s with writer thread".\
+              format(sync_rate, async_rate))
+
+    finally:
+        rmtree(temp_dir)
+
+    print("ok")
+
+################################################################################
+# EOF
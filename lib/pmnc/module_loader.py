@@ -5,6 +5,10 @@
 # ModuleLoader is the heart of Pythomnic3k. An instance of ModuleLoader is
 # accessible from all modules as pmnc and is essentialy the running cage itself.
 #
+# The log storms are contained by LogLimiter, which allows at most a configured
+# number of the same messages per 10 seconds at each log level (see set_log_limits),
+# and reports the number of the suppressed ones with a single line afterwards.
+#
 # Pythomnic3k project
 # (c) 2005-2019, Dmitry Dvoinikov <dmitry@targeted.org>
 # Distributed under BSD license
@@ -22,6 +26,9 @@ import imp; from imp import acquire_lock as acquire_imp_lock, load_module, \
                             release_lock as release_imp_lock, PY_SOURCE, PY_COMPILED
 import inspect; from inspect import isfunction, getfullargspec, isclass
 import traceback; from traceback import extract_stack
+import time; from time import time
+import re; from re import compile as regex
+import itertools; from itertools import count
 
 if __name__ == "__main__": # add pythomnic/lib to sys.path
     import os; import sys
@@ -29,7 +36,7 @@ if __name__ == "__main__": # add pythomnic/lib to sys.path
     sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..")))
 
 import exc_string; from exc_string import exc_string
-import typecheck; from typecheck import typecheck, optional, by_regex, callable, list_of, one_of
+import typecheck; from typecheck import typecheck, optional, by_regex, callable, list_of, one_of, dict_of
 import shared_lock; from shared_lock import SharedLockWriterPriority
 import pmnc.module_locator; from pmnc.module_locator import ModuleLocator
 import pmnc.timeout; from pmnc.timeout import Timeout
@@ -381,6 +388,101 @@ _log_levels = { "ERROR": 1, "MESSAGE": 2, "WARNING": 3, "LOG": 4, "INFO": 5, "DE
 
 ###############################################################################
 
+# this class suppresses the storms of repetitive log messages, the messages
+# are considered the same if they are logged from the same line of the same
+# module and only differ in numbers, at most a configured number of the same
+# messages are logged per period, the rest are counted and reported with
+# a single line once the period is over; the messages within a period are
+# counted without locking, the lock is only taken to start a new period,
+# at most _max_messages are tracked, the oldest are evicted beyond that
+
+class LogLimiter:
+
+    period = 10 # seconds
+    _max_messages = 10000
+    _template_regex = regex("0x[0-9A-Fa-f]+|[0-9]+")
+
+    def __init__(self, log):
+        self._log = log
+        self._lock = Lock()
+        self._limits = {}   # msg_level -> number of the same messages allowed per period
+        self._messages = {} # (msg_level, site, template) -> [ period start, count(), count() of suppressed, last message ]
+
+    @typecheck
+    def set_limits(self, limits: dict_of(valid_log_level, optional(int))):
+        self._limits = { _log_levels[k]: v for k, v in limits.items() if v is not None }
+
+    # this method returns True if the message should be logged, site is
+    # where the message is logged from, message is what the caller logged,
+    # full_message is what actually gets logged
+
+    def admit(self, msg_level, site, message, full_message) -> bool:
+
+        limit = self._limits.get(msg_level)
+        if limit is None:
+            return True
+
+        key = (msg_level, site, self._template_regex.sub("#", message))
+        now = time()
+
+        # within the current period the message is counted without the lock,
+        # next() on itertools.count is atomic, a message counted against a state
+        # that has just been replaced is lost from the counts, which is harmless
+
+        state = self._messages.get(key)
+        if state is None or now - state[0] >= self.period:
+            with self._lock:
+                reports = []
+                state = self._messages.get(key)
+                if state is not None and now - state[0] >= self.period:
+                    reports.extend(self._report(msg_level, self._messages.pop(key)))
+                    state = None
+                if state is None:
+                    if len(self._messages) >= self._max_messages:
+                        reports.extend(self._expire(now))
+                    state = self._messages[key] = [ now, count(), count(), None ]
+            for report_level, report in reports:
+                self._log(report, msg_level = report_level)
+
+        if next(state[1]) < limit:
+            return True
+
+        state[3] = full_message
+        next(state[2])
+        return False
+
+    # this method is called periodically to report the suppressed messages
+    # for the periods that are over and to forget the stale messages
+
+    def flush(self):
+        with self._lock:
+            reports = self._expire(time())
+        for msg_level, report in reports:
+            self._log(report, msg_level = msg_level)
+
+    # the messages are kept in the order their periods started, therefore
+    # the stale ones are at the front, and if there is still no room,
+    # the oldest ones are evicted and reported early
+
+    def _expire(self, now):
+        reports = []
+        for key, state in list(self._messages.items()):
+            if now - state[0] < self.period and len(self._messages) < self._max_messages:
+                break
+            reports.extend(self._report(key[0], state))
+            del self._messages[key]
+        return reports
+
+    def _report(self, msg_level, state): # returns [ (msg_level, report) ] or []
+        period_start, messages, suppressed, last_message = state
+        suppressed = next(suppressed) # the state is discarded, the count is read once
+        if not suppressed:
+            return []
+        return [ (msg_level, "message repeated {0:d} time(s) in last {1:d}s: {2:s}".\
+                             format(suppressed, self.period, last_message)) ]
+
+###############################################################################
+
 class ModuleLoader:
 
     @typecheck
@@ -389,6 +491,7 @@ class ModuleLoader:
                  locator_cache_timeout: float, locator_settle_timeout: float):
         self._node_name, self._cage_name = node_name, cage_name
         self._log, self._log_level = log, None
+        self._log_limiter = LogLimiter(log)
         self._cage_directory = cage_directory
         self._module_locator = ModuleLocator(self._cage_directory, locator_cache_timeout, locator_settle_timeout)
         self._lock, self._modules, self._loggers = Lock(), {}, {}
@@ -406,6 +509,33 @@ class ModuleLoader:
                 self._log_level = log_level
                 self._loggers.clear() # all the cached loggers are removed
 
+    # this method sets the number of the same messages allowed per period
+    # for each log level, { "INFO": 10, ... }, None or missing is unlimited
+
+    @typecheck
+    def set_log_limits(self, log_limits: dict_of(valid_log_level, optional(int))):
+        self._log_limiter.set_limits(log_limits)
+
+    # these methods pass the overflow policy and the format through to the
+    # log function, a LogWriter supports both, a plain function, such as
+    # the one used in self-tests, writes its own way and they return False
+
+    @typecheck
+    def set_log_overflow(self, log_overflow: str) -> bool:
+        set_overflow = getattr(self._log, "set_overflow", None)
+        if set_overflow is None:
+            return False
+        set_overflow(log_overflow)
+        return True
+
+    @typecheck
+    def set_log_format(self, log_format: str) -> bool:
+        set_format = getattr(self._log, "set_format", None)
+        if set_format is None:
+            return False
+        set_format(log_format)
+        return True
+
     ###################################
 
     def __getattr__(self, module_name, src_module = None):
@@ -416,7 +546,7 @@ class ModuleLoader:
             with self._lock:
                 logger = self._loggers.get(src_module)
                 if logger is None:
-                    logger = ModuleLog(self._log, self._log_level, src_module)
+                    logger = ModuleLog(self._log, self._log_limiter, self._log_level, src_module)
                     self._loggers[src_module] = logger
             return logger
 
@@ -497,8 +627,9 @@ class ModuleLoader:
 
 class ModuleLog:
 
-    def __init__(self, log, log_level, src_module):
-        self._log, self._loader_log_level, self._src_module = log, log_level, src_module
+    def __init__(self, log, log_limiter, log_level, src_module):
+        self._log, self._log_limiter = log, log_limiter
+        self._loader_log_level, self._src_module = log_level, src_module
         self._lock = Lock()
         self._loggers = {}
 
@@ -510,7 +641,8 @@ class ModuleLog:
             logger = self._loggers.get(logger_log_level)
             if logger is None:
                 shortcut = method == "log_"
-                logger = ModuleLogger(self._log, self._loader_log_level, logger_log_level, self._src_module, shortcut)
+                logger = ModuleLogger(self._log, self._log_limiter, self._loader_log_level,
+                                      logger_log_level, self._src_module, shortcut)
                 self._loggers[method] = logger
         return logger
 
@@ -522,9 +654,11 @@ class ModuleLog:
     def __bool__(self):
         return bool(self.log_)
 
-    # this utility method tells the log function to flush the log stream
+    # this utility method tells the log function to flush the log stream,
+    # reporting the suppressed repetitive messages beforehand
 
     def flush(self):
+        self._log_limiter.flush()
         self._log("", msg_level = "ERROR")
 
     # this utility class supports log level modification using
@@ -567,8 +701,8 @@ class ModuleLog:
 
 class ModuleLogger:
 
-    def __init__(self, log, loader_log_level, logger_log_level, src_module, shortcut):
-        self._log = log
+    def __init__(self, log, log_limiter, loader_log_level, logger_log_level, src_module, shortcut):
+        self._log, self._log_limiter = log, log_limiter
         self._loader_log_level = loader_log_level
         self._logger_log_level = logger_log_level
         self._src_module = src_module
@@ -595,12 +729,15 @@ class ModuleLogger:
 
             if self._src_module:
                 line, func = extract_stack(None, 3)[-3 if self._shortcut else -2][1:3]
-                message += " # {0:s}.py:{1:d} in {2:s}(){3:s}".\
-                           format(self._src_module, line, func, req_desc)
-            elif req_desc:
-                message += " #{0:s}".format(req_desc)
+                full_message = message + " # {0:s}.py:{1:d} in {2:s}(){3:s}".\
+                               format(self._src_module, line, func, req_desc)
+                site = (self._src_module, line)
+            else:
+                full_message = message + (req_desc and " #{0:s}".format(req_desc))
+                site = None
 
-            self._log(message, msg_level = self._logger_log_level)
+            if self._log_limiter.admit(self._logger_log_level, site, message, full_message):
+                self._log(full_message, msg_level = self._logger_log_level)
 
         except:
             pass # do nothing
@@ -1756,6 +1893,118 @@ if __name__ == "__main__":
 
     ###################################
 
+    print("repetitive logging: ", end = "")
+
+    r = fake_request(30.0)
+
+    write_module("storm.py",
+                 "__all__ = ['storm']\n"
+                 "def storm(n):\n"
+                 "    for i in range(n):\n"
+                 "        pmnc.log.warning('connection to 10.0.0.{0:d} failed'.format(i))\n"
+                 "        pmnc.log.warning('something else')\n"
+                 "        pmnc.log.info('not limited {0:d}'.format(i))\n"
+                 "# EOF")
+
+    loader.set_log_limits({ "WARNING": 2, "INFO": None })
+    loader._log_limiter.period = 1
+
+    def storm_lines(*lines, description = None):
+        suffix = " in storm() by {0:s}".format(r.description)
+        prev_suffix = " in storm() by {0:s}".format(description or r.description)
+        return [ line.format(suffix = suffix, prev_suffix = prev_suffix) for line in lines ]
+
+    pmnc.storm.storm(0) # load the module
+    del log_lines[:]
+    pmnc.storm.storm(5)
+    description = r.description
+    compare_log_lines(log_lines, storm_lines(
+        "connection to 10.0.0.0 failed # storm.py:4{suffix}",
+        "something else # storm.py:5{suffix}",
+        "not limited 0 # storm.py:6{suffix}",
+        "connection to 10.0.0.1 failed # storm.py:4{suffix}",
+        "something else # storm.py:5{suffix}",
+        "not limited 1 # storm.py:6{suffix}",
+        "not limited 2 # storm.py:6{suffix}",
+        "not limited 3 # storm.py:6{suffix}",
+        "not limited 4 # storm.py:6{suffix}",
+    ))
+
+    # the suppressed messages are reported once the period is over
+
+    sleep(1.1)
+    del log_lines[:]
+    pmnc.storm.storm(1)
+    compare_log_lines(log_lines, storm_lines(
+        "message repeated 3 time(s) in last 1s: connection to 10.0.0.4 failed # storm.py:4{prev_suffix}",
+        "connection to 10.0.0.0 failed # storm.py:4{suffix}",
+        "message repeated 3 time(s) in last 1s: something else # storm.py:5{prev_suffix}",
+        "something else # storm.py:5{suffix}",
+        "not limited 0 # storm.py:6{suffix}",
+        description = description,
+    ))
+
+    # or when the log is flushed
+
+    pmnc.storm.storm(2)
+    description = r.description
+    sleep(1.1)
+    del log_lines[:]
+    pmnc.log.flush()
+    compare_log_lines(sorted(log_lines), sorted(storm_lines(
+        "message repeated 1 time(s) in last 1s: connection to 10.0.0.1 failed # storm.py:4{prev_suffix}",
+        "message repeated 1 time(s) in last 1s: something else # storm.py:5{prev_suffix}",
+        "*** FLUSH ***",
+        description = description,
+    )))
+    assert loader._log_limiter._messages == {}
+
+    del log_lines[:]
+    pmnc.log.flush()
+    assert log_lines == [ "*** FLUSH ***" ]
+
+    loader.set_log_limits({})
+
+    del log_lines[:]
+    pmnc.storm.storm(3)
+    assert len(log_lines) == 9
+
+    # at most _max_messages are tracked, the oldest ones are evicted and reported early
+
+    reports = []
+    limiter = LogLimiter(lambda message, *, msg_level: reports.append((msg_level, message)))
+    limiter._max_messages = 3
+    limiter.set_limits({ "WARNING": 1 })
+    assert [ limiter.admit(3, None, m, m + "!") for m in ("foo", "foo", "bar", "baz", "biz", "biz") ] == \
+           [ True, False, True, True, True, False ]
+    assert [ key[2] for key in limiter._messages ] == [ "bar", "baz", "biz" ]
+    assert reports == [ (3, "message repeated 1 time(s) in last 10s: foo!") ]
+
+    print("ok")
+
+    ###################################
+
+    print("overflow and format are passed to the log function: ", end = "")
+
+    assert not loader.set_log_overflow("drop")
+    assert not loader.set_log_format("jsonl")
+
+    log_settings = []
+    log.set_overflow = lambda overflow: log_settings.append(("overflow", overflow))
+    log.set_format = lambda log_format: log_settings.append(("format", log_format))
+    try:
+        assert loader.set_log_overflow("drop")
+        assert loader.set_log_format("jsonl")
+    finally:
+        del log.set_overflow
+        del log.set_format
+
+    assert log_settings == [ ("overflow", "drop"), ("format", "jsonl") ]
+
+    print("ok")
+
+    ###################################
+
     print("module names such as _this are reserved: ", end = "")
 
     fake_request(30.0)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#-*- coding: iso-8859-1 -*-
+################################################################################
+#
+# This module implements a fixed size round-robin archive of performance
+# readings, kept in a memory mapped file. It is used by module performance.py
+# to keep the cage performance history across restarts and for longer than
+# the last hour kept in memory.
+#
+# Each reading is stored as four levels in 0-39 range, normalized the same way
+# as the performance.py's extract() returns them - low and high of the average
+# band, followed by p50 and p99 for the time readings, any of which can be
+# missing. The archive consists of three rings of slots:
+#
+# 1 minute resolution for the last day,
+# 10 minutes resolution for the last week,
+# 1 hour resolution for the last eight weeks.
+#
+# Only the 1 minute slots are written directly, as soon as a 10 minute or
+# 1 hour period completes, its slot is consolidated from the finer slots
+# already in the file: the band levels and p50 are averaged, p99 takes
+# the maximum. A period whose closing minute has not been written, because
+# the cage was down at the time, is consolidated by the next write, from
+# whatever finer slots it has. Each slot is stamped with its time, therefore
+# the stale slots left over from before a downtime are simply ignored.
+#
+# The file also contains a table of up to 256 keys, a key that does not
+# fit is not archived.
+#
+# Pythomnic3k project
+# (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
+# Distributed under BSD license
+#
+################################################################################
+
+__all__ = [ "PerformanceArchive" ]
+
+###############################################################################
+
+import threading; from threading import Lock
+import mmap; from mmap import mmap
+import struct; from struct import Struct
+import os; from os import path as os_path
+
+if __name__ == "__main__": # add pythomnic/lib to sys.path
+    import os; import sys
+    main_module_dir = os.path.dirname(sys.modules["__main__"].__file__) or os.getcwd()
+    sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..")))
+
+import typecheck; from typecheck import typecheck
+
+###############################################################################
+
+class PerformanceArchive:
+
+    resolutions = ((60, 1440), (600, 1008), (3600, 1344)) # seconds per slot, number of slots
+
+    _magic = b"PMNCPA01"
+    _max_keys = 256
+    _key_size = 64
+    _none = 255 # missing level
+
+    _header = Struct("<8s{0:d}I".format(2 + 2 * len(resolutions)))
+    _stamp = Struct("<q")
+
+    @typecheck
+    def __init__(self, filename: str):
+
+        self._lock = Lock()
+        self._written = None # the end of the last minute written
+        self._slot_size = self._stamp.size + self._max_keys * 4
+        self._keys_offset = self._header.size
+        self._rings = {} # resolution -> (offset, slots)
+        offset = self._keys_offset + self._max_keys * self._key_size
+        for resolution, slots in self.resolutions:
+            self._rings[resolution] = (offset, slots)
+            offset += slots * self._slot_size
+
+        header = self._header.pack(self._magic, self._max_keys, self._key_size,
+                                   *sum(self.resolutions, ()))
+
+        # the file is reinitialized if its layout does not match
+
+        self._file = open(filename, "r+b" if os_path.isfile(filename) else "w+b")
+        try:
+            self._file.seek(0)
+            if self._file.read(len(header)) != header:
+                self._file.seek(0)
+                self._file.truncate()
+                self._file.write(header)
+            self._file.truncate(offset)
+            self._map = mmap(self._file.fileno(), offset)
+        except:
+            self._file.close()
+            raise
+
+        # load the table of keys
+
+        self._keys = {}
+        for i in range(self._max_keys):
+            key_offset = self._keys_offset + i * self._key_size
+            key = self._map[key_offset:key_offset + self._key_size].rstrip(b"\x00")
+            if key:
+                self._keys[key.decode("ascii")] = i
+
+    ###################################
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+    ###################################
+
+    def _key_index(self, key):
+        index = self._keys.get(key)
+        if index is None:
+            encoded_key = key.encode("ascii")
+            if len(encoded_key) > self._key_size or len(self._keys) == self._max_keys:
+                return None
+            index = len(self._keys)
+            key_offset = self._keys_offset + index * self._key_size
+            self._map[key_offset:key_offset + self._key_size] = encoded_key.ljust(self._key_size, b"\x00")
+            self._keys[key] = index
+        return index
+
+    def _slot_offset(self, resolution, t):
+        offset, slots = self._rings[resolution]
+        return offset + (t // resolution) % slots * self._slot_size
+
+    def _write_slot(self, resolution, t, levels):
+        slot_offset = self._slot_offset(resolution, t)
+        data = bytearray(b"\xff" * (self._max_keys * 4))
+        for key, key_levels in levels.items():
+            index = self._key_index(key)
+            if index is not None:
+                data[index * 4:index * 4 + 4] = bytes(self._none if v is None else v for v in key_levels)
+        self._map[slot_offset + self._stamp.size:slot_offset + self._slot_size] = data
+        self._stamp.pack_into(self._map, slot_offset, t)
+
+    def _read_slot(self, resolution, t):
+        slot_offset = self._slot_offset(resolution, t)
+        if self._stamp.unpack_from(self._map, slot_offset)[0] != t:
+            return None
+        data = self._map[slot_offset + self._stamp.size:slot_offset + self._slot_size]
+        levels = {}
+        for key, index in self._keys.items():
+            key_levels = tuple(None if v == self._none else v for v in data[index * 4:index * 4 + 4])
+            if key_levels != (None, None, None, None):
+                levels[key] = key_levels
+        return levels
+
+    # a consolidated slot averages the band levels and p50, p99 is the maximum
+
+    @classmethod
+    def _consolidate(cls, slots):
+        collected = {}
+        for levels in slots:
+            for key, key_levels in levels.items():
+                collected.setdefault(key, []).append(key_levels)
+        result = {}
+        for key, key_levels in collected.items():
+            consolidated = []
+            for i, vs in enumerate(zip(*key_levels)):
+                vs = [ v for v in vs if v is not None ]
+                if not vs:
+                    consolidated.append(None)
+                elif i == 3:
+                    consolidated.append(max(vs))
+                else:
+                    consolidated.append(int(round(sum(vs) / len(vs))))
+            result[key] = tuple(consolidated)
+        return result
+
+    ###################################
+
+    # this method stores the levels of the minute starting at t, key -> (low, high,
+    # p50, p99), and consolidates the coarser slots of all the periods that have
+    # completed since the previous write, or that the finer ring still covers,
+    # if this is the first write, unless they have been consolidated already
+
+    @typecheck
+    def write(self, t: int, levels: dict):
+        with self._lock:
+            t = t // 60 * 60
+            self._write_slot(60, t, levels)
+            end = t + 60
+            finer, finer_slots = self.resolutions[0]
+            for resolution, slots in self.resolutions[1:]:
+                since = end - finer * finer_slots if self._written is None else self._written - resolution
+                for start in range(max(since, 0) // resolution * resolution, end - resolution + 1, resolution):
+                    if self._stamp.unpack_from(self._map, self._slot_offset(resolution, start))[0] != start:
+                        self._consolidate_slot(resolution, finer, start)
+                finer, finer_slots = resolution, slots
+            self._written = max(self._written or 0, end)
+
+    def _consolidate_slot(self, resolution, finer, start):
+        finer_slots = [ self._read_slot(finer, start + i * finer)
+                        for i in range(resolution // finer) ]
+        finer_slots = [ s for s in finer_slots if s is not None ]
+        if finer_slots:
+            self._write_slot(resolution, start, self._consolidate(finer_slots))
+
+    # this method returns the count of slots of the given resolution starting
+    # at time t, as a list of (slot time, key -> levels or None for missing slots)
+
+    @typecheck
+    def read(self, resolution: int, t: int, count: int) -> list:
+        if resolution not in self._rings:
+            raise Exception("unsupported resolution {0:d}".format(resolution))
+        with self._lock:
+            t = t // resolution * resolution
+            return [ (t + i * resolution, self._read_slot(resolution, t + i * resolution))
+                     for i in range(count) ]
+
+################################################################################
+
+if __name__ == "__main__":
+
+    print("self-testing module perf_archive.py:")
+
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from time import time as now
+
+    temp_dir = mkdtemp()
+    try:
+
+        filename = os_path.join(temp_dir, "test.archive")
+
+        ###################################
+
+        pa = PerformanceArchive(filename)
+        try:
+
+            assert os_path.getsize(filename) == pa._header.size + 256 * 64 + (1440 + 1008 + 1344) * (8 + 256 * 4)
+
+            t0 = 1000000 * 3600 # aligned to an hour
+
+            assert pa.read(60, t0, 2) == [ (t0, None), (t0 + 60, None) ]
+
+            pa.write(t0, { "interface.foo.request_rate": (1, 3, None, None),
+                           "resource.bar.processing_time": (10, 20, 12, 30) })
+            pa.write(t0 + 60, { "interface.foo.request_rate": (3, 5, None, None) })
+
+            assert pa.read(60, t0 + 30, 3) == \
+                   [ (t0, { "interface.foo.request_rate": (1, 3, None, None),
+                            "resource.bar.processing_time": (10, 20, 12, 30) }),
+                     (t0 + 60, { "interface.foo.request_rate": (3, 5, None, None) }),
+                     (t0 + 120, None) ]
+
+            # completing 10 minutes consolidates a 10 minute slot
+
+            assert pa.read(600, t0, 1) == [ (t0, None) ]
+            pa.write(t0 + 540, { "resource.bar.processing_time": (20, 30, 14, 20) })
+            assert pa.read(600, t0, 1) == \
+                   [ (t0, { "interface.foo.request_rate": (2, 4, None, None),
+                            "resource.bar.processing_time": (15, 25, 13, 30) }) ]
+
+            # completing the hour consolidates a 1 hour slot out of the 10 minute slots
+
+            pa.write(t0 + 3540, { "resource.bar.processing_time": (5, 5, 5, 5) })
+            assert pa.read(600, t0 + 3000, 1) == [ (t0 + 3000, { "resource.bar.processing_time": (5, 5, 5, 5) }) ]
+            assert pa.read(3600, t0, 1) == \
+                   [ (t0, { "interface.foo.request_rate": (2, 4, None, None),
+                            "resource.bar.processing_time": (10, 15, 9, 30) }) ]
+
+            # the periods whose closing minutes have been missed are consolidated by the next write
+
+            t1 = t0 + 86400 * 7 # well past anything written so far
+            pa.write(t1 + 60, { "resource.bar.processing_time": (2, 2, 2, 2) })
+            pa.write(t1 + 120, { "resource.bar.processing_time": (4, 4, 4, 4) })
+            assert pa.read(600, t1, 1) == [ (t1, None) ]
+            assert pa.read(3600, t1, 1) == [ (t1, None) ]
+            pa.write(t1 + 7260, { "resource.bar.processing_time": (8, 8, 8, 8) }) # the cage has been down
+            assert pa.read(600, t1, 2) == [ (t1, { "resource.bar.processing_time": (3, 3, 3, 4) }),
+                                            (t1 + 600, None) ]
+            assert pa.read(3600, t1, 2) == [ (t1, { "resource.bar.processing_time": (3, 3, 3, 4) }),
+                                             (t1 + 3600, None) ]
+
+            # and so are the ones missed before the archive has been reopened
+
+            pa.close()
+            pa = PerformanceArchive(filename)
+            t2 = t1 + 86400
+            pa.write(t2 + 60, { "resource.bar.processing_time": (2, 2, 2, 2) })
+            pa.close()
+            pa = PerformanceArchive(filename)
+            pa.write(t2 + 3660, { "resource.bar.processing_time": (6, 6, 6, 6) })
+            assert pa.read(600, t2, 1) == [ (t2, { "resource.bar.processing_time": (2, 2, 2, 2) }) ]
+            assert pa.read(3600, t2, 1) == [ (t2, { "resource.bar.processing_time": (2, 2, 2, 2) }) ]
+
+            # a day later the same 1 minute slot is reused
+
+            pa.write(t0 + 86400, { "resource.bar.processing_time": (1, 1, 1, 1) })
+            assert pa.read(60, t0, 1) == [ (t0, None) ]
+            assert pa.read(60, t0 + 86400, 1) == [ (t0 + 86400, { "resource.bar.processing_time": (1, 1, 1, 1) }) ]
+
+            try:
+                pa.read(120, t0, 1)
+            except Exception as e:
+                assert str(e) == "unsupported resolution 120"
+            else:
+                assert False
+
+        finally:
+            pa.close()
+
+        ###################################
+
+        # the archive survives reopening
+
+        pa = PerformanceArchive(filename)
+        try:
+            assert pa.read(3600, t0, 1)[0][1]["interface.foo.request_rate"] == (2, 4, None, None)
+            assert pa.read(60, t0 + 86400, 1) == [ (t0 + 86400, { "resource.bar.processing_time": (1, 1, 1, 1) }) ]
+        finally:
+            pa.close()
+
+        # a file with a different layout is reinitialized
+
+        with open(filename, "r+b") as f:
+            f.write(b"garbage!")
+
+        pa = PerformanceArchive(filename)
+        try:
+            assert pa.read(3600, t0, 1) == [ (t0, None) ]
+        finally:
+            pa.close()
+
+        ###################################
+
+        # the keys that do not fit are ignored
+
+        pa = PerformanceArchive(filename)
+        try:
+            pa.write(t0, { "resource.r{0:03d}.processing_time".format(i): (1, 1, 1, 1) for i in range(300) })
+            assert len(pa.read(60, t0, 1)[0][1]) == 256
+            pa.write(t0, { "resource.{0:s}.processing_time".format("x" * 64): (1, 1, 1, 1) })
+            assert "resource.{0:s}.processing_time".format("x" * 64) not in pa.read(60, t0, 1)[0][1]
+        finally:
+            pa.close()
+
+        ###################################
+
+        pa = PerformanceArchive(filename)
+        try:
+            levels = { "resource.r{0:03d}.processing_time".format(i): (1, 2, 3, 4) for i in range(50) }
+            n = 600
+            start = now()
+            for i in range(n):
+                pa.write(t0 + i * 60, levels)
+            elapsed = now() - start
+            print("{0:.02f} ms per minute written".format(elapsed * 1000 / n))
+        finally:
+            pa.close()
+
+    finally:
+        rmtree(temp_dir)
+
+    print("ok")
+
+################################################################################
+# EOF
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#-*- coding: iso-8859-1 -*-
+################################################################################
+#
+# This module implements a statistical profiler which periodically takes
+# the stacks of all the threads in the process, using sys._current_frames(),
+# and counts identical stacks. Each stack is prefixed with the name of the
+# interface and the description of the request the thread is processing,
+# or with the name of the thread if it has no request. The threads waiting
+# in the threading module (for a lock, event or the like) are not counted.
+#
+# The result is returned in the collapsed stack format accepted by the
+# flame graph tools, one line per distinct stack:
+#
+# interface;description;outer_function (file.py:1);inner_function (file.py:2) 123
+#
+# It is used by module performance.py to profile the cage on demand.
+#
+# Pythomnic3k project
+# (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
+# Distributed under BSD license
+#
+################################################################################
+
+__all__ = [ "SamplingProfiler" ]
+
+################################################################################
+
+import sys; from sys import _current_frames
+import threading; from threading import Lock, Event, enumerate as enumerate_threads, get_ident
+import os; from os import path as os_path
+import time; from time import time
+
+if __name__ == "__main__": # add pythomnic/lib to sys.path
+    import os; import sys
+    main_module_dir = os.path.dirname(sys.modules["__main__"].__file__) or os.getcwd()
+    sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..")))
+
+import typecheck; from typecheck import typecheck
+import pmnc.threads; from pmnc.threads import LightThread
+
+################################################################################
+
+class SamplingProfiler:
+
+    _threading_file = threading.__file__
+
+    @typecheck
+    def __init__(self, duration: float, interval: float = 0.01):
+        self._duration, self._interval = duration, interval
+        self._lock = Lock()
+        self._stop = Event()
+        self._stacks = {}
+        self._samples = 0
+        self._thread = None
+
+    def _rrunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _rsamples(self):
+        with self._lock:
+            return self._samples
+
+    def _rremain(self):
+        return max(self._deadline - time(), 0.0) if self.running else 0.0
+
+    running = property(lambda self: self._rrunning())
+    samples = property(lambda self: self._rsamples())
+    remain = property(lambda self: self._rremain())
+
+    def start(self):
+        self._deadline = time() + self._duration
+        self._thread = LightThread(target = self._thread_proc, name = "profiler")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _thread_proc(self):
+        while not self._stop.wait(self._interval) and time() < self._deadline:
+            self._sample()
+
+    ###################################
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return "{0:s} ({1:s}:{2:d})".format(code.co_name, os_path.basename(code.co_filename),
+                                            code.co_firstlineno).replace(";", ":")
+
+    @staticmethod
+    def _thread_tag(thread):
+        request = getattr(thread, "_request", None)
+        interface = request is not None and request.interface or None
+        if interface is not None:
+            description = request.plain_description
+            return [ interface, description.replace(";", ":") ] if description else [ interface ]
+        name, _, number = thread.name.rpartition(":") # pooled threads are named like pool:123
+        return [ name if name and number.isdigit() else thread.name ]
+
+    def _sample(self):
+
+        own_ident = get_ident()
+        threads = { thread.ident: thread for thread in enumerate_threads() }
+
+        stacks = []
+        for ident, frame in _current_frames().items():
+            if ident == own_ident or frame.f_code.co_filename == self._threading_file:
+                continue
+            thread = threads.get(ident)
+            if thread is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.extend(reversed(self._thread_tag(thread)))
+            stacks.append(";".join(reversed(stack)))
+
+        with self._lock:
+            self._samples += 1
+            for stack in stacks:
+                self._stacks[stack] = self._stacks.get(stack, 0) + 1
+
+    ###################################
+
+    # this method returns the counted stacks in collapsed stack format,
+    # the most frequently seen first
+
+    def collapsed(self) -> str:
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key = lambda s_n: (-s_n[1], s_n[0]))
+        return "".join("{0:s} {1:d}\n".format(stack, count) for stack, count in stacks)
+
+################################################################################
+
+if __name__ == "__main__":
+
+    print("self-testing module profiler.py:")
+
+    from time import sleep
+    from pmnc.request import Request
+
+    ###################################
+
+    def busy_loop(stop):
+        x = 0
+        while not stop.is_set():
+            x += 1
+
+    def busy_thread(stop):
+        current_thread()._request = Request(timeout = 10.0, interface = "foo", protocol = "n/a",
+                                            description = "bar;baz")
+        busy_loop(stop)
+
+    def idle_thread(stop):
+        stop.wait()
+
+    from threading import Thread, current_thread
+
+    stop = Event()
+    th1 = Thread(target = busy_thread, args = (stop, ), name = "busy:1")
+    th2 = Thread(target = busy_loop, args = (stop, ), name = "pool:12")
+    th3 = Thread(target = idle_thread, args = (stop, ), name = "idle")
+    for th in (th1, th2, th3): th.start()
+
+    try:
+
+        p = SamplingProfiler(1.0)
+        assert not p.running and p.samples == 0 and p.collapsed() == ""
+
+        p.start()
+        sleep(0.5)
+        assert p.running and 0.0 < p.remain <= 0.5
+        sleep(1.0)
+        assert not p.running and p.remain == 0.0
+
+        assert 20 <= p.samples <= 100
+
+        lines = p.collapsed().split("\n")
+        assert lines[-1] == ""
+        stacks = dict(line.rsplit(" ", 1) for line in lines[:-1])
+
+        busy_frame = "busy_loop (profiler.py:{0:d})".format(busy_loop.__code__.co_firstlineno)
+        assert any(stack.startswith("foo;bar:baz;_bootstrap (threading.py:") and stack.endswith(busy_frame)
+                   for stack in stacks)
+        assert any(stack.startswith("pool;") and stack.endswith(busy_frame) for stack in stacks)
+        assert not any(stack.startswith("idle;") for stack in stacks) # waiting in threading.py
+        assert not any("_thread_proc (profiler.py:" in stack for stack in stacks) # profiler itself
+
+        # stopping is immediate
+
+        p = SamplingProfiler(10.0)
+        p.start()
+        sleep(0.1)
+        p.stop()
+        assert not p.running
+
+        # overhead
+
+        p = SamplingProfiler(1000.0)
+        start = time()
+        for i in range(1000):
+            p._sample()
+        print("{0:.02f} ms per sample".format(time() - start))
+
+    finally:
+        stop.set()
+        for th in (th1, th2, th3): th.join()
+
+    print("ok")
+
+################################################################################
+# EOF
@@ -91,6 +91,7 @@ class Request(ComparableMixin):
                           self._interface, deadline)
 
     description = property(lambda self: self._rdescription())
+    plain_description = property(lambda self: self._description) # as passed to describe()
 
     ###################################
 
@@ -48,6 +48,9 @@
 #
 # Any resource pool can be instrumented with a read cache, its implementation
 # resides in a separate module, for more information see resource_pool_cache.py
+# If the cache has a snapshot file configured, the periodic maintenance saves
+# the cache contents to it, and so does the pool being stopped, failure to do so
+# is reported to the cache's snapshot_failed callable.
 #
 # Pythomnic3k project
 # (c) 2005-2015, Dmitry Dvoinikov <dmitry@targeted.org>
@@ -75,6 +78,7 @@ if __name__ == "__main__": # add pythomnic/lib to sys.path
     sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..")))
 
 import typecheck; from typecheck import typecheck, callable, optional
+import exc_string; from exc_string import exc_string
 import pmnc.timeout; from pmnc.timeout import Timeout
 import pmnc.threads; from pmnc.threads import HeavyThread, LightThread
 import pmnc.request; from pmnc.request import Request
@@ -609,6 +613,8 @@ class ResourcePool: # a fixed size pool of resources
         self._warmup()
         if self._cache:
             self._purge_cache()
+            if self._cache.snapshot_due:
+                self._save_cache_snapshot()
 
     ###################################
     # this method is called from the periodic maintenance above
@@ -690,6 +696,20 @@ class ResourcePool: # a fixed size pool of resources
 
     _purge_sem = Semaphore()
 
+    ###################################
+    # this method is called from the periodic maintenance above
+    # and upon the pool being stopped, and it should not throw
+
+    def _save_cache_snapshot(self):
+        try:
+            self._cache.save_snapshot() # concurrent saves are serialized by the cache itself
+        except: # failure to save the snapshot only affects the next startup
+            if self._cache.snapshot_failed is not None:
+                try:
+                    self._cache.snapshot_failed(exc_string())
+                except:
+                    pass
+
     ###################################
     # this method is called by the watchdog thread
     # to stop the pool at cage shutdown
@@ -706,6 +726,8 @@ class ResourcePool: # a fixed size pool of resources
                         resource.expire() # all the resource instances are marked as expired
             finally:                      # and then the entire pool is swept thus diconnecting them
                 self._stop_sem.release()
+            if self._cache and self._cache.snapshot_file:
+                self._save_cache_snapshot() # the final snapshot is taken as the cage shuts down
             self._sweep() # the same thread is entering _sweep, only if it has succeeded with stopping
 
     _stop_sem = Semaphore()
@@ -1152,6 +1174,21 @@ if __name__ == "__main__":
 
     ###################################
 
+    # failure to save the cache snapshot is reported
+
+    from tempfile import mkdtemp
+    from os import path as os_path
+
+    errors = []
+    cache = ResourcePoolReadWriteCache("PoolName", size = 1, snapshot_file = os_path.join(mkdtemp(), "no", "such"),
+                                       snapshot_failed = errors.append)
+    rp = ResourcePool("PoolName", FooResource, 1, cache = cache)
+
+    rp._save_cache_snapshot()
+    assert len(errors) == 1 and errors[0].startswith("FileNotFoundError(")
+
+    ###################################
+
     # releasing an instance initiates warming up
 
     rp = ResourcePool("PoolName", FooResource, 1, 1)
@@ -39,6 +39,24 @@
 # >> pool__cache_evict_period = N.N,
 # Eviction can occur at most once in N.N float seconds. Default is 10.0 seconds.
 #
+# >> pool__cache_stale_ttl = N.N,
+# Grace period in float seconds during which an expired entry is still
+# returned from the cache while a single background transaction refreshes it
+# (stale-while-revalidate). None (default) means that expired entries are never
+# returned and the next caller executes the actual resource call, while the
+# others wait for its result.
+#
+# >> pool__cache_refresh_ahead = N.N,
+# Fraction of entry's time to live in 0.0-1.0 range, after which a hit
+# to such entry initiates its background refresh, so that frequently used
+# entries are replaced before they expire. None (default) means no refresh
+# ahead of expiration.
+#
+# A background refresh that has not put its result within the refresh timeout
+# (the cage request timeout, see shared_pools.py) is considered abandoned,
+# whether it has failed, expired in the queue or been dropped, and the next hit
+# to the entry initiates another one.
+#
 # >> pool__cache_group_interval = N.N,
 # Group weight statistics will be accumulated over last N.N seconds.
 # With this option turned on, values are evicted from the cache based
@@ -64,6 +82,10 @@
 # The result of this particular call is cached for M.M seconds,
 # explicitly passed None means forever.
 #
+# >> xa.resource.foo(1, biz = "baz", pool__cache_stale_ttl = S.S)
+# Once the result of this particular call expires, it can still be returned
+# for S.S seconds while being refreshed, explicitly passed None means never.
+#
 # >> xa.resource.foo(1, biz = "baz", pool__cache_weight = K.K)
 # The result of this particular call is marked with weight K.K,
 # which is used with "weight" eviction policy and group weight
@@ -92,8 +114,35 @@
 #                   pool__cache_write_keys = { "t" })
 # Set (or other iterable) of strings containing keys this request writes.
 #
-# As you can see, this approach is suitable unique key access,
-# but problematic for range key access.
+# Keys are hierarchical, with segments separated by slashes, and a key
+# ending with "/*" is a prefix key which covers all the keys beneath it,
+# as well as the key itself:
+#
+# >> xa.resource.db("SELECT * FROM t", pool__cache_read_keys = { "t/*" })
+# is invalidated by a write to "t/123", and
+# >> xa.resource.db("DELETE FROM t", pool__cache_write_keys = { "t/*" })
+# invalidates reads of "t", "t/123" and "t/123/c", but not "u/123".
+#
+# For range access, a key can also be a tuple ("namespace", low, high)
+# (or ("namespace", value) for a single value) with numeric inclusive
+# bounds, and such keys conflict with the overlapping ranges in the same
+# namespace, as well as with the prefix keys covering the namespace:
+#
+# >> xa.resource.db("SELECT * FROM t WHERE k BETWEEN {a} AND {b}", a = 10, b = 20,
+#                   pool__cache_read_keys = { ("t/k", 10, 20) })
+# is invalidated by a write to ("t/k", 15), ("t/k", 20, 30) or "t/*",
+# but not by a write to ("t/k", 21) or "t/k".
+#
+# The keys are indexed, therefore the cost of detecting the conflicts
+# depends on the number of conflicting keys, not on the total number of them.
+#
+# The cache contents can be saved to a snapshot file and restored from it
+# later, so that the cache survives cage restart. Each cached value is saved
+# along with its expiration time, weight, group and read keys, values that
+# cannot be pickled are not saved. The snapshot is stamped and is discarded
+# upon loading if the stamp does not match. Should the snapshot fail to be
+# saved by the resource pool maintenance, the snapshot_failed callable is
+# passed the error description. See pool__cache_snapshot_period in shared_pools.py.
 #
 # Pythomnic3k project
 # (c) 2005-2015, Dmitry Dvoinikov <dmitry@targeted.org>
@@ -110,6 +159,9 @@ import time; from time import time
 import copy; from copy import deepcopy
 import heapq; from heapq import nsmallest
 import random; from random import randint
+import bisect; from bisect import bisect_left, bisect_right
+import os; from os import replace as rename
+import pickle; from pickle import dumps as pickle, loads as unpickle
 
 if __name__ == "__main__": # add pythomnic/lib to sys.path
     import os; import sys
@@ -125,6 +177,7 @@ import pmnc.timeout; from pmnc.timeout import Timeout
 
 _positive_int = lambda i: isinstance(i, int) and i > 0
 _non_negative_float = lambda f: isinstance(f, float) and f >= 0.0
+_fraction = lambda f: isinstance(f, float) and 0.0 <= f <= 1.0
 
 ###############################################################################
 # built-in hash is undeterministic, djb2 is used instead for strings keys
@@ -135,6 +188,29 @@ def _hash(s: str) -> int:
         h = (h * 33 + ord(c)) & 0xffffffff
     return h
 
+###############################################################################
+# read and write keys are parsed into hashable tuples of the following kinds:
+# ("=", path) for exact key "a/b", ("*", path) for prefix key "a/b/*" and
+# ("~", path, low, high) for range key ("a/b", low, high), where path is
+# a tuple of hashed key segments
+
+def _parse_path(s: str) -> tuple:
+    return tuple(_hash(segment) for segment in s.split("/"))
+
+def _parse_key(k) -> tuple:
+    if isinstance(k, str):
+        if k == "*":
+            return ("*", ())
+        elif k.endswith("/*"):
+            return ("*", _parse_path(k[:-2]))
+        else:
+            return ("=", _parse_path(k))
+    elif isinstance(k, tuple) and len(k) in (2, 3) and isinstance(k[0], str) and \
+         all(isinstance(b, (int, float)) for b in k[1:]) and k[1] <= k[-1]:
+        return ("~", _parse_path(k[0]), k[1], k[-1])
+    else:
+        raise Exception("invalid cache key: {0:s}".format(repr(k)))
+
 ###############################################################################
 # this class collects statistics on cache performance of a group of keys,
 # which is an average time saved on hits of the group cache entries,
@@ -201,15 +277,22 @@ class CachedValue: # instances of this class contain cached values
     _instance_count = InterlockedCounter() # we need to count cached values
                                            # so that they have unique ids
 
-    def __init__(self, value, *, ttl = None, weight = None, group_counter = None):
+    def __init__(self, value, *, ttl = None, stale_ttl = None, refresh_ahead = None,
+                 weight = None, group = None, group_counter = None):
 
         self._value = value
 
         self.key = self._instance_count.next()
 
         self._timeout = Timeout(ttl) if ttl else None
+        self._deadline = time() + ttl if ttl else None
+        self._stale_timeout = Timeout(ttl + stale_ttl) if ttl and stale_ttl else None
+        self._refresh_timeout = Timeout(ttl * refresh_ahead) if ttl and refresh_ahead is not None else None
+        self.stale_ttl = stale_ttl
         self.weight = weight
+        self.group = group
         self._group_counter = group_counter
+        self.read_keys = None # set by the read/write cache to the keys the value depends upon
 
         self.hit_count = -1 # after call to touch becomes 0
         self.touch()
@@ -217,8 +300,19 @@ class CachedValue: # instances of this class contain cached values
     value = property(lambda self: self._value)
     expired = property(lambda self: self._timeout.expired if self._timeout is not None else False)
     ttl = property(lambda self: self._timeout.remain if self._timeout is not None else None)
+    deadline = property(lambda self: self._deadline)
     group_weight = property(lambda self: self._group_counter.group_weight if self._group_counter else None)
 
+    # expired value may still be returned within the grace period while it is being
+    # refreshed, and once the grace period is over as well, the value is of no use
+
+    stale = property(lambda self: self.expired and self._stale_timeout is not None and not self._stale_timeout.expired)
+    perished = property(lambda self: self.expired and not self.stale)
+
+    # the value is to be refreshed either because it has expired or is about to
+
+    refresh_due = property(lambda self: self.expired or (self._refresh_timeout is not None and self._refresh_timeout.expired))
+
     def touch(self):
         self.last_used = time() # note that usage has nothing to do with expiration
         self.hit_count += 1
@@ -237,12 +331,20 @@ class ResourcePoolCache:
                  policy: optional(one_of("lru", "lfu", "weight", "useless", "old", "random")) = None,
                  default_ttl: optional(_non_negative_float) = None,
                  evict_period: optional(_non_negative_float) = None,
-                 group_interval: optional(_non_negative_float) = None):
+                 group_interval: optional(_non_negative_float) = None,
+                 stale_ttl: optional(_non_negative_float) = None,
+                 refresh_ahead: optional(_fraction) = None,
+                 snapshot_file: optional(str) = None,
+                 snapshot_stamp: optional(str) = None,
+                 snapshot_period: optional(_non_negative_float) = None,
+                 snapshot_failed: optional(callable) = None):
 
         self._name = name
         self._size = size # can be None meaning unrestricted
         self._policy = policy or "lru"
         self._default_ttl = default_ttl # can be None meaning unspecified
+        self._stale_ttl = stale_ttl # can be None meaning expired values are never returned
+        self._refresh_ahead = refresh_ahead # can be None meaning no refresh before expiration
 
         self._evict_period = evict_period or self._default_evict_period
         self._evict_timeout = Timeout(self._evict_period)
@@ -253,12 +355,23 @@ class ResourcePoolCache:
 
         self._lock, self._cache = Lock(), {}
 
+        self._snapshot_file = snapshot_file # can be None meaning no snapshots
+        self._snapshot_stamp = snapshot_stamp
+        self._snapshot_lock = Lock()
+        self._snapshot_timeout = Timeout(snapshot_period) if snapshot_file and snapshot_period else None
+        self._snapshot_failed = snapshot_failed
+
     name = property(lambda self: self._name)
     size = property(lambda self: self._size)
     policy = property(lambda self: self._policy)
     default_ttl = property(lambda self: self._default_ttl)
     evict_period = property(lambda self: self._evict_period)
     group_interval = property(lambda self: self._group_interval)
+    stale_ttl = property(lambda self: self._stale_ttl)
+    refresh_ahead = property(lambda self: self._refresh_ahead)
+    snapshot_file = property(lambda self: self._snapshot_file)
+    snapshot_failed = property(lambda self: self._snapshot_failed)
+    snapshot_due = property(lambda self: self._snapshot_timeout is not None and self._snapshot_timeout.expired)
 
     # utility method to set caching parameters on per-value basis
 
@@ -319,23 +432,32 @@ class ResourcePoolCache:
     # remove entries that are to expire soon, note that values that never expire get removed last
 
     def _evict_old(self, cv, now, gw):
-        return (cv.ttl * gw) if cv.ttl is not None else float("inf")
+        return ((cv.deadline - now) * gw) if cv.deadline is not None else float("inf")
 
     # remove entries at random
 
     def _evict_random(self, cv, now, gw):
         return randint(0, 2147483647) * gw
 
-    # protocol method
+    # utility method to fetch a cached value which is not yet of no use,
+    # note that it can still be expired and returned only while stale
 
-    def _get(self, k):
+    def _lookup(self, k):
         self._evict()
         cv = self._cache.get(k)
         if cv is None:
             return None
-        if cv.expired:
+        if cv.perished:
             del self._cache[k]
             return None
+        return cv
+
+    # protocol method
+
+    def _get(self, k):
+        cv = self._lookup(k)
+        if cv is None or cv.expired:
+            return None
         cv.touch()
         return self._unwrap_value(cv)
 
@@ -393,6 +515,7 @@ class ResourcePoolCache:
     def _wrap_value(self, v, kwargs):
 
         ttl = kwargs.get("pool__cache_ttl", self._default_ttl)
+        stale_ttl = kwargs.get("pool__cache_stale_ttl", self._stale_ttl)
         weight = kwargs.get("pool__cache_weight")
         group = kwargs.get("pool__cache_group")
 
@@ -405,8 +528,9 @@ class ResourcePoolCache:
             group_counter = None
 
         return CachedValue(deepcopy(v),
-                           ttl = ttl, weight = weight,
-                           group_counter = group_counter)
+                           ttl = ttl, stale_ttl = stale_ttl,
+                           refresh_ahead = self._refresh_ahead,
+                           weight = weight, group = group, group_counter = group_counter)
 
     def _unwrap_value(self, cv):
 
@@ -415,7 +539,7 @@ class ResourcePoolCache:
     # called by the maintenance thread periodically
 
     def _purge(self):
-        self._cache = { k: cv for k, cv in self._cache.items() if not cv.expired }
+        self._cache = { k: cv for k, cv in self._cache.items() if not cv.perished }
         self._evict()
         if self._group_counters:
             self._group_counters = { g: gc for g, gc in self._group_counters.items() if not gc.trim() }
@@ -424,69 +548,310 @@ class ResourcePoolCache:
         with self._lock:
             self._purge()
 
+    # saves unexpired values to the snapshot file, the values are pickled
+    # outside the lock, which is safe because cached values are never modified,
+    # the file is replaced atomically so that a crash leaves the previous snapshot
+
+    def save_snapshot(self):
+
+        with self._snapshot_lock:
+
+            if self._snapshot_timeout is not None:
+                self._snapshot_timeout.reset()
+
+            with self._lock:
+                cvs = [ (k, cv) for k, cv in self._cache.items() if not cv.expired ]
+
+            entries = []
+            for k, cv in cvs:
+                try:
+                    entries.append(pickle((k, cv.value, cv.deadline, cv.stale_ttl,
+                                           cv.weight, cv.group, cv.read_keys)))
+                except:
+                    pass # values that cannot be pickled are simply not saved
+
+            temp_file = "{0:s}.tmp".format(self._snapshot_file)
+            with open(temp_file, "wb") as f:
+                f.write(pickle(dict(stamp = self._snapshot_stamp, entries = entries)))
+            rename(temp_file, self._snapshot_file)
+
+            return len(entries)
+
+    # restores the values saved to the snapshot file, which keep their
+    # remaining time to live, returns the number of restored values, or
+    # None if the snapshot has been discarded because of stamp mismatch
+
+    def load_snapshot(self):
+
+        with self._snapshot_lock:
+
+            try:
+                with open(self._snapshot_file, "rb") as f:
+                    snapshot = unpickle(f.read())
+            except FileNotFoundError:
+                return 0
+
+            if snapshot["stamp"] != self._snapshot_stamp:
+                return None
+
+            restored = 0
+            now = time()
+
+            with self._lock:
+                for entry in snapshot["entries"]:
+                    k, v, deadline, stale_ttl, weight, group, read_keys = unpickle(entry)
+                    if (deadline is not None and deadline <= now) or k in self._cache:
+                        continue # the value has expired while the cage was down or is already cached
+                    self._restore(k, v, dict(pool__cache_ttl = deadline - now if deadline is not None else None,
+                                             pool__cache_stale_ttl = stale_ttl,
+                                             pool__cache_weight = weight,
+                                             pool__cache_group = group), read_keys)
+                    restored += 1
+
+            return restored
+
+    def _restore(self, k, v, kwargs, read_keys):
+        self._put(k, v, kwargs)
+
 ################################################################################
 
+class RangeIndex: # ranges are kept sorted by lower bound, and knowing the width
+                  # of the widest range restricts the scan to the candidates only
+    def __init__(self):
+        self._lows, self._ranges = [], []
+        self._width = 0
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def add(self, low, high, ref):
+        i = bisect_right(self._lows, low)
+        self._lows.insert(i, low)
+        self._ranges.insert(i, (low, high, ref))
+        self._width = max(self._width, high - low)
+
+    def remove(self, low, high, ref):
+        i = bisect_left(self._lows, low)
+        while i < len(self._lows) and self._lows[i] == low:
+            if self._ranges[i] == (low, high, ref):
+                del self._lows[i]
+                del self._ranges[i]
+                if high - low == self._width: # the widest range may be gone
+                    self._update_width()
+                return
+            i += 1
+
+    def _update_width(self):
+        self._width = max((r[1] - r[0] for r in self._ranges), default = 0)
+
+    def _window(self, low, high):
+        return bisect_left(self._lows, low - self._width), bisect_right(self._lows, high)
+
+    def find(self, low, high):
+        i, j = self._window(low, high)
+        return set(r[2] for r in self._ranges[i:j] if r[1] >= low)
+
+    def pop(self, low, high):
+        i, j = self._window(low, high)
+        refs, kept = set(), []
+        for r in self._ranges[i:j]:
+            if r[1] >= low:
+                refs.add(r[2])
+            else:
+                kept.append(r)
+        self._ranges[i:j] = kept
+        self._lows[i:j] = [ r[0] for r in kept ]
+        if refs:
+            self._update_width()
+        return refs
+
+    def refs(self):
+        return set(r[2] for r in self._ranges)
+
+    def filter(self, valid_ref):
+        self._ranges = [ r for r in self._ranges if valid_ref(r[2]) ]
+        self._lows = [ r[0] for r in self._ranges ]
+        self._update_width()
+
+###############################################################################
+
+class KeyNode: # a node of the key trie, one per key segment
+
+    __slots__ = ("children", "exact", "prefix", "ranges")
+
+    def __init__(self):
+        self.children = {}    # segment hash -> KeyNode
+        self.exact = set()    # refs registered with key "a/b"
+        self.prefix = set()   # refs registered with key "a/b/*"
+        self.ranges = None    # refs registered with keys ("a/b", low, high)
+
+    def subtree_refs(self):
+        refs = self.exact | self.prefix
+        if self.ranges:
+            refs |= self.ranges.refs()
+        for child in self.children.values():
+            refs |= child.subtree_refs()
+        return refs
+
+    def filter(self, valid_ref): # returns True if the node becomes useless
+        self.exact = set(filter(valid_ref, self.exact))
+        self.prefix = set(filter(valid_ref, self.prefix))
+        if self.ranges:
+            self.ranges.filter(valid_ref)
+        self.children = { h: child for h, child in self.children.items()
+                          if not child.filter(valid_ref) }
+        return self.useless()
+
+    def useless(self): # an empty range index is also dropped
+        if self.ranges is not None and not self.ranges:
+            self.ranges = None
+        return not (self.exact or self.prefix or self.ranges or self.children)
+
+###############################################################################
+# this class maps parsed keys (see _parse_key) to sets of arbitrary references,
+# either cache keys of the cached values or ids of the executing transactions,
+# and finds the references registered with keys conflicting with the given ones
+
 class KeySet:
 
     def __init__(self):
         self._lock = Lock()
-        self._keys = {}
+        self._root = KeyNode()
+
+    def _node(self, path, create):
+        node = self._root
+        for h in path:
+            child = node.children.get(h)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[h] = KeyNode()
+            node = child
+        return node
+
+    # removes the nodes along the path that have been left with nothing
+    # in them, so that the trie does not keep growing with key churn
+
+    def _prune(self, path):
+        nodes = [ self._root ]
+        for h in path:
+            node = nodes[-1].children.get(h)
+            if node is None:
+                break
+            nodes.append(node)
+        for i in range(len(nodes) - 1, 0, -1):
+            if not nodes[i].useless():
+                break
+            del nodes[i - 1].children[path[i - 1]]
 
-    # adds multiple key -> cache_key references
+    # adds multiple key -> ref references
 
-    def add_key(self, keys, cache_key):
+    def add_key(self, keys, ref):
         with self._lock:
             for k in keys:
-                s = self._keys.get(k)
-                if s is None:
-                    s = set()
-                    self._keys[k] = s
-                s.add(cache_key)
+                node = self._node(k[1], True)
+                if k[0] == "=":
+                    node.exact.add(ref)
+                elif k[0] == "*":
+                    node.prefix.add(ref)
+                else:
+                    if node.ranges is None:
+                        node.ranges = RangeIndex()
+                    node.ranges.add(k[2], k[3], ref)
+
+    # removes multiple key -> ref references
 
-    # returns a set of cache_key's for a given set of keys,
+    def remove_key(self, keys, ref):
+        with self._lock:
+            for k in keys:
+                node = self._node(k[1], False)
+                if node is None:
+                    continue
+                if k[0] == "=":
+                    node.exact.discard(ref)
+                elif k[0] == "*":
+                    node.prefix.discard(ref)
+                elif node.ranges is not None:
+                    node.ranges.remove(k[2], k[3], ref)
+                self._prune(k[1])
+
+    # returns a set of refs registered with keys conflicting with any of the given keys,
+    # for each key only the path from the root to its node is visited, plus the entire
+    # subtree for a prefix key, optionally the matching references are discarded
+
+    def _conflicting_keys(self, keys, pop):
+        refs = set()
+        for k in keys:
+            node = self._root
+            for h in k[1]: # prefix keys along the path cover this key
+                refs |= node.prefix
+                if pop: node.prefix = set()
+                node = node.children.get(h)
+                if node is None:
+                    break
+            else:
+                refs |= node.prefix # "a/b/*" covers "a/b" itself
+                if pop: node.prefix = set()
+                if k[0] == "=":
+                    refs |= node.exact
+                    if pop: node.exact = set()
+                elif k[0] == "~":
+                    if node.ranges is not None:
+                        refs |= node.ranges.pop(k[2], k[3]) if pop else node.ranges.find(k[2], k[3])
+                else:
+                    refs |= node.subtree_refs()
+                    if pop: node.exact, node.ranges, node.children = set(), None, {}
+        return refs
+
+    def find_conflicting_keys(self, keys):
+        with self._lock:
+            return self._conflicting_keys(keys, False)
+
+    # returns a set of refs for a given set of keys,
     # the references are discarded as they are returned
 
     def pop_conflicting_keys(self, keys):
-        cache_keys = set()
         with self._lock:
+            refs = self._conflicting_keys(keys, True)
             for k in keys:
-                s = self._keys.pop(k, None)
-                if s is not None:
-                    cache_keys |= s
-        return cache_keys
+                self._prune(k[1])
+            return refs
 
-    # filters out cache keys that are no longer valid for whatever reason
+    # filters out refs that are no longer valid for whatever reason
 
-    def revalidate(self, valid_cache_key):
+    def revalidate(self, valid_ref):
         with self._lock:
-            keys = {}
-            for k, s in self._keys.items():
-                s = set(filter(lambda cache_key: valid_cache_key(cache_key), s))
-                if s: keys[k] = s
-            self._keys = keys
+            self._root.filter(valid_ref)
 
 ################################################################################
 
 class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descendant
                                                      # for read/write dependency tracking
-    def __init__(self, *args, invalidated_keys: optional(InterlockedQueue) = None, **kwargs):
+    _default_refresh_timeout = 60.0
+
+    def __init__(self, *args, invalidated_keys: optional(InterlockedQueue) = None,
+                 refresh_timeout: optional(_non_negative_float) = None, **kwargs):
 
         ResourcePoolCache.__init__(self, *args, **kwargs)
         self._xacts = {}
         self._cached = KeySet()
-        self._read_reqs = {}
-        self._write_reqs = {}
+        self._read_reqs, self._reading = {}, KeySet()
+        self._write_reqs, self._writing = {}, KeySet()
+        self._refreshes = {} # key -> Timeout after which the refresh is considered abandoned
+        self._refresh_timeout = refresh_timeout or self._default_refresh_timeout
         self._invalidated_keys = invalidated_keys
 
+    refresh_timeout = property(lambda self: self._refresh_timeout)
+
     def _extract_kwargs(self, kwargs):
 
         xid = kwargs["pool__cache_transaction_id"]
         read_keys = kwargs.get("pool__cache_read_keys")
-        if read_keys:
-            read_keys = set(_hash(s) for s in read_keys)
+        if read_keys is not None:
+            read_keys = set(_parse_key(k) for k in read_keys)
         write_keys = kwargs.get("pool__cache_write_keys")
-        if write_keys:
-            write_keys = set(_hash(s) for s in write_keys)
+        if write_keys is not None:
+            write_keys = set(_parse_key(k) for k in write_keys)
         assert read_keys is None or write_keys is None # can't specify both read and write keys
 
         return xid, read_keys, write_keys
@@ -501,6 +866,7 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
         if write_keys is not None:
             with self._lock:
                 self._write_reqs[xid] = write_keys
+                self._writing.add_key(write_keys, xid)
                 self._invalidate_read_reqs(write_keys)
             return None
 
@@ -509,31 +875,67 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
 
         if read_keys is not None:
             with self._lock:
-                for write_keys_ in self._write_reqs.values():
-                    if write_keys_.intersection(read_keys):
-                        break
-                else:
+                if not self._writing.find_conflicting_keys(read_keys):
                     self._read_reqs[xid] = read_keys # this request currently has no conflicts
+                    self._reading.add_key(read_keys, xid)
 
         # read requests are executed so that only one request can proceed
         # for any given cache key, the others will wait and get the cached
         # result once the first request returns
 
+        # if the caller is capable of refreshing the value in background,
+        # stale values can be returned, and the first such hit initiates
+        # the refresh, but the request that performs the refresh must not
+        # get the cached value, it has to execute the actual call instead
+
+        refresh = kwargs.get("pool__cache_refresh")
+        refreshing = kwargs.get("pool__cache_refreshing", False)
         timeout = Timeout(kwargs["pool__cache_timeout"])
 
         while True: # this is a do-while loop as we need at least one pass
             with self._lock:
-                value = self._get(key)
-                if value is not None:
-                    return value # always returns a cached value
+                if not refreshing:
+                    value, refresh_required = self._get_or_refresh(key, refresh is not None)
+                    if value is not None:
+                        break # always returns a cached value
                 e_xid = self._xacts.get(key)
                 if not e_xid:                         # register this transaction as the one
                     self._xacts[key] = (Event(), xid) # responsible for actually executing the call
                     return None
-            e_xid[0].wait(timeout.remain)             # and the others will wait for it
+                refreshing = False # some other transaction is already executing the call,
+            e_xid[0].wait(timeout.remain) # the refresh is moot, and the others will wait for it
             if timeout.expired:
                 return Timeout # timed out, do not attempt to execute
 
+        if refresh_required:
+            try:
+                refresh()
+            except:
+                with self._lock:
+                    self._refreshes.pop(key, None)
+                raise
+
+        return value
+
+    # returns a cached value, possibly stale, and an indication whether the caller
+    # is the first to notice that the value needs to be refreshed in background
+
+    def _get_or_refresh(self, key, refreshable):
+
+        cv = self._lookup(key)
+        if cv is None or (cv.expired and not (refreshable and cv.stale)):
+            return None, False
+
+        cv.touch()
+
+        refresh_timeout = self._refreshes.get(key)
+        refresh_required = refreshable and cv.refresh_due and \
+                           (refresh_timeout is None or refresh_timeout.expired) and key not in self._xacts
+        if refresh_required:
+            self._refreshes[key] = Timeout(self._refresh_timeout)
+
+        return self._unwrap_value(cv), refresh_required
+
     # the following method caches and registers results of read
     # transactions, releases transactions waiting in get, invalidates
     # cached read against conflicting write transactions
@@ -550,7 +952,7 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
                 if self._invalidated_keys is not None: # notify the owner
                     self._invalidated_keys.push(write_keys)
                 self._invalidate(write_keys)
-                del self._write_reqs[xid]
+                self._writing.remove_key(self._write_reqs.pop(xid), xid)
             return
 
         # read request has returned, its result is cached if
@@ -561,9 +963,20 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
         # therefore caching should not be enabled on resources which can return None
         # as a valid execution result
 
+        # a background refresh replaces the stale cached value, and
+        # should it fail, the stale value remains until it perishes,
+        # the next hit to it will then initiate another refresh
+
+        refreshing = kwargs.get("pool__cache_refreshing", False)
+
         with self._lock:
 
+            if refreshing:
+                self._refreshes.pop(key, None)
+
             read_keys_ = self._read_reqs.pop(xid, None) if read_keys is not None else None
+            if read_keys_ is not None:
+                self._reading.remove_key(read_keys_, xid)
             cache_value = (value is not None) and ((read_keys is None) or (read_keys_ is not None))
 
             e_xid = self._xacts.get(key)
@@ -571,8 +984,10 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
                 if e_xid[1] == xid: # this request has been executing the actual resource call
                     del self._xacts[key]
                     if cache_value:
-                        assert not self._contains(key)
+                        cv = self._cache.get(key)
+                        assert cv is None or cv.expired or refreshing
                         self._put(key, value, kwargs)
+                        self._cache[key].read_keys = read_keys
                     e_xid[0].set()
                 else: # this request has timed out waiting for result to appear in the cache
                     assert value is None
@@ -588,7 +1003,7 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
     # it has the same effect as an infinitely fast write request with the same set of keys
 
     def invalidate(self, write_keys):
-        write_keys = set(_hash(s) for s in write_keys)
+        write_keys = set(_parse_key(k) for k in write_keys)
         with self._lock:
             self._invalidate_read_reqs(write_keys)
             self._invalidate(write_keys)
@@ -603,9 +1018,8 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
     # the list so that their results are not cached when they return
 
     def _invalidate_read_reqs(self, write_keys):
-        self._read_reqs = \
-            dict(filter(lambda xid_read_keys: xid_read_keys[1].isdisjoint(write_keys),
-                        self._read_reqs.items()))
+        for xid in self._reading.find_conflicting_keys(write_keys):
+            self._reading.remove_key(self._read_reqs.pop(xid), xid)
 
     # remove all the cache keys that are not actually in the cache
 
@@ -613,6 +1027,19 @@ class ResourcePoolReadWriteCache(ResourcePoolCache): # transaction-aware descend
         with self._lock:
             self._purge()
             self._cached.revalidate(lambda cache_key: self._contains(cache_key))
+            self._reading.revalidate(lambda xid: xid in self._read_reqs)
+            self._writing.revalidate(lambda xid: xid in self._write_reqs)
+            self._refreshes = { key: refresh_timeout for key, refresh_timeout in self._refreshes.items()
+                                if not refresh_timeout.expired }
+
+    # restored values are registered against their read keys
+    # so that they are invalidated just like the freshly cached ones
+
+    def _restore(self, k, v, kwargs, read_keys):
+        ResourcePoolCache._restore(self, k, v, kwargs, read_keys)
+        if read_keys is not None:
+            self._cache[k].read_keys = read_keys
+            self._cached.add_key(read_keys, k)
 
 ################################################################################
 
@@ -626,6 +1053,8 @@ if __name__ == "__main__":
     from random import random, normalvariate
     from expected import expected
     from threading import Thread
+    from tempfile import mkdtemp
+    from os import path as os_path
 
     ###################################
 
@@ -700,6 +1129,36 @@ if __name__ == "__main__":
     assert time() - cv.last_used > 1.0
     assert cv.hit_count == 0
 
+    ########
+
+    cv = rpc._wrap_value("baz", dict(pool__cache_ttl = 1.0, pool__cache_stale_ttl = 1.0))
+
+    assert not cv.expired and not cv.stale and not cv.perished and not cv.refresh_due
+
+    sleep(1.2)
+
+    assert cv.expired and cv.stale and not cv.perished and cv.refresh_due
+
+    sleep(1.0)
+
+    assert cv.expired and not cv.stale and cv.perished and cv.refresh_due
+
+    cv = CachedValue("baz", ttl = 1.0, refresh_ahead = 0.5)
+
+    assert not cv.expired and not cv.refresh_due
+
+    sleep(0.7)
+
+    assert not cv.expired and not cv.stale and cv.refresh_due
+
+    sleep(0.5)
+
+    assert cv.expired and not cv.stale and cv.perished and cv.refresh_due
+
+    cv = CachedValue("baz", ttl = None, stale_ttl = 1.0, refresh_ahead = 0.5)
+
+    assert not cv.expired and not cv.stale and not cv.perished and not cv.refresh_due
+
     ###################################
 
     # cache group count
@@ -1297,26 +1756,126 @@ if __name__ == "__main__":
 
     ###################################
 
+    def keys(*ks):
+        return set(_parse_key(k) for k in ks)
+
     ks = KeySet()
 
-    ks.add_key({ "foo", 1 }, "FOO/1")
-    ks.add_key({ "bar" }, "BAR")
-    assert ks.pop_conflicting_keys({}) == set()
-    assert ks.pop_conflicting_keys({ "foo" }) == { "FOO/1" }
-    assert ks.pop_conflicting_keys({ "foo" }) == set()
-    assert ks.pop_conflicting_keys({ "bar", 2 }) == { "BAR" }
-    assert ks.pop_conflicting_keys({ "bar", 2 }) == set()
-
-    ks.add_key({ "foo", 1 }, "FOO/1")
-    ks.add_key({ "bar" }, "BAR")
-    assert ks.pop_conflicting_keys({ "foo", 1 }) == { "FOO/1" }
-    assert ks.pop_conflicting_keys({ "foo", 1 }) == set()
-    assert ks.pop_conflicting_keys({ "bar", 1 }) == { "BAR" }
-
-    ks.add_key({ "foo", 1 }, "FOO/1")
-    ks.add_key({ "bar" }, "BAR")
-    assert ks.pop_conflicting_keys({ "foo", "bar" }) == { "FOO/1", "BAR" }
-    assert ks.pop_conflicting_keys({ "foo", "bar" }) == set()
+    ks.add_key(keys("foo", "1"), "FOO/1")
+    ks.add_key(keys("bar"), "BAR")
+    assert ks.pop_conflicting_keys(keys()) == set()
+    assert ks.pop_conflicting_keys(keys("foo")) == { "FOO/1" }
+    assert ks.pop_conflicting_keys(keys("foo")) == set()
+    assert ks.pop_conflicting_keys(keys("bar", "2")) == { "BAR" }
+    assert ks.pop_conflicting_keys(keys("bar", "2")) == set()
+
+    ks.add_key(keys("foo", "1"), "FOO/1")
+    ks.add_key(keys("bar"), "BAR")
+    assert ks.pop_conflicting_keys(keys("foo", "1")) == { "FOO/1" }
+    assert ks.pop_conflicting_keys(keys("foo", "1")) == set()
+    assert ks.pop_conflicting_keys(keys("bar", "1")) == { "BAR" }
+
+    ks.add_key(keys("foo", "1"), "FOO/1")
+    ks.add_key(keys("bar"), "BAR")
+    assert ks.pop_conflicting_keys(keys("foo", "bar")) == { "FOO/1", "BAR" }
+    assert ks.pop_conflicting_keys(keys("foo", "bar")) == set()
+
+    # key parsing
+
+    assert _parse_key("a/b") == ("=", (_hash("a"), _hash("b")))
+    assert _parse_key("a/b/*") == ("*", (_hash("a"), _hash("b")))
+    assert _parse_key("*") == ("*", ())
+    assert _parse_key(("a/b", 1, 2)) == ("~", (_hash("a"), _hash("b")), 1, 2)
+    assert _parse_key(("a", 1.5)) == ("~", (_hash("a"), ), 1.5, 1.5)
+    for k in (1, None, ("a", ), ("a", 2, 1), ("a", "b"), (1, 2), ("a", 1, 2, 3)):
+        try:
+            _parse_key(k)
+        except Exception as e:
+            assert str(e).startswith("invalid cache key: ")
+        else:
+            assert False
+
+    # prefix keys
+
+    ks = KeySet()
+    ks.add_key(keys("t"), "T")
+    ks.add_key(keys("t/1"), "T/1")
+    ks.add_key(keys("t/1/c"), "T/1/C")
+    ks.add_key(keys("t/*"), "T/*")
+    ks.add_key(keys("u/1"), "U/1")
+    assert ks.find_conflicting_keys(keys("t/2")) == { "T/*" }
+    assert ks.find_conflicting_keys(keys("t/1")) == { "T/*", "T/1" }
+    assert ks.find_conflicting_keys(keys("t/1/c/d")) == { "T/*" }
+    assert ks.find_conflicting_keys(keys("t/1/*")) == { "T/*", "T/1", "T/1/C" }
+    assert ks.find_conflicting_keys(keys("t/*")) == { "T", "T/1", "T/1/C", "T/*" }
+    assert ks.find_conflicting_keys(keys("u/*")) == { "U/1" }
+    assert ks.find_conflicting_keys(keys("v/*")) == set()
+    assert ks.find_conflicting_keys(keys("*")) == { "T", "T/1", "T/1/C", "T/*", "U/1" }
+    assert ks.pop_conflicting_keys(keys("t/1/*")) == { "T/*", "T/1", "T/1/C" }
+    assert ks.pop_conflicting_keys(keys("*")) == { "T", "U/1" }
+    assert ks.pop_conflicting_keys(keys("*")) == set()
+
+    # range keys
+
+    ks.add_key(keys(("t/k", 10, 20)), "10-20")
+    ks.add_key(keys(("t/k", 15)), "15")
+    ks.add_key(keys(("t/k", 30, 40)), "30-40")
+    ks.add_key(keys(("t/j", 0, 100)), "J")
+    assert ks.find_conflicting_keys(keys(("t/k", 0, 9))) == set()
+    assert ks.find_conflicting_keys(keys(("t/k", 0, 10))) == { "10-20" }
+    assert ks.find_conflicting_keys(keys(("t/k", 16))) == { "10-20" }
+    assert ks.find_conflicting_keys(keys(("t/k", 15))) == { "10-20", "15" }
+    assert ks.find_conflicting_keys(keys(("t/k", 20, 30))) == { "10-20", "30-40" }
+    assert ks.find_conflicting_keys(keys(("t/k", 41, 50))) == set()
+    assert ks.find_conflicting_keys(keys("t/k")) == set()
+    assert ks.find_conflicting_keys(keys("t/k/*")) == { "10-20", "15", "30-40" }
+    assert ks.find_conflicting_keys(keys("t/*")) == { "10-20", "15", "30-40", "J" }
+    ks.remove_key(keys(("t/k", 15)), "15")
+    assert ks.pop_conflicting_keys(keys(("t/k", 15, 35))) == { "10-20", "30-40" }
+    assert ks.pop_conflicting_keys(keys(("t/k", 15, 35))) == set()
+    ks.add_key(keys(("t/k", 10, 20)), "10-20")
+    ks.add_key(keys("t/*"), "T/*")
+    assert ks.find_conflicting_keys(keys(("t/k", 100))) == { "T/*" }
+    assert ks.find_conflicting_keys(keys(("t", 100))) == { "T/*" }
+
+    # removal and revalidation
+
+    ks.remove_key(keys("t/*", ("t/j", 0, 100)), "J")
+    assert ks.find_conflicting_keys(keys("*")) == { "10-20", "T/*" }
+    ks.revalidate(lambda ref: ref != "10-20")
+    assert ks.find_conflicting_keys(keys("*")) == { "T/*" }
+    assert list(ks._root.children.keys()) == [ _hash("t") ]
+    assert ks._root.children[_hash("t")].children == {}
+    ks.revalidate(lambda ref: False)
+    assert ks._root.children == {}
+
+    # removal prunes the nodes left empty, and the widest range is recalculated
+
+    ks = KeySet()
+    ks.add_key(keys("a/b/c", ("a/r", 0, 1000), ("a/r", 5, 6)), "X")
+    ks.add_key(keys("a/d"), "Y")
+    ks.remove_key(keys("a/b/c", ("a/r", 0, 1000)), "X")
+    node_a = ks._root.children[_hash("a")]
+    assert set(node_a.children.keys()) == { _hash("d"), _hash("r") }
+    assert node_a.children[_hash("r")].ranges._width == 1
+    ks.remove_key(keys(("a/r", 5, 6)), "X")
+    assert set(node_a.children.keys()) == { _hash("d") }
+    assert ks.pop_conflicting_keys(keys("a/d")) == { "Y" }
+    assert ks._root.children == {}
+
+    # the cost of detecting conflicts does not depend on the number of unrelated keys
+
+    ks = KeySet()
+    for i in range(100000):
+        ks.add_key(keys("t/{0:d}".format(i), ("r", i * 10, i * 10 + 5)), i)
+
+    start = time()
+    for i in range(10000):
+        assert ks.find_conflicting_keys(keys("t/{0:d}".format(i), ("r", i * 10 + 5, i * 10 + 9))) == { i }
+    print("{0:d} conflicts detected per second with 100000 keys".format(int(10000 / (time() - start))))
+
+    assert len(ks.pop_conflicting_keys(keys("t/*"))) == 100000
+    assert len(ks.pop_conflicting_keys(keys(("r", -1000, 1000)))) == 101
 
     ###################################
 
@@ -1420,8 +1979,8 @@ if __name__ == "__main__":
     dr = rw_kwargs(read = { "foo", "bar" })
     assert rwc.get("k", **dr) is None
     rwc.put("k", "v1", **dr)
-    assert _hash("foo") in rwc._cached._keys
-    assert _hash("bar") in rwc._cached._keys
+    assert rwc._cached.find_conflicting_keys(keys("foo")) == { "k" }
+    assert rwc._cached.find_conflicting_keys(keys("bar")) == { "k" }
     assert "k" in rwc._cache
     assert ik.pop(0.1) is None
 
@@ -1430,7 +1989,7 @@ if __name__ == "__main__":
     dr = rw_kwargs(read = { "foo", "BAR" })
     assert rwc.get("k", **dr) == "v1"
     rwc.put("k", None, **dr)
-    assert _hash("BAR") in rwc._cached._keys
+    assert rwc._cached.find_conflicting_keys(keys("BAR")) == { "k" }
     assert "k" in rwc._cache
     assert ik.pop(0.1) is None
 
@@ -1439,9 +1998,9 @@ if __name__ == "__main__":
     dw = rw_kwargs(write = { "bar" })
     assert rwc.get("k", **dw) is None
     rwc.put("k", None, **dw)
-    assert _hash("bar") not in rwc._cached._keys
+    assert rwc._cached.find_conflicting_keys(keys("bar")) == set()
     assert "k" not in rwc._cache
-    assert ik.pop(0.1) == { _hash("bar") }
+    assert ik.pop(0.1) == keys("bar")
     assert ik.pop(0.1) is None
 
     # forced invalidation
@@ -1462,7 +2021,8 @@ if __name__ == "__main__":
     assert rwc.get("K?", **dr) is None
     assert len(rwc._read_reqs) == 1
     xa = list(rwc._read_reqs.keys())[0]
-    assert rwc._read_reqs[xa] == { _hash("b") }
+    assert rwc._read_reqs[xa] == keys("b")
+    assert rwc._reading.find_conflicting_keys(keys("b")) == { xa }
 
     assert "K1" in rwc
     assert "K2" in rwc
@@ -1475,15 +2035,28 @@ if __name__ == "__main__":
     assert "K3" in rwc
 
     assert len(rwc._read_reqs) == 0
+    assert rwc._reading.find_conflicting_keys(keys("*")) == set()
     assert ik.pop(0.1) is None
 
     # purging missing cache keys
 
-    assert _hash("foo") in rwc._cached._keys
-    assert _hash("BAR") in rwc._cached._keys
+    assert rwc._cached.find_conflicting_keys(keys("foo")) == { "k" }
+    assert rwc._cached.find_conflicting_keys(keys("BAR")) == { "k" }
+    rwc.purge()
+    assert rwc._cached.find_conflicting_keys(keys("foo")) == set()
+    assert rwc._cached.find_conflicting_keys(keys("BAR")) == set()
+    assert _hash("foo") not in rwc._cached._root.children
+
+    # the indexes do not grow with distinct keys cached and evicted
+
+    for i in range(20000):
+        dr = rw_kwargs(read = { "churn/{0:d}".format(i) })
+        assert rwc.get("churn", **dr) is None
+        rwc.put("churn", i, **dr)
+        rwc.pop("churn")
     rwc.purge()
-    assert _hash("foo") not in rwc._cached._keys
-    assert _hash("BAR") not in rwc._cached._keys
+    assert _hash("churn") not in rwc._cached._root.children
+    assert _hash("churn") not in rwc._reading._root.children
 
     # failing reads
 
@@ -1673,6 +2246,279 @@ if __name__ == "__main__":
     assert rwc.get("k", **dr) == "v"
     rwc.put("k", None, **dr)
 
+    # stale while revalidate
+
+    rwc = ResourcePoolReadWriteCache("name", size = 10, default_ttl = 1.0, stale_ttl = 1.0)
+
+    refreshes = []
+    refresh = lambda: refreshes.append(None)
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) is None
+    rwc.put("k", "v1", pool__cache_refresh = refresh, **dr)
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert not refreshes # fresh value is not refreshed
+
+    sleep(1.2)
+
+    dr = rw_kwargs(read = { "s" }) # stale value is not returned to the caller
+    assert rwc.get("k", **dr) is None # who is unable to refresh it
+    rwc.put("k", "v2", **dr)
+    assert rwc.pop("k") == "v2"
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) is None
+    rwc.put("k", "v1", pool__cache_refresh = refresh, **dr)
+
+    sleep(1.2)
+
+    dr1 = rw_kwargs(read = { "s" }) # the first hit to a stale value initiates the refresh
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr1) == "v1"
+    rwc.put("k", None, **dr1)
+    assert len(refreshes) == 1 and "k" in rwc._refreshes
+
+    dr2 = rw_kwargs(read = { "s" }) # but only once
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr2) == "v1"
+    rwc.put("k", None, **dr2)
+    assert len(refreshes) == 1
+
+    dr3 = rw_kwargs(read = { "s" }) # the refreshing request bypasses the cache
+    dr3.update(pool__cache_refreshing = True)
+    assert rwc.get("k", **dr3) is None
+
+    dr4 = rw_kwargs(read = { "s" }) # and meanwhile the stale value is still returned
+    t = time()
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr4) == "v1"
+    assert time() - t < 0.1
+    rwc.put("k", None, **dr4)
+
+    rwc.put("k", "v2", **dr3) # the refreshed value replaces the stale one
+    assert not rwc._refreshes and not rwc._xacts
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v2"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 1
+
+    sleep(2.2) # once the grace period is over, the value perishes
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) is None
+    rwc.put("k", None, **dr)
+    assert "k" not in rwc and len(refreshes) == 1
+
+    # failed refresh keeps the stale value and the next hit retries
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) is None
+    rwc.put("k", "v1", **dr)
+
+    sleep(1.2)
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 2
+
+    dr = rw_kwargs(read = { "s" })
+    dr.update(pool__cache_refreshing = True)
+    assert rwc.get("k", **dr) is None
+    rwc.put("k", None, **dr)
+    assert not rwc._refreshes
+
+    dr = rw_kwargs(read = { "s" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 3
+
+    # refresh cannot be initiated
+
+    def failing_refresh():
+        raise Exception("foo")
+
+    rwc._refreshes.clear()
+
+    dr = rw_kwargs(read = { "s" })
+    with expected(Exception("foo")):
+        rwc.get("k", pool__cache_refresh = failing_refresh, **dr)
+    assert not rwc._refreshes
+
+    # concurrent write invalidates the stale value as well as the refresh
+
+    dr = rw_kwargs(read = { "s" })
+    dr.update(pool__cache_refreshing = True)
+    assert rwc.get("k", **dr) is None
+
+    dw = rw_kwargs(write = { "s" })
+    assert rwc.get("k", **dw) is None
+    rwc.put("k", None, **dw)
+    assert "k" not in rwc
+
+    rwc.put("k", "v3", **dr)
+    assert "k" not in rwc
+
+    # refresh ahead of expiration
+
+    rwc = ResourcePoolReadWriteCache("name", size = 10, default_ttl = 2.0, refresh_ahead = 0.5)
+    refreshes.clear()
+
+    dr = rw_kwargs(read = { "r" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) is None
+    rwc.put("k", "v1", **dr)
+
+    dr = rw_kwargs(read = { "r" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert not refreshes
+
+    sleep(1.2)
+
+    dr = rw_kwargs(read = { "r" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 1
+
+    dr = rw_kwargs(read = { "r" })
+    dr.update(pool__cache_refreshing = True)
+    assert rwc.get("k", **dr) is None
+    rwc.put("k", "v2", **dr)
+
+    dr = rw_kwargs(read = { "r" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v2"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 1
+
+    sleep(1.2)
+
+    dr = rw_kwargs(read = { "r" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v2"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 2
+
+    sleep(1.0) # without grace period the expired value is not returned
+
+    dr = rw_kwargs(read = { "r" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) is None
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 2
+
+    # refresh that never comes back is abandoned after a while
+
+    rwc = ResourcePoolReadWriteCache("name", size = 10, default_ttl = 1.0, stale_ttl = 10.0, refresh_timeout = 1.0)
+    assert rwc.refresh_timeout == 1.0
+    refreshes.clear()
+
+    dr = rw_kwargs(read = { "a" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) is None
+    rwc.put("k", "v1", **dr)
+
+    sleep(1.2)
+
+    dr = rw_kwargs(read = { "a" })
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 1
+
+    dr = rw_kwargs(read = { "a" }) # the refresh is still in flight
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 1
+
+    sleep(1.2)
+
+    rwc.purge()
+    assert not rwc._refreshes
+
+    dr = rw_kwargs(read = { "a" }) # the lost refresh is replaced with another one
+    assert rwc.get("k", pool__cache_refresh = refresh, **dr) == "v1"
+    rwc.put("k", None, **dr)
+    assert len(refreshes) == 2 and "k" in rwc._refreshes
+
+    # prefix and range invalidation
+
+    rwc = ResourcePoolReadWriteCache("name", size = 10)
+
+    for k, read in (("ROW", "t/1"), ("TABLE", "t/*"), ("RANGE", ("t/k", 10, 20)), ("OTHER", "u/1")):
+        dr = rw_kwargs(read = { read })
+        assert rwc.get(k, **dr) is None
+        rwc.put(k, k, **dr)
+
+    dw = rw_kwargs(write = { ("t/k", 21, 30) })
+    assert rwc.get("k", **dw) is None
+    rwc.put("k", None, **dw)
+    assert "ROW" in rwc and "TABLE" not in rwc and "RANGE" in rwc and "OTHER" in rwc
+
+    dw = rw_kwargs(write = { ("t/k", 15) })
+    assert rwc.get("k", **dw) is None
+    rwc.put("k", None, **dw)
+    assert "ROW" in rwc and "RANGE" not in rwc and "OTHER" in rwc
+
+    dr = rw_kwargs(read = { ("t/k", 0, 100) }) # concurrent range write prevents caching
+    assert rwc.get("RANGE", **dr) is None
+    dw = rw_kwargs(write = { ("t/k", 100, 200) })
+    assert rwc.get("k", **dw) is None
+    rwc.put("RANGE", "RANGE", **dr)
+    rwc.put("k", None, **dw)
+    assert "RANGE" not in rwc
+
+    rwc.invalidate({ "t/*" })
+    assert "ROW" not in rwc and "OTHER" in rwc
+
+    # snapshots
+
+    snapshot_file = os_path.join(mkdtemp(), "cache.snapshot")
+
+    rwc = ResourcePoolReadWriteCache("name", size = 10, default_ttl = 3.0,
+                                     snapshot_file = snapshot_file, snapshot_stamp = "1",
+                                     snapshot_period = 1.0)
+    assert rwc.snapshot_file == snapshot_file
+    assert not rwc.snapshot_due
+    assert rwc.load_snapshot() == 0 # no snapshot yet
+
+    dr = rw_kwargs(read = { "t/1" })
+    assert rwc.get("ROW", **dr) is None
+    rwc.put("ROW", { "c": 1 }, pool__cache_weight = 2.0, pool__cache_group = "G", **dr)
+    dr = rw_kwargs(read = { "t/*" })
+    assert rwc.get("TABLE", **dr) is None
+    rwc.put("TABLE", [ 1 ], pool__cache_ttl = 1.0, **dr)
+    dr = rw_kwargs()
+    assert rwc.get("FOREVER", **dr) is None
+    rwc.put("FOREVER", "F", pool__cache_ttl = None, **dr)
+    dr = rw_kwargs()
+    assert rwc.get("LAMBDA", **dr) is None
+    rwc.put("LAMBDA", lambda: None, **dr)
+
+    sleep(1.5)
+    assert rwc.snapshot_due
+    assert rwc.save_snapshot() == 2 # expired and unpicklable values are not saved
+    assert not rwc.snapshot_due
+
+    rwc = ResourcePoolReadWriteCache("name", size = 10, snapshot_file = snapshot_file, snapshot_stamp = "1")
+    assert not rwc.snapshot_due # no period means no periodic snapshots
+    assert rwc.load_snapshot() == 2
+    assert rwc._cache["ROW"].value == { "c": 1 } and rwc._cache["FOREVER"].value == "F"
+    assert "TABLE" not in rwc and "LAMBDA" not in rwc
+    assert 1.0 < rwc._cache["ROW"].ttl < 1.5 and rwc._cache["ROW"].weight == 2.0
+    assert rwc._cache["ROW"].group == "G" and rwc._cache["FOREVER"].ttl is None
+    assert rwc._cached.find_conflicting_keys(keys("t/1")) == { "ROW" }
+
+    dw = rw_kwargs(write = { "t/*" }) # restored value is invalidated as usual
+    assert rwc.get("k", **dw) is None
+    rwc.put("k", None, **dw)
+    assert "ROW" not in rwc and "FOREVER" in rwc
+
+    sleep(1.5)
+    rwc = ResourcePoolReadWriteCache("name", size = 10, snapshot_file = snapshot_file, snapshot_stamp = "1")
+    assert rwc.load_snapshot() == 1 # the value has expired before the restart
+    assert "ROW" not in rwc and "FOREVER" in rwc
+
+    rwc = ResourcePoolReadWriteCache("name", size = 10, snapshot_file = snapshot_file, snapshot_stamp = "2")
+    assert rwc.load_snapshot() is None # different stamp, the snapshot is discarded
+    assert "FOREVER" not in rwc
+
     # burn-out test
 
     rwc = ResourcePoolReadWriteCache("name", size = 200, policy = "random",
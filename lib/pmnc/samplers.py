@@ -9,6 +9,14 @@
 #
 # RawSampler tracks measurable facts and calculates average value etc.
 # RateSampler tracks atomic events and calculates their rate of arrival.
+# Both keep the readings aggregated in a fixed number of time buckets,
+# therefore adding a reading and discarding the old ones takes constant
+# time and memory no matter how many readings arrive.
+# PercentileSampler keeps a number of the most recent readings and calculates
+# their percentiles.
+# HistogramSampler counts readings in log-linear buckets, which makes it possible
+# to calculate approximate percentiles of any number of readings in bounded
+# memory, histograms can be merged, for example to roll minutes up into hours.
 #
 # Pythomnic3k project
 # (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
@@ -16,29 +24,33 @@
 #
 ################################################################################
 
-__all__ = [ "RawSampler", "RateSampler" ]
+__all__ = [ "RawSampler", "RateSampler", "PercentileSampler", "HistogramSampler" ]
 
 ###############################################################################
 
 import threading; from threading import Lock
 import time; from time import time
-import math; from math import sqrt
+import math; from math import sqrt, ceil
+import collections; from collections import deque
 
 if __name__ == "__main__": # add pythomnic/lib to sys.path
     import os; import sys
     main_module_dir = os.path.dirname(sys.modules["__main__"].__file__) or os.getcwd()
     sys.path.insert(0, os.path.normpath(os.path.join(main_module_dir, "..")))
 
-import typecheck; from typecheck import typecheck
+import typecheck; from typecheck import typecheck, optional
 
 ###############################################################################
 
 class RawSampler:
 
+    _buckets = 50 # the period is split into this many buckets of readings
+
     @typecheck
     def __init__(self, period: float):
         self._lock = Lock()
         self._period = period
+        self._width = period / self._buckets
         self._clear()
 
     def _rcount(self):
@@ -49,12 +61,12 @@ class RawSampler:
     def _rmin(self):
         with self._lock:
             self.trim()
-            return self._min
+            return self._mins[0][1] if self._mins else 2**63-1
 
     def _rmax(self):
         with self._lock:
             self.trim()
-            return self._max
+            return self._maxs[0][1] if self._maxs else -2**63
 
     def _ravg(self):
         with self._lock:
@@ -65,10 +77,7 @@ class RawSampler:
         with self._lock:
             self.trim()
             n = (self._count or 1)
-            avg = self._sum / n
-            return sqrt(sum((data[1] - avg) ** 2
-                             for data in self._data)
-                        / n)
+            return sqrt(max(self._sumsq * n - self._sum ** 2, 0)) / n
 
     count = property(lambda self: self._rcount())
     min = property(lambda self: self._rmin())
@@ -76,44 +85,60 @@ class RawSampler:
     avg = property(lambda self: self._ravg())
     dev = property(lambda self: self._rdev())
 
+    # each bucket is [ index, count, sum, sum of squares ] of the readings that
+    # arrived within the same time slice of the period/_buckets width, the bucket
+    # is discarded as a whole as soon as its time slice is older than the period
+
     def trim(self):
-        deadline = time() - self._period
-        recalc_min, recalc_max = False, False
-        while self._data and self._data[0][0] <= deadline:
-            data = self._data.pop(0)[1]
-            self._count -= 1
-            self._sum -= data
-            if data == self._min: recalc_min = True
-            if data == self._max: recalc_max = True
-        if recalc_min:
-            if self._data:
-                self._min = min(map(lambda t_d: t_d[1], self._data))
-            else:
-                self._min = 2**63-1
-        if recalc_max:
-            if self._data:
-                self._max = max(map(lambda t_d: t_d[1], self._data))
-            else:
-                self._max = -2**63
+        if not self._data:
+            return
+        deadline = int((time() - self._period) // self._width)
+        while self._data and self._data[0][0] < deadline:
+            index, count, sum_, sumsq = self._data.popleft()
+            self._count -= count
+            self._sum -= sum_
+            self._sumsq -= sumsq
+        while self._mins and self._mins[0][0] < deadline:
+            self._mins.popleft()
+        while self._maxs and self._maxs[0][0] < deadline:
+            self._maxs.popleft()
+
+    # the minimums and maximums are kept in monotonic deques of (index, reading),
+    # there is at most one reading per bucket, the one that can still become
+    # the minimum (maximum) of the window once the older buckets are discarded
 
     def _iadd(self, data):
-        self._count += 1
-        self._sum += data
-        self._min = min(self._min, data)
-        self._max = max(self._max, data)
-        self._data.append((time(), data))
+        if self._width <= 0.0: # zero period sampler never keeps anything
+            return
+        index = int(time() // self._width)
+        if self._data and self._data[-1][0] == index:
+            bucket = self._data[-1]
+        else:
+            self.trim()
+            bucket = [ index, 0, 0, 0 ]
+            self._data.append(bucket)
+        bucket[1] += 1; bucket[2] += data; bucket[3] += data * data
+        self._count += 1; self._sum += data; self._sumsq += data * data
+        mins = self._mins
+        if not mins or mins[-1][0] != index or mins[-1][1] > data:
+            while mins and mins[-1][1] >= data:
+                mins.pop()
+            mins.append((index, data))
+        maxs = self._maxs
+        if not maxs or maxs[-1][0] != index or maxs[-1][1] < data:
+            while maxs and maxs[-1][1] <= data:
+                maxs.pop()
+            maxs.append((index, data))
 
     @typecheck
     def __iadd__(self, data: int):
         with self._lock:
             self._iadd(data)
-            if self._count % 100 == 0:
-                self.trim()
         return self
 
     def _clear(self):
-        self._data, self._count, self._sum = [], 0, 0
-        self._min, self._max = 2**63-1, -2**63
+        self._data, self._count, self._sum, self._sumsq = deque(), 0, 0, 0
+        self._mins, self._maxs = deque(), deque()
 
     def clear(self):
         with self._lock:
@@ -123,25 +148,166 @@ class RawSampler:
 
 class RateSampler(RawSampler):
 
-    def tick(self):
+    # ticks are counted per second as [ second, count, time of the first tick ],
+    # and each second's count becomes a reading once its first tick is 1 second old
+
+    def tick(self, count = 1):
         with self._lock:
-            self._ticks.append(time())
-            if len(self._ticks) % 100 == 0:
+            now = time()
+            second = int(now)
+            if self._ticks and self._ticks[-1][0] == second:
+                self._ticks[-1][1] += count
+            else:
+                self._ticks.append([ second, count, now ])
                 self.trim()
 
     def trim(self):
-        while self._ticks and self._ticks[0] <= time() - 1.0:
-            tick_second = int(self._ticks.pop(0))
-            tick_count = 1
-            while self._ticks and int(self._ticks[0]) == tick_second:
-                self._ticks.pop(0)
-                tick_count += 1
-            self._iadd(tick_count)
+        deadline = time() - 1.0
+        while self._ticks and self._ticks[0][2] <= deadline:
+            self._iadd(self._ticks.popleft()[1])
         RawSampler.trim(self)
 
     def _clear(self):
         RawSampler._clear(self)
-        self._ticks = []
+        self._ticks = deque()
+
+################################################################################
+
+class PercentileSampler:
+
+    @typecheck
+    def __init__(self, size: int):
+        self._lock = Lock()
+        self._size = size
+        self._clear()
+
+    def _rcount(self):
+        with self._lock:
+            return len(self._data)
+
+    count = property(lambda self: self._rcount())
+
+    @typecheck
+    def __iadd__(self, data: float):
+        with self._lock:
+            if len(self._data) < self._size:
+                self._data.append(data)
+            else:
+                self._data[self._next] = data # the oldest reading is overwritten
+            self._next = (self._next + 1) % self._size
+        return self
+
+    # nearest rank percentile of the kept readings, None if there are none
+
+    @typecheck
+    def percentile(self, p: float) -> optional(float):
+        with self._lock:
+            data = sorted(self._data)
+        if not data:
+            return None
+        return data[max(int(ceil(len(data) * p / 100.0)) - 1, 0)]
+
+    def _clear(self):
+        self._data, self._next = [], 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+################################################################################
+
+class HistogramSampler:
+
+    # non-negative integer readings below 2 ** _precision are counted exactly,
+    # above that each power of two range is split into 2 ** (_precision - 1)
+    # equal buckets, therefore the relative error is below 2 ** (1 - _precision)
+
+    _precision = 7
+
+    def __init__(self):
+        self._lock = Lock()
+        self._clear()
+
+    @classmethod
+    def _index(cls, data):
+        shift = data.bit_length() - cls._precision
+        if shift <= 0:
+            return data
+        return (shift << (cls._precision - 1)) + (data >> shift)
+
+    @classmethod
+    def _highest(cls, index): # the highest reading that falls into the bucket
+        half = 1 << (cls._precision - 1)
+        if index < 2 * half:
+            return index
+        shift, mantissa = divmod(index, half)
+        shift -= 1
+        return ((mantissa + half + 1) << shift) - 1
+
+    def _rcount(self):
+        with self._lock:
+            return self._count
+
+    def _rmax(self):
+        with self._lock:
+            return self._max
+
+    count = property(lambda self: self._rcount())
+    max = property(lambda self: self._rmax())
+
+    @typecheck
+    def __iadd__(self, data: int):
+        data = max(data, 0)
+        index = self._index(data)
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self._count += 1
+            if self._max is None or data > self._max:
+                self._max = data
+        return self
+
+    # this method adds all the readings of another histogram to this one
+
+    def merge(self, other):
+        with other._lock:
+            counts, count, max_ = other._counts.copy(), other._count, other._max
+        with self._lock:
+            for index, n in counts.items():
+                self._counts[index] = self._counts.get(index, 0) + n
+            self._count += count
+            if max_ is not None and (self._max is None or max_ > self._max):
+                self._max = max_
+        return self
+
+    # nearest rank percentiles, each is the highest reading that could fall into
+    # the same bucket, but not greater than the actual maximum, None if empty
+
+    def percentiles(self, *ps):
+        with self._lock:
+            if not self._count:
+                return [ None ] * len(ps)
+            ranks = [ max(int(ceil(self._count * p / 100.0)), 1) for p in ps ]
+            result = [ None ] * len(ps)
+            seen = 0
+            for index in sorted(self._counts.keys()):
+                seen += self._counts[index]
+                for i, rank in enumerate(ranks):
+                    if result[i] is None and seen >= rank:
+                        result[i] = min(self._highest(index), self._max)
+                if None not in result:
+                    break
+            return result
+
+    @typecheck
+    def percentile(self, p: float) -> optional(int):
+        return self.percentiles(p)[0]
+
+    def _clear(self):
+        self._counts, self._count, self._max = {}, 0, None
+
+    def clear(self):
+        with self._lock:
+            self._clear()
 
 ################################################################################
 
@@ -226,7 +392,7 @@ if __name__ == "__main__":
 
     assert rs.count == 0 and rs._sum == 0 and rs.avg == 0.0 and \
            rs.min == 2**63-1 and rs.max == -2**63 and is_close(rs.dev, 0.0) and \
-           len(rs._ticks) == 50
+           sum(t[1] for t in rs._ticks) == 50
 
     for i in range(100):
         sleep(0.01)
@@ -236,6 +402,129 @@ if __name__ == "__main__":
 
     assert rs.count in (2, 3, 4) and rs._sum == 150
 
+    rs.tick(20)
+    rs.tick(30)
+    sleep(1.1)
+
+    assert rs.count in (3, 4, 5, 6) and rs._sum == 200
+
+    ###################################
+
+    from random import randint
+
+    rs = RawSampler(3600.0)
+    data = [ randint(-1000, 1000) for i in range(10000) ]
+    for d in data:
+        rs += d
+
+    avg = sum(data) / len(data)
+    dev = sqrt(sum((d - avg) ** 2 for d in data) / len(data))
+
+    assert rs.count == len(data) and rs.min == min(data) and rs.max == max(data)
+    assert is_close(rs.avg, avg) and is_close(rs.dev, dev)
+    assert len(rs._data) <= 2 and len(rs._mins) <= 2 and len(rs._maxs) <= 2
+
+    ###################################
+
+    rs = RawSampler(0.5)
+
+    for d in (5, 1, 3, 2, 4):
+        rs += d
+        sleep(0.11)
+
+    assert rs.count in (4, 5) and rs.max in (4, 5) and rs.min == 1
+
+    sleep(0.24)
+    assert rs.count in (2, 3) and rs.min == 2 and rs.max == 4
+
+    sleep(0.23)
+    assert rs.count in (0, 1) and rs.min in (4, 2**63-1) and rs.max in (4, -2**63)
+
+    ###################################
+
+    from time import time as now
+
+    rs = RawSampler(1.0)
+    rt = RateSampler(1.0)
+
+    n = 200000
+    start = now()
+    for i in range(n):
+        rs += i % 1000
+        rt.tick()
+    elapsed = now() - start
+
+    assert len(rs._data) <= RawSampler._buckets + 1 and len(rs._mins) <= RawSampler._buckets + 1
+    assert len(rt._ticks) <= 2
+
+    print("{0:.02f} us per reading and tick".format(elapsed * 1000000 / n))
+
+    ###################################
+
+    ps = PercentileSampler(10)
+
+    assert ps.count == 0 and ps.percentile(50.0) is None
+
+    ps += 5.0
+    assert ps.count == 1 and ps.percentile(0.0) == ps.percentile(100.0) == 5.0
+
+    for i in range(1, 11):
+        ps += float(i)
+
+    assert ps.count == 10 # the first reading has been overwritten
+    assert ps.percentile(0.0) == 1.0 and ps.percentile(10.0) == 1.0 and ps.percentile(11.0) == 2.0
+    assert ps.percentile(50.0) == 5.0 and ps.percentile(95.0) == 10.0 and ps.percentile(100.0) == 10.0
+
+    for i in range(5):
+        ps += 100.0
+
+    assert ps.percentile(50.0) == 10.0 and ps.percentile(51.0) == 100.0
+
+    ps.clear()
+    assert ps.count == 0
+
+    ###################################
+
+    hs = HistogramSampler()
+
+    assert hs.count == 0 and hs.max is None and hs.percentile(50.0) is None
+    assert hs.percentiles(50.0, 99.0) == [ None, None ]
+
+    for i in range(1 << HistogramSampler._precision): # small readings are exact
+        assert HistogramSampler._index(i) == i and HistogramSampler._highest(i) == i
+
+    prev_index = HistogramSampler._index(127)
+    for i in range(128, 1000000): # buckets are contiguous and the error is bounded
+        index = HistogramSampler._index(i)
+        assert index in (prev_index, prev_index + 1)
+        highest = HistogramSampler._highest(index)
+        assert i <= highest and (highest - i) / i < 2 ** (1 - HistogramSampler._precision)
+        if index == prev_index + 1:
+            assert HistogramSampler._highest(prev_index) == i - 1
+        prev_index = index
+
+    for i in range(1, 101):
+        hs += i
+    hs += -1 # negative readings count as zeroes
+
+    assert hs.count == 101 and hs.max == 100
+    assert hs.percentiles(0.0, 1.0, 50.0, 99.0, 100.0) == [ 0, 1, 50, 99, 100 ]
+
+    hs2 = HistogramSampler()
+    for i in range(100):
+        hs2 += 100000 + i * 1000
+
+    assert 149000 <= hs2.percentile(50.0) < 149000 * (1 + 2 ** (1 - HistogramSampler._precision))
+    assert hs2.max == 199000
+
+    hs.merge(hs2)
+    assert hs.count == 201 and hs.max == 199000
+    assert hs.percentile(50.0) == 100 and hs.percentile(99.9) == 199000
+    assert abs(hs.percentile(99.0) - 197000) / 197000 < 0.02
+
+    hs.clear()
+    assert hs.count == 0 and hs.max is None
+
     ###################################
 
     print("ok")
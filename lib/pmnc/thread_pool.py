@@ -171,6 +171,22 @@ class ThreadPool:
         self._push(work_unit)
         return work_unit
 
+    # the following two methods allow the calling thread to do the work itself
+    # instead of enqueueing it, while one of the pool threads is held busy, this
+    # way the pool size still limits the concurrency, a thread is reserved only
+    # if it is available right away and no other work units are queued ahead
+
+    def reserve(self):
+        if len(self._queue) > 0:
+            return None
+        try:
+            return self._threads.allocate()
+        except (ResourcePoolEmpty, ResourcePoolStopped):
+            return None
+
+    def unreserve(self, thread):
+        self._release(thread)
+
 ################################################################################
 
 if __name__ == "__main__":
@@ -454,6 +470,42 @@ if __name__ == "__main__":
 
     ###################################
 
+    print("thread reservation: ", end = "")
+
+    RegisteredResourcePool.start_pools(0.5)
+    try:
+
+        rq = fake_request(3.0)
+        tp = ThreadPool("TP", 2)
+
+        th1 = tp.reserve()
+        th2 = tp.reserve()
+        assert th1 is not None and th2 is not None and th1 is not th2
+        assert tp.reserve() is None and tp.busy == 2
+
+        wu = tp.enqueue(rq, wu_loopback, (1, ), {}) # queued until a thread is unreserved
+        sleep(0.5)
+        assert tp.over == 1
+        assert tp.reserve() is None
+
+        tp.unreserve(th1) # the released thread picks the queued work unit up
+        assert wu.wait() == ((1, ), {})
+        assert tp.over == 0
+
+        th1 = tp.reserve()
+        assert th1 is not None
+        tp.unreserve(th1)
+        tp.unreserve(th2)
+        sleep(0.5)
+        assert tp.busy == 0 and tp.free == 2
+
+    finally:
+        RegisteredResourcePool.stop_pools()
+
+    print("ok")
+
+    ###################################
+
     print("avalanche processing, 10 threads: ", end = "")
 
     RegisteredResourcePool.start_pools(0.5)
@@ -32,9 +32,9 @@
 ###############################################################################
 
 import sys; from sys import argv, modules, stdout, path as sys_path, executable as python
-import os; from os import path as os_path, getcwd, mkdir, write, fsync, close, getpid
-import threading; from threading import Lock, current_thread
-import time; from time import time, localtime, strftime, sleep
+import os; from os import path as os_path, getcwd, mkdir, getpid
+import threading; from threading import current_thread
+import time; from time import sleep
 import platform; from platform import node as node_name
 import errno; from errno import EEXIST
 try:
@@ -55,8 +55,9 @@ sys_path.insert(0, lib_dir)
 import exc_string; from exc_string import exc_string
 import typecheck; from typecheck import typecheck, by_regex
 import pmnc.module_loader; from pmnc.module_loader import ModuleLoader
-import pmnc.popen; from pmnc.popen import popen, fopen
+import pmnc.popen; from pmnc.popen import popen
 import pmnc.threads; from pmnc.threads import LightThread, HeavyThread
+import pmnc.log_writer; from pmnc.log_writer import LogWriter
 
 #######################################
 
@@ -141,45 +142,10 @@ def secondary_startup(node, cage, mode):
     lib_dir = os_path.join(cage_dir, "lib")
     sys_path.insert(0, lib_dir)
 
-    log_abbrevs = { 1: "ERR", 2: "MSG", 3: "WRN", 4: "LOG", 5: "INF", 6: "DBG", 7: "NSE" }
-    log_encoding = "windows-1251"
-    log_translate = b"         \t                      " + bytes(range(32, 256))
-    log_lock = Lock()
-
-    log_yyyymmdd = None
-    log_file = None
-
-    # the following function will serve for all cage's logging
-
-    def log(message, *, msg_level):
-
-        nonlocal log_yyyymmdd, log_file
-
-        line_time = time()
-        line_yyyymmdd, line_hhmmss = strftime("%Y%m%d %H:%M:%S", localtime(line_time)).split(" ")
-        log_line = "{0:s}.{1:02d} {2:s} [{3:s}] {4:s}".format(line_hhmmss, int(line_time * 100) % 100,
-                                            log_abbrevs.get(msg_level, "???"), current_thread().name, message)
-        with log_lock:
-
-            if line_yyyymmdd != log_yyyymmdd: # rotate log file
-                try:
-                    new_log_file_name = os_path.join(logs_dir, "{0:s}-{1:s}.log".format(cage, line_yyyymmdd))
-                    new_log_file = fopen(new_log_file_name, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
-                except:
-                    pass # if rotation fails, previous log file will still be used
-                else:
-                    try:
-                        close(log_file)
-                    except:
-                        pass # this also catches the attempt to close None
-                    log_file = new_log_file
-                    log_yyyymmdd = line_yyyymmdd
-
-            if log_file is not None:
-                if message:
-                    write(log_file, log_line.encode(log_encoding, "replace").translate(log_translate) + b"\n")
-                if msg_level == 1:
-                    fsync(log_file)
+    # all cage's logging is done through a background writer thread,
+    # see lib/pmnc/log_writer.py for details
+
+    log = LogWriter(logs_dir, cage)
 
     ###################################
 
@@ -245,7 +211,7 @@ def secondary_startup(node, cage, mode):
     ###################################
 
     log("the cage has been properly shut down", msg_level = 2)
-    log("", msg_level = 1) # force flush of a log file
+    log.close() # writes and flushes the remaining lines
 
 #######################################
 
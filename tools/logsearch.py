@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#-*- coding: iso-8859-1 -*-
+################################################################################
+#
+# This tool prints the lines of a structured cage log (see log_format in
+# config_interfaces.py) logged on behalf of one request, or within a range
+# of time, without scanning the entire file.
+#
+# Usage:
+# c:> logsearch.py cage-yyyymmdd.jsonl RQ-XXXX [--json]
+# c:> logsearch.py cage-yyyymmdd.jsonl HH:MM[:SS] [HH:MM[:SS]] [--json]
+#
+# The request can be specified either by its short id as it appears in the
+# log or by its full unique id. The time is that of the day of the log file,
+# the end of a range includes the whole of its minute or second, a range with
+# no end lasts until the end of the file. The lines are printed
+# the same way the plain text log has them, or as they are with --json.
+#
+# Pythomnic3k project
+# (c) 2005-2014, Dmitry Dvoinikov <dmitry@targeted.org>
+# Distributed under BSD license
+#
+################################################################################
+
+import sys; from sys import argv, exit, stdout, path as sys_path
+import os; from os import path as os_path
+import time; from time import mktime, strptime
+import json; from json import dumps
+
+main_module_dir = os_path.dirname(sys.modules["__main__"].__file__) or os.getcwd()
+sys_path.insert(0, os_path.normpath(os_path.join(main_module_dir, "..", "lib")))
+
+import pmnc.log_reader; from pmnc.log_reader import LogReader
+
+###############################################################################
+
+def _parse_time(yyyymmdd, hhmmss):
+    if hhmmss.count(":") == 1:
+        hhmmss += ":00"
+    return mktime(strptime("{0:s} {1:s}".format(yyyymmdd, hhmmss), "%Y%m%d %H:%M:%S"))
+
+# the end of a range is just past the minute or the second it specifies
+
+def _parse_end_time(yyyymmdd, hhmmss):
+    return _parse_time(yyyymmdd, hhmmss) + (hhmmss.count(":") == 1 and 60.0 or 1.0)
+
+###############################################################################
+
+if __name__ == "__main__":
+
+    args = [ arg for arg in argv[1:] if arg != "--json" ]
+    raw = len(args) < len(argv) - 1
+
+    if len(args) not in (2, 3) or not os_path.isfile(args[0]):
+        print("usage: logsearch.py cage-yyyymmdd.jsonl RQ-XXXX [--json]")
+        print("       logsearch.py cage-yyyymmdd.jsonl HH:MM[:SS] [HH:MM[:SS]] [--json]")
+        exit(1)
+
+    filename = args[0]
+    yyyymmdd = os_path.basename(filename).rsplit(".", 1)[0].rsplit("-", 1)[-1]
+
+    lr = LogReader(filename)
+    try:
+        if args[1].startswith("RQ-"):
+            lines = lr.request_lines(args[1])
+        else:
+            start = _parse_time(yyyymmdd, args[1])
+            end = _parse_end_time(yyyymmdd, args[2]) if len(args) == 3 else float("inf")
+            lines = [ line for line in lr.time_lines(start, end) if line["ts"] < end ]
+    finally:
+        lr.close()
+
+    for line in lines:
+        stdout.write((dumps(line) if raw else LogReader.format_line(line)) + "\n")
+
+################################################################################
+# EOF